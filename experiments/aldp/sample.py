@@ -7,6 +7,7 @@ import numpy as np
 import boltzgen as bg
 
 from fab.utils.training import load_config
+from fab.sampling_methods import ParallelAnnealedImportanceSampler
 from experiments.make_flow.make_aldp_model import make_aldp_model
 
 
@@ -37,6 +38,9 @@ parser.add_argument('--n_ais_samples', type=int, default=-1,
 parser.add_argument('--batch_size', type=int, default=None,
                     help='Batch size to be used for sampling, '
                          'if None the one from config is used')
+parser.add_argument('--n_processes', type=int, default=1,
+                    help='Number of CPU worker processes to be used '
+                         'for AIS, only supported in cpu mode')
 
 args = parser.parse_args()
 
@@ -123,24 +127,36 @@ if n_ais_samples > 0:
     log_w = np.zeros(n_ais_samples, dtype=args.precision)
     log_p = np.zeros(n_ais_samples, dtype=args.precision)
 
-    n_batches = int(np.ceil(n_ais_samples / batch_size))
-
-    torch.manual_seed(seed)
-
-    # Draw samples
-    for i in range(n_batches):
-        if i == n_batches - 1:
-            end = n_ais_samples
-            end_ = n_ais_samples % batch_size
-        else:
-            end = (i + 1) * batch_size
-            end_ = batch_size
-        point, lw = model.annealed_importance_sampler.sample_and_log_weights(batch_size)
-        z = point.x
-        lp = model.target_distribution.log_prob(z[:end_, :].detach())
-        samples[(i * batch_size):end, :] = z[:end_, :].detach().cpu().numpy()
-        log_w[(i * batch_size):end] = lw[:end_].detach().cpu().numpy()
-        log_p[(i * batch_size):end] = lp.detach().cpu().numpy()
+    if args.n_processes > 1:
+        assert not use_gpu, "Parallel AIS is only supported in cpu mode"
+        parallel_ais = ParallelAnnealedImportanceSampler(model.annealed_importance_sampler,
+                                                         args.n_processes, seed=seed)
+        z, lw, lp = parallel_ais.sample(n_ais_samples, batch_size)
+        n_valid = len(z)
+        samples[:n_valid, :] = z.numpy()
+        log_w[:n_valid] = lw.numpy()
+        log_p[:n_valid] = lp.numpy()
+        # Samples dropped by AIS as invalid are saved with zero weight.
+        log_w[n_valid:] = -np.inf
+    else:
+        n_batches = int(np.ceil(n_ais_samples / batch_size))
+
+        torch.manual_seed(seed)
+
+        # Draw samples
+        for i in range(n_batches):
+            if i == n_batches - 1:
+                end = n_ais_samples
+                end_ = n_ais_samples % batch_size
+            else:
+                end = (i + 1) * batch_size
+                end_ = batch_size
+            point, lw = model.annealed_importance_sampler.sample_and_log_weights(batch_size)
+            z = point.x
+            lp = model.target_distribution.log_prob(z[:end_, :].detach())
+            samples[(i * batch_size):end, :] = z[:end_, :].detach().cpu().numpy()
+            log_w[(i * batch_size):end] = lw[:end_].detach().cpu().numpy()
+            log_p[(i * batch_size):end] = lp.detach().cpu().numpy()
 
     # Save samples
     path = os.path.join(s_dir, 'ais_samples_%03i.npz' % seed)
@@ -13,8 +13,12 @@ from fab.sampling_methods.transition_operators import HamiltonianMonteCarlo, Met
 from fab.utils.aldp import evaluate_aldp
 from fab.utils.aldp import filter_chirality
 from fab.utils.numerical import effective_sample_size
+from fab.sampling_methods.base import Point
 from fab.utils.replay_buffer import ReplayBuffer
 from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer
+from fab.utils.memory_mapped_replay_buffer import MemoryMappedPrioritisedReplayBuffer
+from fab.utils.pinned_replay_buffer import PinnedPrioritisedReplayBuffer
+from fab.utils.buffer_storage import get_storage_dtype, stored_sample_log_probs
 from fab.core import ALPHA_DIV_TARGET_LOSSES
 from experiments.make_flow.make_aldp_model import make_aldp_model
 
@@ -167,6 +171,8 @@ max_grad_norm = (
 grad_clipping = max_grad_norm is not None
 if grad_clipping:
     grad_norm_hist = np.zeros((0, 2))
+# Buffer memory, and the error from storing the buffer samples in reduced precision
+buffer_storage_hist = np.zeros((0, 5))
 
 # Set parameters for training
 ndim = 60
@@ -220,6 +226,9 @@ if args.resume:
         if grad_clipping:
             log_labels.append("grad_norm")
             log_hists.append(grad_norm_hist)
+        if "replay_buffer" in config["training"]:
+            log_labels.append("buffer_storage")
+            log_hists.append(buffer_storage_hist)
         for log_label, log_hist in zip(log_labels, log_hists):
             log_path = os.path.join(log_dir, log_label + ".csv")
             if os.path.exists(log_path):
@@ -238,20 +247,34 @@ if args.resume:
 if "replay_buffer" in config["training"]:
     use_rb = True
     rb_config = config["training"]["replay_buffer"]
+    x_dtype = get_storage_dtype(rb_config.get("x_dtype"))
+    log_w_dtype = get_storage_dtype(rb_config.get("log_w_dtype"))
     if rb_config["type"] == "uniform":
 
+        def get_buffer_log_probs(point):
+            # If x is stored in reduced precision, then the log probs are those of the rounded x.
+            log_q, log_p, _ = stored_sample_log_probs(
+                point.x, x_dtype, point.log_q, model.flow.log_prob,
+                point.log_p, model.target_distribution.log_prob
+            )
+            return log_q, log_p
+
         def initial_sampler():
             point, log_w = model.annealed_importance_sampler.sample_and_log_weights(
                 batch_size, logging=False
             )
-            return point.x, log_w
+            return (point.x, log_w) + get_buffer_log_probs(point)
 
+        # Store the target log probs, so that the replay steps do not re-evaluate the target.
         buffer = ReplayBuffer(
             dim=ndim,
             max_length=rb_config["max_length"] * batch_size,
             min_sample_length=rb_config["min_length"] * batch_size,
             initial_sampler=initial_sampler,
             device=str(device),
+            store_log_probs=True,
+            x_dtype=x_dtype,
+            log_w_dtype=log_w_dtype,
         )
     elif rb_config["type"] == "prioritised":
         buffer_path = os.path.join(cp_dir, "buffer.pt")
@@ -267,15 +290,44 @@ if "replay_buffer" in config["training"]:
                 point, log_w = model.annealed_importance_sampler.sample_and_log_weights(
                     batch_size, logging=False
                 )
-                return point.x, log_w, point.log_q
-
-        buffer = PrioritisedReplayBuffer(
-            dim=ndim,
-            max_length=rb_config["max_length"] * batch_size,
-            min_sample_length=rb_config["min_length"] * batch_size,
-            initial_sampler=initial_sampler,
-            device=str(device),
-        )
+                log_q, _, _ = stored_sample_log_probs(
+                    point.x, x_dtype, point.log_q, model.flow.log_prob
+                )
+                return point.x, log_w, log_q
+
+        if rb_config.get("memory_mapped", False):
+            # Keep the samples in memory-mapped files next to the checkpoints.
+            buffer = MemoryMappedPrioritisedReplayBuffer(
+                dim=ndim,
+                max_length=rb_config["max_length"] * batch_size,
+                min_sample_length=rb_config["min_length"] * batch_size,
+                initial_sampler=initial_sampler,
+                storage_dir=os.path.join(cp_dir, "buffer_storage"),
+                device=str(device),
+                x_dtype=x_dtype,
+                log_w_dtype=log_w_dtype,
+            )
+        elif rb_config.get("pin_memory", False):
+            # Keep the samples in pinned host memory, and prefetch batches to the device.
+            buffer = PinnedPrioritisedReplayBuffer(
+                dim=ndim,
+                max_length=rb_config["max_length"] * batch_size,
+                min_sample_length=rb_config["min_length"] * batch_size,
+                initial_sampler=initial_sampler,
+                transfer_device=str(device),
+                x_dtype=x_dtype,
+                log_w_dtype=log_w_dtype,
+            )
+        else:
+            buffer = PrioritisedReplayBuffer(
+                dim=ndim,
+                max_length=rb_config["max_length"] * batch_size,
+                min_sample_length=rb_config["min_length"] * batch_size,
+                initial_sampler=initial_sampler,
+                device=str(device),
+                x_dtype=x_dtype,
+                log_w_dtype=log_w_dtype,
+            )
 
         if os.path.exists(buffer_path):
             buffer.load(buffer_path)
@@ -336,6 +388,7 @@ model.set_ais_target(min_is_target=min_is_target)
 
 # Start training
 start_time = time()
+log_q_quantisation_error = np.nan
 
 for it in range(start_iter, max_iter):
     # Get loss
@@ -378,12 +431,13 @@ for it in range(start_iter, max_iter):
                 )
                 buffer_iter = iter(buffer_sample)
                 # Add sample to buffer
-                buffer.add(point_ais.x, log_w_ais)
+                buffer.add(point_ais.x, log_w_ais, *get_buffer_log_probs(point_ais))
             else:
-                x, log_w = next(buffer_iter)
-                log_q = model.flow.log_prob(x)
-                log_p = model.target_distribution.log_prob(x)
-                loss = model.fab_ub_alpha_div_loss_inner(log_q, log_p, log_w)
+                # log_p is reused from AIS, and log_q is re-evaluated by the loss.
+                x, log_w, log_q, log_p = next(buffer_iter)
+                loss = model.fab_ub_alpha_div_loss_inner(
+                    Point(x=x, log_q=log_q, log_p=log_p), log_w
+                )
         elif rb_config["type"] == "prioritised":
             if it % rb_config["n_updates"] == 0:
                 # Sample
@@ -399,7 +453,15 @@ for it in range(start_iter, max_iter):
                         point_ais = point_ais[ind_L]
                         log_w_ais = log_w_ais[ind_L]
                 # Add sample to buffer
-                buffer.add(point_ais.x, log_w_ais.detach(), point_ais.log_q)
+                # Store log q of the rounded samples, so that the weight adjustments are not
+                # biased by the rounding.
+                log_q_ais, _, stored_info = stored_sample_log_probs(
+                    point_ais.x, buffer.x_dtype, point_ais.log_q, model.flow.log_prob
+                )
+                log_q_quantisation_error = stored_info.get(
+                    "buffer_log_q_quantisation_error_mean", log_q_quantisation_error
+                )
+                buffer.add(point_ais.x, log_w_ais.detach(), log_q_ais)
                 # Sample from buffer
                 buffer_sample = buffer.sample_n_batches(
                     batch_size=batch_size, n_batches=rb_config["n_updates"]
@@ -512,6 +574,30 @@ for it in range(start_iter, max_iter):
             header="it,flow,ais",
             comments="",
         )
+        # Buffer storage
+        if use_rb:
+            storage_info = buffer.get_storage_info()
+            buffer_storage_append = np.array(
+                [
+                    [
+                        it + 1,
+                        storage_info["buffer_storage_mb"],
+                        storage_info.get("x_quantisation_error_rms", np.nan),
+                        storage_info.get("x_quantisation_error_max", np.nan),
+                        log_q_quantisation_error,
+                    ]
+                ]
+            )
+            buffer_storage_hist = np.concatenate(
+                [buffer_storage_hist, buffer_storage_append]
+            )
+            np.savetxt(
+                os.path.join(log_dir, "buffer_storage.csv"),
+                buffer_storage_hist,
+                delimiter=",",
+                header="it,storage_mb,x_error_rms,x_error_max,log_q_error_mean",
+                comments="",
+            )
         if use_gpu:
             torch.cuda.empty_cache()
 
@@ -5,7 +5,8 @@ import normflows as nf
 import larsflow as lf
 
 from fab.target_distributions.aldp import AldpBoltzmann
-from fab.sampling_methods.transition_operators import HamiltonianMonteCarlo, Metropolis
+from fab.sampling_methods.transition_operators import HamiltonianMonteCarlo, Metropolis, \
+    MetropolisAdjustedLangevin
 from fab.wrappers.normflows import WrappedNormFlowModel
 from fab import FABModel
 from fab.core import ALPHA_DIV_TARGET_LOSSES
@@ -256,6 +257,20 @@ def make_aldp_model(config, device):
             max_step_size=config["fab"]["max_step_size"],
             min_step_size=config["fab"]["min_step_size"],
             adjust_step_size=config["fab"]["adjust_step_size"],
+            # Screen proposals with the flow before calling OpenMM.
+            delayed_acceptance=config["fab"].get("delayed_acceptance", False),
+        )
+    elif transition_type == "mala":
+        transition_operator = MetropolisAdjustedLangevin(
+            n_ais_intermediate_distributions=config["fab"]["n_int_dist"],
+            dim=ndim,
+            base_log_prob=flow.log_prob,
+            target_log_prob=target.log_prob,
+            p_target=not min_is_target,
+            alpha=alpha,
+            n_updates=config["fab"]["n_inner"],
+            step_size=config["fab"]["epsilon"],
+            adjust_step_size=config["fab"]["adjust_step_size"],
         )
     else:
         raise NotImplementedError(
@@ -0,0 +1,53 @@
+import time
+
+import torch
+
+from fab.target_distributions.many_well import ManyWellEnergy
+
+
+def log_prob_loop(target: ManyWellEnergy, x: torch.Tensor) -> torch.Tensor:
+    """Reference implementation of `ManyWellEnergy.log_prob`, with a Python loop over wells."""
+    return torch.sum(torch.stack([super(ManyWellEnergy, target).log_prob(x[:, i*2:i*2+2])
+                                  for i in range(target.n_wells)]), dim=0)
+
+
+def sample_loop(target: ManyWellEnergy, n_samples: int) -> torch.Tensor:
+    """Reference implementation of `ManyWellEnergy.sample`, with a rejection sampling call per
+    well."""
+    return torch.concat([super(ManyWellEnergy, target).sample((n_samples,))
+                         for _ in range(target.n_wells)], dim=-1)
+
+
+def time_fn(fn, n_repeats: int, device: str) -> float:
+    """Average time of `fn` in milliseconds, after a warmup call."""
+    fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_repeats * 1000
+
+
+if __name__ == '__main__':
+    # Compare the vectorised `log_prob` and `sample` against looping over wells, as the
+    # dimension grows.
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    batch_size = 1024
+    n_repeats = 20
+    print(f"device: {device}, batch size: {batch_size}")
+    print(f"{'dim':>5} {'log_prob loop':>14} {'log_prob vec':>13} "
+          f"{'sample loop':>12} {'sample vec':>11}  (ms)")
+    for dim in [8, 16, 32, 64, 128]:
+        target = ManyWellEnergy(dim=dim, use_gpu=device == "cuda")
+        x = target.sample((batch_size,)).to(device)
+        torch.testing.assert_close(target.log_prob(x), log_prob_loop(target, x))
+        times = [
+            time_fn(lambda: log_prob_loop(target, x), n_repeats, device),
+            time_fn(lambda: target.log_prob(x), n_repeats, device),
+            time_fn(lambda: sample_loop(target, batch_size), n_repeats, device),
+            time_fn(lambda: target.sample((batch_size,)), n_repeats, device),
+        ]
+        print(f"{dim:>5} {times[0]:>14.3f} {times[1]:>13.3f} {times[2]:>12.3f} {times[3]:>11.3f}")
@@ -12,15 +12,19 @@ from datetime import datetime
 import matplotlib.pyplot as plt
 import torch
 
-from fab import Trainer, BufferTrainer, PrioritisedBufferTrainer
+from fab import Trainer, BufferTrainer, PrioritisedBufferTrainer, AsyncPrioritisedBufferTrainer
 from fab.target_distributions.base import TargetDistribution
 from fab.utils.logging import PandasLogger, WandbLogger, Logger, ListLogger
 from fab.utils.replay_buffer import ReplayBuffer
 from fab.utils.plotting import plot_history
 
-from fab import FABModel, HamiltonianMonteCarlo, Metropolis
+from fab import FABModel, HamiltonianMonteCarlo, Metropolis, MetropolisAdjustedLangevin, \
+    MultipleTryMetropolis
 from fab.core import ALPHA_DIV_TARGET_LOSSES
+from fab.sampling_methods.transition_operators.hmc import INTEGRATORS
 from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer
+from fab.utils.pinned_replay_buffer import PinnedPrioritisedReplayBuffer
+from fab.utils.buffer_storage import get_storage_dtype, stored_sample_log_probs
 
 from experiments.make_flow import make_wrapped_normflow_realnvp, \
     make_wrapped_normflow_resampled_flow, make_wrapped_normflow_snf_model
@@ -39,7 +43,9 @@ def get_n_iterations(
         n_intermediate_ais_dist: int,
         transition_operator_type: str,
         use_buffer: bool,
-        min_buffer_length: Optional[int] = None) -> int:
+        min_buffer_length: Optional[int] = None,
+        n_transition_operator_tries: int = 1,
+        hmc_integrator: str = "leapfrog") -> int:
     """
     Calculate the number of training iterations, based on the run config.
     We define one "training iteration" as
@@ -64,11 +70,18 @@ def get_n_iterations(
             if transition_operator_type == "hmc":
                 # Note this also requires differentiating the flow, which is fair as the
                 # KLD forward pass also requires a differentiation of target and flow step.
-                # +1 is for the initial sampling step.
+                # +1 is for the initial sampling step. Multi-stage integrators evaluate the
+                # gradient once per stage.
+                n_stages = len(INTEGRATORS[hmc_integrator][1])
                 n_flow_eval_per_ais_forward = \
-                    (n_transition_operator_inner_steps)*n_intermediate_ais_dist + 1
+                    (n_transition_operator_inner_steps)*n_stages*n_intermediate_ais_dist + 1
+            elif transition_operator_type == "mtm":
+                # Each multiple-try step evaluates the tries, and one less reference point.
+                n_flow_eval_per_ais_forward = (2*n_transition_operator_tries - 1) * \
+                    n_transition_operator_inner_steps*n_intermediate_ais_dist + 1
             else:
-                assert transition_operator_type == "metropolis"
+                # Metropolis and MALA evaluate the flow (and for MALA its gradient) once per step.
+                assert transition_operator_type in ["metropolis", "mala"]
                 # +1 for the initial sampling step
                 n_flow_eval_per_ais_forward = \
                     n_transition_operator_inner_steps*n_intermediate_ais_dist + 1
@@ -103,28 +116,51 @@ def setup_logger(cfg: DictConfig, save_path: str) -> Logger:
 def setup_buffer(cfg: DictConfig, fab_model: FABModel, auto_fill_buffer: bool) -> \
         Union[ReplayBuffer, PrioritisedReplayBuffer]:
     dim = cfg.target.dim  # applies to flow and target
+    # Optional reduced precision storage, e.g. "bfloat16" for the samples.
+    x_dtype = get_storage_dtype(cfg.training.get("buffer_x_dtype", None))
+    log_w_dtype = get_storage_dtype(cfg.training.get("buffer_log_w_dtype", None))
     if cfg.training.prioritised_buffer is False:
         def initial_sampler():
             # used to fill the replay buffer up to its minimum size
-            x, log_w = fab_model.annealed_importance_sampler.sample_and_log_weights(
+            point, log_w = fab_model.annealed_importance_sampler.sample_and_log_weights(
                 cfg.training.batch_size, logging=False)
-            return x, log_w
+            # If x is stored in reduced precision, then the log probs are those of the rounded x.
+            log_q, log_p, _ = stored_sample_log_probs(
+                point.x.detach(), x_dtype, point.log_q.detach(), fab_model.flow.log_prob,
+                point.log_p.detach(), fab_model.target_distribution.log_prob)
+            return point.x.detach(), log_w, log_q, log_p
 
+        # Store the target log probs, so that the replay steps do not re-evaluate the target.
         buffer = ReplayBuffer(dim=dim, max_length=cfg.training.maximum_buffer_length,
                               min_sample_length=cfg.training.min_buffer_length,
                               initial_sampler=initial_sampler,
-                              temperature=cfg.training.buffer_temp)
+                              temperature=cfg.training.buffer_temp,
+                              store_log_probs=True,
+                              x_dtype=x_dtype, log_w_dtype=log_w_dtype)
     else:
         # buffer
         def initial_sampler():
             point, log_w = fab_model.annealed_importance_sampler.sample_and_log_weights(
                 cfg.training.batch_size, logging=False)
-            return point.x.detach(), log_w, point.log_q.detach()
-
-        buffer = PrioritisedReplayBuffer(dim=dim, max_length=cfg.training.maximum_buffer_length,
-                                         min_sample_length=cfg.training.min_buffer_length,
-                                         initial_sampler=initial_sampler,
-                                         fill_buffer_during_init=auto_fill_buffer)
+            log_q, _, _ = stored_sample_log_probs(point.x.detach(), x_dtype,
+                                                  point.log_q.detach(), fab_model.flow.log_prob)
+            return point.x.detach(), log_w, log_q
+
+        if cfg.training.get("buffer_pin_memory", False):
+            # Keep the buffer in pinned host memory, with batches prefetched to the flow device.
+            buffer = PinnedPrioritisedReplayBuffer(
+                dim=dim, max_length=cfg.training.maximum_buffer_length,
+                min_sample_length=cfg.training.min_buffer_length,
+                initial_sampler=initial_sampler,
+                transfer_device=str(next(fab_model.flow.parameters()).device),
+                fill_buffer_during_init=auto_fill_buffer,
+                x_dtype=x_dtype, log_w_dtype=log_w_dtype)
+        else:
+            buffer = PrioritisedReplayBuffer(dim=dim, max_length=cfg.training.maximum_buffer_length,
+                                             min_sample_length=cfg.training.min_buffer_length,
+                                             initial_sampler=initial_sampler,
+                                             fill_buffer_during_init=auto_fill_buffer,
+                                             x_dtype=x_dtype, log_w_dtype=log_w_dtype)
     return buffer
 
 def get_load_checkpoint_dir(outer_checkpoint_dir):
@@ -190,6 +226,7 @@ def setup_model(cfg: DictConfig, target: TargetDistribution) -> FABModel:
             n_outer=1,
             epsilon=cfg.fab.transition_operator.init_step_size,
             L=cfg.fab.transition_operator.n_inner_steps,
+            integrator=cfg.fab.transition_operator.get("integrator", "leapfrog"),
             )
 
     elif cfg.fab.transition_operator.type == "metropolis":
@@ -204,7 +241,32 @@ def setup_model(cfg: DictConfig, target: TargetDistribution) -> FABModel:
             adjust_step_size=cfg.fab.transition_operator.tune_step_size,
             target_p_accept=cfg.fab.transition_operator.target_p_accept,
             min_step_size=cfg.fab.transition_operator.init_step_size,
-            max_step_size=cfg.fab.transition_operator.init_step_size
+            max_step_size=cfg.fab.transition_operator.init_step_size,
+            delayed_acceptance=cfg.fab.transition_operator.get("delayed_acceptance", False),
+        )
+    elif cfg.fab.transition_operator.type == "mala":
+        transition_operator = MetropolisAdjustedLangevin(
+            n_ais_intermediate_distributions=cfg.fab.n_intermediate_distributions,
+            dim=dim,
+            base_log_prob=flow.log_prob,
+            target_log_prob=target.log_prob,
+            p_target=p_target,
+            alpha=cfg.fab.alpha,
+            n_updates=cfg.fab.transition_operator.n_inner_steps,
+            step_size=cfg.fab.transition_operator.init_step_size,
+        )
+    elif cfg.fab.transition_operator.type == "mtm":
+        # Gradient-free, so may be used for targets that are not differentiable.
+        transition_operator = MultipleTryMetropolis(
+            n_ais_intermediate_distributions=cfg.fab.n_intermediate_distributions,
+            dim=dim,
+            base_log_prob=flow.log_prob,
+            target_log_prob=target.log_prob,
+            p_target=p_target,
+            alpha=cfg.fab.alpha,
+            n_updates=cfg.fab.transition_operator.n_inner_steps,
+            n_tries=cfg.fab.transition_operator.get("n_tries", 4),
+            step_size=cfg.fab.transition_operator.init_step_size,
         )
     else:
         raise NotImplementedError
@@ -264,6 +326,8 @@ def setup_trainer_and_run_flow(cfg: DictConfig, setup_plotter: SetupPlotterFn,
         transition_operator_type=cfg.fab.transition_operator.type,
         use_buffer=cfg.training.use_buffer,
         min_buffer_length=cfg.training.min_buffer_length,
+        n_transition_operator_tries=cfg.fab.transition_operator.get("n_tries", 4),
+        hmc_integrator=cfg.fab.transition_operator.get("integrator", "leapfrog"),
     )
     print(f"running for {n_iterations}")
     cfg.training.n_iterations = n_iterations
@@ -311,6 +375,22 @@ def setup_trainer_and_run_flow(cfg: DictConfig, setup_plotter: SetupPlotterFn,
                                 clip_ais_weights_frac=cfg.training.log_w_clip_frac,
                                 max_gradient_norm=cfg.training.max_grad_norm
                                 )
+    elif cfg.training.get("n_async_actors", 0) > 0:
+        # AIS runs in background actor threads, concurrently with the gradient steps.
+        trainer = AsyncPrioritisedBufferTrainer(
+            model=fab_model,
+            optimizer=optimizer,
+            logger=logger,
+            plot=plot,
+            optim_schedular=scheduler,
+            save_path=save_path,
+            buffer=buffer,
+            n_batches_buffer_sampling=cfg.training.n_batches_buffer_sampling,
+            max_gradient_norm=cfg.training.max_grad_norm,
+            w_adjust_max_clip=cfg.training.w_adjust_max_clip,
+            alpha=cfg.fab.alpha,
+            n_actors=cfg.training.n_async_actors,
+            )
     else:
         trainer = PrioritisedBufferTrainer(
             model=fab_model,
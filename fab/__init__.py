@@ -4,7 +4,9 @@ from .core import FABModel
 from .train import Trainer
 from .train_with_buffer import BufferTrainer
 from .train_with_prioritised_buffer import PrioritisedBufferTrainer
-from .sampling_methods import AnnealedImportanceSampler, HamiltonianMonteCarlo, Metropolis
+from .train_with_async_actors import AsyncPrioritisedBufferTrainer
+from .sampling_methods import AnnealedImportanceSampler, HamiltonianMonteCarlo, Metropolis, \
+    MetropolisAdjustedLangevin, MultipleTryMetropolis
 from .types_ import Model, Distribution
 
 __version__ = '0.1'
\ No newline at end of file
@@ -5,9 +5,10 @@ import warnings
 
 from fab.types_ import Model
 from fab.target_distributions.base import TargetDistribution
-from fab.sampling_methods import AnnealedImportanceSampler, TransitionOperator, Point
+from fab.sampling_methods import AnnealedImportanceSampler, ParallelAnnealedImportanceSampler, \
+    SequentialMonteCarlo, ParallelTempering, TransitionOperator, Point
 from fab.trainable_distributions import TrainableDistribution
-from fab.utils.numerical import effective_sample_size
+from fab.utils.numerical import effective_sample_size, ImportanceWeightAccumulator
 
 
 ALPHA_DIV_TARGET_LOSSES = ["fab_alpha_div"]
@@ -27,6 +28,9 @@ class FABModel(Model):
                  ais_distribution_spacing: "str" = "linear",
                  loss_type: Optional["str"] = None,
                  use_ais: bool = True,
+                 smc_resampling_threshold: Optional[float] = None,
+                 ais_prune_log_w_margin: Optional[float] = None,
+                 parallel_tempering_n_sweeps: Optional[int] = None,
                  ):
         """
         Args:
@@ -35,12 +39,20 @@ class FABModel(Model):
             n_intermediate_distributions: Number of intermediate AIS distributions.
             alpha: Value of alpha if using fab_alpha_div loss.
             transition_operator: Transition operator for AIS.
-            ais_distribution_spacing: AIS spacing type "geometric" or "linear"
+            ais_distribution_spacing: AIS spacing type "geometric", "linear" or "adaptive"
             loss_type: Loss type for training. May be set to None if `self.loss` is not used.
                 E.g. for training with the prioritised buffer.
             use_ais: Whether or not to use AIS. For losses that do not rely on AIS, this may still
                 be set to True if we wish to use AIS in evaluation, which is why it is set to True
                 by default.
+            smc_resampling_threshold: If not None, then Sequential Monte Carlo is used instead of
+                AIS, resampling if the normalised ESS falls below this threshold.
+            ais_prune_log_w_margin: If not None, AIS chains with a log weight more than this margin
+                below the max log weight are frozen, which biases AIS for reduced compute (see
+                `AnnealedImportanceSampler`).
+            parallel_tempering_n_sweeps: If not None, then parallel tempering over the AIS
+                intermediate distributions is used instead of AIS, with this many sweeps per call
+                (see `ParallelTempering`).
         """
         assert loss_type in [None, "fab_ub_alpha_2_div",
                              "forward_kl", "flow_alpha_2_div",
@@ -57,20 +69,53 @@ class FABModel(Model):
         self.target_distribution = target_distribution
         self.n_intermediate_distributions = n_intermediate_distributions
         self.ais_distribution_spacing = ais_distribution_spacing
+        self.smc_resampling_threshold = smc_resampling_threshold
+        self.ais_prune_log_w_margin = ais_prune_log_w_margin
+        self.parallel_tempering_n_sweeps = parallel_tempering_n_sweeps
+        assert parallel_tempering_n_sweeps is None or smc_resampling_threshold is None
         assert len(flow.event_shape) == 1, "Currently only 1D distributions are supported"
         if use_ais or loss_type in LOSSES_USING_AIS:
             if transition_operator is None:
                 raise Exception("If using AIS, transition operator must be provided.")
             self.transition_operator = transition_operator
-            self.annealed_importance_sampler = AnnealedImportanceSampler(
+            self.annealed_importance_sampler = self.setup_annealed_importance_sampler()
+
+    def setup_annealed_importance_sampler(self) -> AnnealedImportanceSampler:
+        """Create the AIS (or SMC/ parallel tempering) sampler, initially targeting
+        p^\alpha q^(1-\alpha)."""
+        if self.parallel_tempering_n_sweeps is not None:
+            return ParallelTempering(
                 base_distribution=self.flow,
                 target_log_prob=self.target_distribution.log_prob,
                 transition_operator=self.transition_operator,
                 n_intermediate_distributions=self.n_intermediate_distributions,
                 distribution_spacing_type=self.ais_distribution_spacing,
                 p_target=False,
-                alpha=self.alpha
+                alpha=self.alpha,
+                n_sweeps=self.parallel_tempering_n_sweeps
             )
+        if self.smc_resampling_threshold is not None:
+            return SequentialMonteCarlo(
+                base_distribution=self.flow,
+                target_log_prob=self.target_distribution.log_prob,
+                transition_operator=self.transition_operator,
+                n_intermediate_distributions=self.n_intermediate_distributions,
+                distribution_spacing_type=self.ais_distribution_spacing,
+                p_target=False,
+                alpha=self.alpha,
+                prune_log_w_margin=self.ais_prune_log_w_margin,
+                resampling_threshold=self.smc_resampling_threshold
+            )
+        return AnnealedImportanceSampler(
+            base_distribution=self.flow,
+            target_log_prob=self.target_distribution.log_prob,
+            transition_operator=self.transition_operator,
+            n_intermediate_distributions=self.n_intermediate_distributions,
+            distribution_spacing_type=self.ais_distribution_spacing,
+            p_target=False,
+            alpha=self.alpha,
+            prune_log_w_margin=self.ais_prune_log_w_margin
+        )
 
     def parameters(self):
         return self.flow.parameters()
@@ -192,24 +237,42 @@ class FABModel(Model):
                       outer_batch_size: int,
                       inner_batch_size: int,
                       set_p_target: bool = True,
-                      ais_only: bool = False
+                      ais_only: bool = False,
+                      streaming: bool = False,
+                      n_processes: int = 1
                       ) -> Dict[str, Any]:
+        """Evaluate the flow and AIS over `outer_batch_size` samples, generated in batches of
+        `inner_batch_size`. If `streaming` is True, the metrics are computed online over the
+        batches, so that memory use does not grow with `outer_batch_size`. If `n_processes` > 1,
+        the batches are generated in parallel by a pool of CPU worker processes (see
+        `ParallelAnnealedImportanceSampler`), seeded from the torch RNG."""
         if hasattr(self, "annealed_importance_sampler"):
             if set_p_target:
                 self.set_ais_target(min_is_target=False)  # Evaluate with target=p.
-            base_samples, base_log_w, ais_samples, ais_log_w = \
-                self.annealed_importance_sampler.generate_eval_data(outer_batch_size,
-                                                                    inner_batch_size)
-            info = {"eval_ess_flow": effective_sample_size(log_w=base_log_w, normalised=False).item(),
-                    "eval_ess_ais": effective_sample_size(log_w=ais_log_w, normalised=False).item()}
+            if streaming:
+                assert n_processes == 1, "Streaming evaluation runs in a single process."
+                info = self.get_eval_info_streaming(outer_batch_size, inner_batch_size, ais_only)
+            else:
+                if n_processes > 1:
+                    # Draw the seed of the workers from the torch RNG, so that successive
+                    # evaluations use different (but reproducible) RNG streams.
+                    seed = int(torch.randint(2**31, ()).item())
+                    sampler = ParallelAnnealedImportanceSampler(self.annealed_importance_sampler,
+                                                                n_processes, seed=seed)
+                else:
+                    sampler = self.annealed_importance_sampler
+                base_samples, base_log_w, ais_samples, ais_log_w = \
+                    sampler.generate_eval_data(outer_batch_size, inner_batch_size)
+                info = {"eval_ess_flow": effective_sample_size(log_w=base_log_w, normalised=False).item(),
+                        "eval_ess_ais": effective_sample_size(log_w=ais_log_w, normalised=False).item()}
 
-            if not ais_only:
-                flow_info = self.target_distribution.performance_metrics(base_samples, base_log_w,
-                                                                         self.flow.log_prob,
-                                                                         batch_size=inner_batch_size)
-                info.update({"flow_" + key: val for key, val in flow_info.items()})
-            ais_info = self.target_distribution.performance_metrics(ais_samples, ais_log_w)
-            info.update({"ais_" + key: val for key, val in ais_info.items()})
+                if not ais_only:
+                    flow_info = self.target_distribution.performance_metrics(base_samples, base_log_w,
+                                                                             self.flow.log_prob,
+                                                                             batch_size=inner_batch_size)
+                    info.update({"flow_" + key: val for key, val in flow_info.items()})
+                ais_info = self.target_distribution.performance_metrics(ais_samples, ais_log_w)
+                info.update({"ais_" + key: val for key, val in ais_info.items()})
 
             # Back to target = p^\alpha & q^(1-\alpha).
             self.set_ais_target(min_is_target=True)
@@ -219,6 +282,34 @@ class FABModel(Model):
             # TODO
         return info
 
+    def get_eval_info_streaming(self,
+                                outer_batch_size: int,
+                                inner_batch_size: int,
+                                ais_only: bool = False) -> Dict[str, Any]:
+        """Compute the same info as `get_eval_info`, using online estimators over the batches
+        from `AnnealedImportanceSampler.generate_eval_data_stream`."""
+        flow_weights = ImportanceWeightAccumulator()
+        ais_weights = ImportanceWeightAccumulator()
+        if not ais_only:
+            flow_metrics = self.target_distribution.performance_metrics_accumulator(
+                self.flow.log_prob, batch_size=inner_batch_size)
+        ais_metrics = self.target_distribution.performance_metrics_accumulator()
+        for base_samples, base_log_w, ais_samples, ais_log_w in \
+                self.annealed_importance_sampler.generate_eval_data_stream(outer_batch_size,
+                                                                           inner_batch_size):
+            flow_weights.update(base_log_w)
+            ais_weights.update(ais_log_w)
+            if not ais_only:
+                flow_metrics.update(base_samples, base_log_w)
+            ais_metrics.update(ais_samples, ais_log_w)
+
+        info = {"eval_ess_flow": flow_weights.effective_sample_size.item(),
+                "eval_ess_ais": ais_weights.effective_sample_size.item()}
+        if not ais_only:
+            info.update({"flow_" + key: val for key, val in flow_metrics.result().items()})
+        info.update({"ais_" + key: val for key, val in ais_metrics.result().items()})
+        return info
+
     def save(self,
              path: "str"
              ):
@@ -250,11 +341,4 @@ class FABModel(Model):
             warnings.warn('Transition operator could not be loaded. '
                   'Perhaps there is a mismatch in the architectures.')
         if self.annealed_importance_sampler:
-            self.annealed_importance_sampler = AnnealedImportanceSampler(
-                base_distribution=self.flow,
-                target_log_prob=self.target_distribution.log_prob,
-                transition_operator=self.transition_operator,
-                p_target=False,
-                alpha=self.alpha,
-                n_intermediate_distributions=self.n_intermediate_distributions,
-                distribution_spacing_type=self.ais_distribution_spacing)
+            self.annealed_importance_sampler = self.setup_annealed_importance_sampler()
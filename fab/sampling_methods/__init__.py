@@ -1,4 +1,8 @@
 from fab.sampling_methods.ais import AnnealedImportanceSampler
+from fab.sampling_methods.parallel_ais import ParallelAnnealedImportanceSampler
+from fab.sampling_methods.smc import SequentialMonteCarlo
+from fab.sampling_methods.parallel_tempering import ParallelTempering
 from fab.sampling_methods.transition_operators import TransitionOperator, HamiltonianMonteCarlo, \
-    Metropolis
+    Metropolis, MetropolisAdjustedLangevin, NoUTurnSampler, LatentHamiltonianMonteCarlo, \
+    BlockMetropolis, MultipleTryMetropolis
 from fab.sampling_methods.base import create_point, Point
\ No newline at end of file
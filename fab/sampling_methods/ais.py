@@ -1,8 +1,9 @@
-from typing import Any, Dict, NamedTuple, Optional, Tuple
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Tuple
 
 import numpy as np
 import torch
-from fab.sampling_methods.base import Point, create_point, get_intermediate_log_prob
+from fab.sampling_methods.base import Point, create_point, get_intermediate_log_prob, \
+    AnnealingCoefficientTables, make_annealing_coefficient_tables, apply_coefficients
 from fab.sampling_methods.transition_operators.base import TransitionOperator
 from fab.types_ import Distribution, LogProbFunc
 from fab.utils.numerical import effective_sample_size
@@ -26,7 +27,44 @@ class AnnealedImportanceSampler:
         alpha: Optional[float] = None,
         n_intermediate_distributions: int = 1,
         distribution_spacing_type: str = "linear",
+        fixed_shape: bool = False,
+        adaptive_ess_target: float = 0.5,
+        adaptive_n_iterations: Optional[int] = None,
+        prune_log_w_margin: Optional[float] = None,
     ):
+        """
+        Args:
+            base_distribution: Distribution that AIS is initialised with (typically the flow).
+            target_log_prob: Log prob function of the target distribution.
+            transition_operator: MCMC transition operator used within AIS.
+            p_target: Whether the AIS target is p, or p^alpha q^(1-alpha).
+            alpha: Alpha for the minimum variance AIS target, required if p_target is False.
+            n_intermediate_distributions: Number of intermediate AIS distributions.
+            distribution_spacing_type: Spacing of beta, either "linear", "geometric" or
+                "adaptive". With "adaptive" spacing each beta is chosen during the AIS pass, by
+                bisection, such that the conditional ESS of the AIS weight increment is equal to
+                `adaptive_ess_target` (see `choose_next_beta`).
+            fixed_shape: If True, the batch size is kept fixed throughout AIS. Rather than removing
+                chains with NaN/inf log probs, they are masked (via `Point.mask`), frozen and
+                given a log weight of -inf. This avoids data-dependent shapes so that an AIS pass
+                may be compiled/ graph-captured as a whole.
+            adaptive_ess_target: Target conditional ESS (between 0 and 1) of each AIS weight
+                increment, for "adaptive" spacing.
+            adaptive_n_iterations: For "adaptive" spacing, if not None, then after this many calls
+                to `sample_and_log_weights` (with logging) the spacing is fixed to the average of
+                the adaptive schedules (see `fix_adaptive_distribution_spacing`).
+            prune_log_w_margin: If not None, then before each transition, chains with a log weight
+                more than this margin below the max log weight in the batch are pruned: they are
+                frozen for that transition, skipping their target/ flow evaluations. This
+                introduces a bias: whether a chain is frozen depends on its own weight (i.e. on
+                its path so far) and on the max weight across the batch, so the AIS weights are
+                no longer an unbiased estimate of Z, and the chains are no longer independent.
+                Chains are only pruned while they hold a small fraction (at most
+                N * exp(-prune_log_w_margin), for batch size N) of the total weight, and the bias
+                vanishes as the margin grows, but a pruned chain may later regain weight (in a
+                mode that it has not mixed into), so no bound on the bias is given. The margin
+                should be checked against an unpruned run, e.g. by comparing log Z.
+        """
         if not p_target:
             assert alpha is not None, "Must specify alpha if AIS target is not p."
         self.base_distribution = base_distribution
@@ -36,16 +74,42 @@ class AnnealedImportanceSampler:
         self.alpha = alpha
         self.n_intermediate_distributions = n_intermediate_distributions
         self.distribution_spacing_type = distribution_spacing_type
+        self.fixed_shape = fixed_shape
+        assert 0.0 < adaptive_ess_target < 1.0
+        self.adaptive_ess_target = adaptive_ess_target
+        self.adaptive_n_iterations = adaptive_n_iterations
+        self.adapt_distribution_spacing = distribution_spacing_type == "adaptive"
+        self._adaptive_B_space_history = []
+        assert not (fixed_shape and prune_log_w_margin is not None), \
+            "Pruning changes the batch size of transitions, so is not used in fixed shape mode."
+        self.prune_log_w_margin = prune_log_w_margin
+        self._n_pruned_transitions = 0
+        self._n_pruned_final = 0
+        self._pruning_info: Dict[str, float]
+        self._coefficient_tables_cache: Dict[Tuple, AnnealingCoefficientTables] = {}
+        self._coefficient_tables: Optional[AnnealingCoefficientTables] = None
         self.B_space = self.setup_distribution_spacing(
             distribution_spacing_type, n_intermediate_distributions
         )
         self._logging_info: LoggingInfo
 
+    @property
+    def B_space(self) -> torch.Tensor:
+        """Beta of each AIS distribution (float64, on the CPU)."""
+        return self._B_space
+
+    @B_space.setter
+    def B_space(self, B_space: torch.Tensor):
+        self._B_space = B_space
+        self._coefficient_tables_cache = {}
+
     def get_logging_info(self) -> Dict[str, Any]:
         """Return information saved during the last call to sample_and_log_weights (assuming
         logging was set to True)."""
         logging_info = self._logging_info._asdict()
         logging_info.update(self.transition_operator.get_logging_info())
+        if self.prune_log_w_margin is not None:
+            logging_info.update(self._pruning_info)
         return logging_info
 
     def sample_and_log_weights(
@@ -62,17 +126,20 @@ class AnnealedImportanceSampler:
             with_grad=self.transition_operator.uses_grad_info,
             log_q_x=log_prob_p0,
         )
-        log_w = (
-            get_intermediate_log_prob(point, self.B_space[1], self.alpha, self.p_target)
-            - log_prob_p0
-        )
+        if self.fixed_shape:
+            point = point.mask_invalid()
+        if self.adapt_distribution_spacing:
+            self.B_space = self.B_space.clone()
+            self.B_space[1] = self.choose_next_beta(point, torch.zeros_like(log_prob_p0), 0)
+        self.setup_coefficient_tables(point.log_q.device, point.log_q.dtype)
+        log_w = self.intermediate_log_prob(point, 1) - log_prob_p0
         point, log_w = self._remove_nan_and_infs(point, log_w, descriptor="chain init")
 
         # Save effective sample size over samples from base distribution if logging.
         if logging:
             with torch.no_grad():
                 log_w_base = point.log_p - point.log_q
-                ess_base = effective_sample_size(log_w_base).detach().cpu().item()
+                ess_base = self._effective_sample_size(log_w_base, point.mask).cpu().item()
 
         # Move through sequence of intermediate distributions via MCMC.
         for j in range(1, self.n_intermediate_distributions + 1):
@@ -83,18 +150,36 @@ class AnnealedImportanceSampler:
         # Save effective sample size if logging.
         if logging:
             with torch.no_grad():
-                ess_ais = effective_sample_size(log_w).cpu().item()
+                ess_ais = self._effective_sample_size(log_w, point.mask).cpu().item()
                 log_Z_N = torch.logsumexp(log_w, dim=0)
                 log_Z = log_Z_N - torch.log(torch.ones_like(log_Z_N) * batch_size)
                 self._logging_info = LoggingInfo(
                     ess_base=ess_base, ess_ais=ess_ais, log_Z=log_Z.cpu().item()
                 )
+                if self.prune_log_w_margin is not None:
+                    self._pruning_info = {
+                        "pruned_fraction": self._n_pruned_final / log_w.shape[0],
+                        "prune_compute_saved": self._n_pruned_transitions /
+                        (log_w.shape[0] * self.n_intermediate_distributions)}
+            if self.adapt_distribution_spacing:
+                self._adaptive_B_space_history.append(self.B_space)
+                if len(self._adaptive_B_space_history) == self.adaptive_n_iterations:
+                    self.fix_adaptive_distribution_spacing()
         return point, log_w.detach()
 
     def perform_transition(self, x_new: Point, log_w: torch.Tensor, j: int):
         """ " Transition via MCMC with the j'th intermediate distribution as the target."""
-        x_new = self.transition_operator.transition(x_new, j, self.B_space[j])
-        if self.B_space[j + 1] != self.B_space[j]:
+        if self.prune_log_w_margin is not None:
+            x_new = self._transition_unpruned_chains(x_new, log_w, j)
+        else:
+            x_new = self.transition_operator.transition(x_new, j, self.B_space[j])
+        if self.adapt_distribution_spacing:
+            self.B_space[j + 1] = self.choose_next_beta(x_new, log_w, j)
+        if self._coefficient_tables is not None:
+            if self._coefficient_tables.has_log_w_increment[j]:
+                log_w = apply_coefficients(self._coefficient_tables.log_w_increment[j],
+                                           x_new.log_q, x_new.log_p, initial_value=log_w)
+        elif self.B_space[j + 1] != self.B_space[j]:
             log_numerator = get_intermediate_log_prob(
                 x_new, self.B_space[j + 1], self.alpha, self.p_target
             )
@@ -107,8 +192,56 @@ class AnnealedImportanceSampler:
             # Commonly we may have a few transitions with beta=1 at the end of AIS, which does not
             # change the AIS weights.
             pass
+        if x_new.mask is not None:
+            # Invalid chains keep a log weight of -inf, rather than the NaN from (-inf) - (-inf).
+            log_w = torch.where(x_new.mask, log_w, torch.full_like(log_w, -float("inf")))
         return x_new, log_w
 
+    def setup_coefficient_tables(self, device: torch.device, dtype: torch.dtype
+                                 ) -> Optional[AnnealingCoefficientTables]:
+        """Get the per-stage coefficient tables of the intermediate distributions on the device of
+        the chain (cached for the current `B_space`, `p_target` and `alpha`), for use in the
+        AIS pass and by the transition operator. With "adaptive" spacing beta is only chosen
+        during the pass, so no tables are used."""
+        if self.adapt_distribution_spacing:
+            tables = None
+        else:
+            key = (self.p_target, self.alpha, device, dtype)
+            if key not in self._coefficient_tables_cache:
+                self._coefficient_tables_cache[key] = make_annealing_coefficient_tables(
+                    self.B_space, self.alpha, self.p_target, device, dtype)
+            tables = self._coefficient_tables_cache[key]
+        self._coefficient_tables = tables
+        # The transition operator may only use the tables if it has the same target.
+        same_target = self.transition_operator.p_target == self.p_target and \
+            (self.p_target or self.transition_operator.alpha == self.alpha)
+        self.transition_operator.set_coefficient_tables(tables if same_target else None)
+        return tables
+
+    def intermediate_log_prob(self, point: Point, j: int) -> torch.Tensor:
+        """Log prob of the j'th intermediate distribution."""
+        if self._coefficient_tables is not None:
+            with torch.no_grad():
+                return apply_coefficients(self._coefficient_tables.log_prob[j],
+                                          point.log_q, point.log_p)
+        return get_intermediate_log_prob(point, self.B_space[j], self.alpha, self.p_target)
+
+    def _transition_unpruned_chains(self, point: Point, log_w: torch.Tensor, j: int) -> Point:
+        """Only transition the chains with a log weight within `self.prune_log_w_margin` of the
+        max log weight, see `__init__`. Pruned chains are left unchanged."""
+        if j == 1:
+            self._n_pruned_transitions = 0
+        with torch.no_grad():
+            unpruned = log_w >= torch.max(log_w) - self.prune_log_w_margin
+        n_pruned = log_w.shape[0] - torch.sum(unpruned).item()
+        self._n_pruned_transitions += n_pruned
+        self._n_pruned_final = n_pruned
+        if n_pruned == 0:
+            return self.transition_operator.transition(point, j, self.B_space[j])
+        point[unpruned] = self.transition_operator.transition(point[unpruned], j,
+                                                              self.B_space[j])
+        return point
+
     def setup_distribution_spacing(
         self, distribution_spacing_type: str, n_intermediate_distributions: int
     ) -> torch.Tensor:
@@ -130,36 +263,89 @@ class AnnealedImportanceSampler:
             )
         elif distribution_spacing_type == "linear":
             B_space = np.linspace(0.0, 1.0, n_intermediate_distributions + 2)
+        elif distribution_spacing_type == "adaptive":
+            # Chosen during each AIS pass, initialise with beta=1 for all transitions.
+            B_space = np.ones(n_intermediate_distributions + 2)
+            B_space[0] = 0.0
         else:
             raise Exception(
                 f"distribution spacing incorrectly specified:"
                 f" '{distribution_spacing_type}',"
-                f"options are 'geometric' or 'linear'"
+                f"options are 'geometric', 'linear' or 'adaptive'"
             )
 
         assert B_space.shape == (self.n_intermediate_distributions + 2,)
         return torch.tensor(B_space)
 
-    def generate_eval_data(
+    def choose_next_beta(self, point: Point, log_w: torch.Tensor, j: int,
+                         n_bisection_steps: int = 30) -> float:
+        """For "adaptive" spacing, choose beta of the (j+1)'th distribution, such that the
+        conditional ESS of the weight increment from the j'th distribution is equal to
+        `self.adaptive_ess_target`, where the conditional ESS of increments w' given the current
+        normalised weights W is (sum_i W_i w'_i)^2 / sum_i W_i w'_i^2. Beta is found by bisection,
+        using the fact that the log weight increment is linear in the change in beta. The last
+        distribution always has beta=1."""
+        beta = float(self.B_space[j])
+        if j == self.n_intermediate_distributions or beta == 1.0:
+            return 1.0
+        with torch.no_grad():
+            # Log weight increment per unit change in beta.
+            log_w_increment_grad = (
+                get_intermediate_log_prob(point, 1.0, self.alpha, self.p_target)
+                - get_intermediate_log_prob(point, 0.0, self.alpha, self.p_target)
+            ).double()
+            valid = torch.isfinite(log_w_increment_grad) & torch.isfinite(log_w)
+            log_w_increment_grad = torch.where(valid, log_w_increment_grad,
+                                               torch.zeros_like(log_w_increment_grad))
+            log_W = torch.where(valid, log_w.double(), torch.full_like(log_w_increment_grad,
+                                                                        -float("inf")))
+            log_W = log_W - torch.logsumexp(log_W, dim=0)
+
+            def conditional_ess(delta_beta: float) -> float:
+                log_increment = delta_beta * log_w_increment_grad
+                return torch.exp(2 * torch.logsumexp(log_W + log_increment, dim=0)
+                                 - torch.logsumexp(log_W + 2 * log_increment, dim=0)).item()
+
+            lower, upper = 0.0, 1.0 - beta
+            if not conditional_ess(upper) < self.adaptive_ess_target:
+                return 1.0
+            for _ in range(n_bisection_steps):
+                middle = (lower + upper) / 2
+                if conditional_ess(middle) < self.adaptive_ess_target:
+                    upper = middle
+                else:
+                    lower = middle
+        return beta + lower
+
+    def fix_adaptive_distribution_spacing(self) -> torch.Tensor:
+        """Stop adapting the spacing of the distributions, and fix it to the average of the
+        schedules chosen during previous calls to `sample_and_log_weights` (with logging) with
+        "adaptive" spacing. This may be used to learn a fixed schedule for later iterations of
+        training."""
+        assert len(self._adaptive_B_space_history) > 0, "No adaptive schedules have been run."
+        self.B_space = torch.stack(self._adaptive_B_space_history).mean(dim=0)
+        self.B_space[-1] = 1.0
+        self.adapt_distribution_spacing = False
+        self._adaptive_B_space_history = []
+        return self.B_space
+
+    def generate_eval_data_stream(
         self, outer_batch_size: int, inner_batch_size: int
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Iterator[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
         """
-        Generates a big batch of data for evaluate, by running multiple steps forward passes of
-        AIS. This prevents the GPU getting overloaded.
+        Generates data for evaluation in chunks, by running multiple forward passes of AIS. This
+        allows very large evaluation sets to be processed in constant memory, e.g. with the
+        online estimators in `fab.utils.numerical`.
         Args:
             outer_batch_size: Total number of evaluation points generated.
             inner_batch_size: Batch size during each forward pass of ais.
 
-        Returns:
+        Yields:
             base_samples: Samples from the base (flow) distribution.
             base_log_w: Log importance weights for samples from the base distribution.
             ais_samples: Samples from AIS.
             ais_log_w: Log importance weights from AIS.
         """
-        base_samples = []
-        base_log_w_s = []
-        ais_samples = []
-        ais_log_w = []
         assert outer_batch_size % inner_batch_size == 0
         n_batches = outer_batch_size // inner_batch_size
         for i in range(n_batches):
@@ -174,21 +360,21 @@ class AnnealedImportanceSampler:
                 with_grad=self.transition_operator.uses_grad_info,
                 log_q_x=log_prob_p0,
             )
-            base_log_w = self.target_log_prob(x) - log_prob_p0
+            if self.fixed_shape:
+                point = point.mask_invalid()
+            base_log_w = point.log_p - log_prob_p0
             point, base_log_w = self._remove_nan_and_infs(
                 point, base_log_w, descriptor="chain init"
             )
+            base_x, base_log_w = self._drop_masked(point.x, base_log_w, point.mask)
+            # Clone, as transition operators may update the points of the chain in place.
+            base_x, base_log_w = base_x.detach().clone(), base_log_w.detach().clone()
 
-            # append base samples and log probs
-            base_samples.append(point.x.detach().cpu())
-            base_log_w_s.append(base_log_w.detach().cpu())
-
-            log_w = (
-                get_intermediate_log_prob(
-                    point, self.B_space[1], self.alpha, self.p_target
-                )
-                - point.log_q
-            )
+            if self.adapt_distribution_spacing:
+                self.B_space = self.B_space.clone()
+                self.B_space[1] = self.choose_next_beta(point, torch.zeros_like(base_log_w), 0)
+            self.setup_coefficient_tables(point.log_q.device, point.log_q.dtype)
+            log_w = self.intermediate_log_prob(point, 1) - point.log_q
             # Move through sequence of intermediate distributions via MCMC.
             for j in range(1, self.n_intermediate_distributions + 1):
                 point, log_w = self.perform_transition(point, log_w, j)
@@ -196,9 +382,37 @@ class AnnealedImportanceSampler:
             point, log_w = self._remove_nan_and_infs(
                 point, log_w, descriptor="chain end", raise_exception=False
             )
-            # append ais samples and log probs
-            ais_samples.append(point.x.detach().cpu())
-            ais_log_w.append(log_w.detach().cpu())
+            ais_x, log_w = self._drop_masked(point.x, log_w, point.mask)
+            yield base_x, base_log_w, ais_x.detach(), log_w.detach()
+
+    def generate_eval_data(
+        self, outer_batch_size: int, inner_batch_size: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Generates a big batch of data for evaluate, by running multiple steps forward passes of
+        AIS. This prevents the GPU getting overloaded. See `generate_eval_data_stream` for a
+        version that does not hold all of the data in memory.
+        Args:
+            outer_batch_size: Total number of evaluation points generated.
+            inner_batch_size: Batch size during each forward pass of ais.
+
+        Returns:
+            base_samples: Samples from the base (flow) distribution.
+            base_log_w: Log importance weights for samples from the base distribution.
+            ais_samples: Samples from AIS.
+            ais_log_w: Log importance weights from AIS.
+        """
+        base_samples = []
+        base_log_w_s = []
+        ais_samples = []
+        ais_log_w = []
+        for base_x, base_log_w, ais_x, log_w in self.generate_eval_data_stream(
+                outer_batch_size, inner_batch_size):
+            # append base and ais samples and log probs
+            base_samples.append(base_x.cpu())
+            base_log_w_s.append(base_log_w.cpu())
+            ais_samples.append(ais_x.cpu())
+            ais_log_w.append(log_w.cpu())
 
         base_samples = torch.cat(base_samples, dim=0)
         base_log_w_s = torch.cat(base_log_w_s, dim=0)
@@ -207,6 +421,24 @@ class AnnealedImportanceSampler:
 
         return base_samples, base_log_w_s, ais_samples, ais_log_w
 
+    @staticmethod
+    def _effective_sample_size(log_w: torch.Tensor, mask: Optional[torch.Tensor]) -> torch.Tensor:
+        """Effective sample size normalised by the number of valid chains."""
+        if mask is None:
+            return effective_sample_size(log_w)
+        normalised_w = torch.softmax(log_w, dim=0)
+        return 1 / torch.sum(normalised_w ** 2) / torch.sum(mask)
+
+    @staticmethod
+    def _drop_masked(
+        x: torch.Tensor, log_w: torch.Tensor, mask: Optional[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Remove invalid chains from the output of a fixed-shape AIS pass. This is done once the
+        chain has finished, outside of the part of AIS that needs to have fixed shapes."""
+        if mask is None:
+            return x, log_w
+        return x[mask], log_w[mask]
+
     def _remove_nan_and_infs(
         self,
         point: Point,
@@ -217,7 +449,13 @@ class AnnealedImportanceSampler:
         """Remove any NaN points or log probs / log weights. During the chain initialisation the
         flow can generate Nan/Infs making this function necessary in the first step of AIS. Sometimes
         extreme points may be generated which have NaN probability under the target, which makes
-        this function necessary in the final step of AIS."""
+        this function necessary in the final step of AIS.
+
+        In fixed shape mode invalid points are instead masked, and given a log weight of -inf."""
+        if self.fixed_shape:
+            point = point.mask_invalid()
+            log_w = torch.where(point.mask, log_w, torch.full_like(log_w, -float("inf")))
+            return point, log_w
         # first remove samples that have inf/nan log w
         valid_indices = (
             ~torch.isinf(point.log_p)
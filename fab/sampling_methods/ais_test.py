@@ -4,13 +4,15 @@ import torch
 import numpy as np
 import matplotlib.pyplot as plt
 
-from fab.sampling_methods import AnnealedImportanceSampler, Metropolis, HamiltonianMonteCarlo
+from fab.sampling_methods import AnnealedImportanceSampler, Metropolis, HamiltonianMonteCarlo, \
+    ParallelAnnealedImportanceSampler, MetropolisAdjustedLangevin, NoUTurnSampler
 from fab.utils.logging import ListLogger
+from fab.utils.numerical import ImportanceWeightAccumulator, effective_sample_size
 from fab.target_distributions import TargetDistribution
 from fab.target_distributions.gmm import GMM
 from fab.wrappers.torch import WrappedTorchDist
 from fab.utils.plotting import plot_history
-from fab.sampling_methods.base import resample
+from fab.sampling_methods.base import resample, get_intermediate_log_prob, apply_coefficients
 
 
 def analytic_alpha_2_div(mean_q: torch.Tensor, mean_p: torch.Tensor) -> torch.Tensor:
@@ -114,6 +116,26 @@ def setup_ais(dim: int = 2,
                                          target_log_prob=target.log_prob,
                                          p_target=not p_sq_over_q_target,
                                          dim=dim)
+    elif transition_operator_type == "mala":
+        transition_operator = MetropolisAdjustedLangevin(
+            n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+            dim=dim,
+            base_log_prob=base_dist.log_prob,
+            target_log_prob=target.log_prob,
+            p_target=not p_sq_over_q_target,
+            n_updates=5,
+            step_size=0.5,
+        )
+    elif transition_operator_type == "nuts":
+        transition_operator = NoUTurnSampler(
+            n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+            dim=dim,
+            base_log_prob=base_dist.log_prob,
+            target_log_prob=target.log_prob,
+            p_target=not p_sq_over_q_target,
+            epsilon=0.5,
+            max_tree_depth=4,
+        )
     else:
         raise NotImplementedError
     ais = AnnealedImportanceSampler(base_distribution=base_dist,
@@ -216,3 +238,178 @@ def test_ais__overall(dim: int = 2,
     plot_history(logger.history)
     plt.show()
 
+
+
+def test_ais__fixed_shape(
+        batch_size: int = 100,
+        dim: int = 2,
+        n_ais_intermediate_distributions: int = 4,
+        seed: int = 0,
+):
+    """Check that in fixed shape mode the batch size is unchanged throughout AIS, and that
+    invalid chains are frozen and given a log weight of -inf."""
+    for transition_operator_type in ["hmc", "metropolis", "mala", "nuts"]:
+        ais, _ = setup_ais(dim=dim, n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+                           seed=seed, transition_operator_type=transition_operator_type,
+                           spacing="linear")
+        ais.fixed_shape = True
+        point, log_w = ais.sample_and_log_weights(batch_size=batch_size)
+        assert point.x.shape == (batch_size, dim)
+        assert log_w.shape == (batch_size,)
+        assert point.mask.shape == (batch_size,)
+        assert torch.isfinite(log_w[point.mask]).all()
+        assert (log_w[~point.mask] == -float("inf")).all()
+        assert torch.isfinite(torch.tensor(list(ais.get_logging_info().values()))).all()
+
+        # Invalidate half of the chains, these should be frozen by the transition.
+        point.mask[:batch_size // 2] = False
+        x_before = point.x.clone()
+        point, log_w = ais.perform_transition(point, log_w, 1)
+        assert (point.x[:batch_size // 2] == x_before[:batch_size // 2]).all()
+        assert (log_w[:batch_size // 2] == -float("inf")).all()
+        assert point.x.shape == (batch_size, dim)
+
+
+def test_ais__eval_stream(
+        outer_batch_size: int = 200,
+        inner_batch_size: int = 50,
+        dim: int = 2,
+        n_ais_intermediate_distributions: int = 4,
+        seed: int = 0,
+):
+    """Check that the online estimators over `generate_eval_data_stream` match the estimates
+    over the concatenated eval data."""
+    ais, _ = setup_ais(dim=dim, n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+                       seed=seed)
+    n_chunks = 0
+    accumulator = ImportanceWeightAccumulator()
+    ais_log_w_s = []
+    for base_x, base_log_w, ais_x, ais_log_w in ais.generate_eval_data_stream(outer_batch_size,
+                                                                               inner_batch_size):
+        assert base_x.shape == (inner_batch_size, dim)
+        assert ais_x.shape == (inner_batch_size, dim)
+        accumulator.update(ais_log_w)
+        ais_log_w_s.append(ais_log_w)
+        n_chunks += 1
+    assert n_chunks == outer_batch_size // inner_batch_size
+    ais_log_w = torch.cat(ais_log_w_s)
+    torch.testing.assert_close(accumulator.effective_sample_size,
+                               effective_sample_size(ais_log_w))
+    torch.testing.assert_close(accumulator.log_Z,
+                               torch.logsumexp(ais_log_w, dim=0) - np.log(outer_batch_size))
+
+
+def test_parallel_ais(
+        outer_batch_size: int = 200,
+        inner_batch_size: int = 50,
+        dim: int = 2,
+        n_ais_intermediate_distributions: int = 4,
+        seed: int = 0,
+):
+    """Check that the parallel AIS results have the right shape, and do not depend on the number
+    of worker processes."""
+    ais, _ = setup_ais(dim=dim, n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+                       seed=seed)
+    eval_data_s = []
+    for n_processes in [1, 3]:
+        parallel_ais = ParallelAnnealedImportanceSampler(ais, n_processes=n_processes, seed=seed)
+        eval_data = parallel_ais.generate_eval_data(outer_batch_size, inner_batch_size)
+        base_x, base_log_w, ais_x, ais_log_w = eval_data
+        assert base_x.shape == (outer_batch_size, dim)
+        assert ais_x.shape == (outer_batch_size, dim)
+        assert base_log_w.shape == (outer_batch_size,)
+        assert ais_log_w.shape == (outer_batch_size,)
+        eval_data_s.append(eval_data)
+    for data_1, data_3 in zip(*eval_data_s):
+        torch.testing.assert_close(data_1, data_3)
+
+    x, log_w, log_p = parallel_ais.sample(outer_batch_size - 10, inner_batch_size)
+    assert x.shape == (outer_batch_size - 10, dim)
+    assert log_w.shape == log_p.shape == (outer_batch_size - 10,)
+
+
+def test_ais__adaptive_spacing(
+        batch_size: int = 200,
+        dim: int = 2,
+        n_ais_intermediate_distributions: int = 8,
+        seed: int = 0,
+        adaptive_n_iterations: int = 3,
+):
+    """Check that the adaptive schedule is monotonic from 0 to 1, and that it is fixed to the
+    average of the adaptive schedules after `adaptive_n_iterations`."""
+    ais, _ = setup_ais(dim=dim, n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+                       seed=seed, spacing="adaptive")
+    B_spaces = []
+    for i in range(adaptive_n_iterations):
+        point, log_w = ais.sample_and_log_weights(batch_size=batch_size)
+        assert torch.isfinite(log_w).all()
+        B_spaces.append(ais.B_space)
+        assert ais.B_space[0] == 0.0 and ais.B_space[-1] == 1.0
+        assert (torch.diff(ais.B_space) >= 0).all()
+    ais.fix_adaptive_distribution_spacing()
+    assert not ais.adapt_distribution_spacing
+    torch.testing.assert_close(ais.B_space, torch.stack(B_spaces).mean(dim=0))
+    ais.sample_and_log_weights(batch_size=batch_size)
+
+    # The schedule is fixed automatically after `adaptive_n_iterations`.
+    ais, _ = setup_ais(dim=dim, n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+                       seed=seed, spacing="adaptive")
+    ais.adaptive_n_iterations = adaptive_n_iterations
+    for i in range(adaptive_n_iterations):
+        assert ais.adapt_distribution_spacing
+        ais.sample_and_log_weights(batch_size=batch_size)
+    assert not ais.adapt_distribution_spacing
+
+
+def test_ais__pruning(
+        batch_size: int = 200,
+        dim: int = 2,
+        n_ais_intermediate_distributions: int = 8,
+        seed: int = 0,
+):
+    """Check that with a small margin chains are pruned (and left unchanged by the transition), and
+    that the pruning stats are logged."""
+    for transition_operator_type in ["hmc", "metropolis"]:
+        ais, _ = setup_ais(dim=dim, n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+                           seed=seed, transition_operator_type=transition_operator_type)
+        ais.prune_log_w_margin = 1.0
+        point, log_w = ais.sample_and_log_weights(batch_size=batch_size)
+        assert point.x.shape == (batch_size, dim)
+        assert torch.isfinite(log_w).all()
+        info = ais.get_logging_info()
+        assert 0 < info["prune_compute_saved"] < 1
+        assert 0 <= info["pruned_fraction"] < 1
+
+        pruned = log_w < torch.max(log_w) - ais.prune_log_w_margin
+        x_before = point.x.clone()
+        point, _ = ais.perform_transition(point, log_w, 1)
+        assert (point.x[pruned] == x_before[pruned]).all()
+
+
+def test_ais__coefficient_tables(
+        batch_size: int = 100,
+        dim: int = 2,
+        n_ais_intermediate_distributions: int = 6,
+        seed: int = 0,
+):
+    """Check that the intermediate log probs and weight increments from the coefficient tables
+    match those computed from beta."""
+    ais, _ = setup_ais(dim=dim, n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+                       seed=seed, spacing="geometric")
+    ais.alpha = 2.
+    for p_target in [True, False]:
+        ais.p_target = p_target
+        x, log_q = ais.base_distribution.sample_and_log_prob((batch_size,))
+        point = ais.transition_operator.create_new_point(x)
+        tables = ais.setup_coefficient_tables(point.log_q.device, point.log_q.dtype)
+        for j in range(n_ais_intermediate_distributions + 2):
+            torch.testing.assert_close(
+                ais.intermediate_log_prob(point, j),
+                get_intermediate_log_prob(point, ais.B_space[j], ais.alpha, p_target))
+        for j in range(n_ais_intermediate_distributions + 1):
+            log_w_increment = \
+                get_intermediate_log_prob(point, ais.B_space[j + 1], ais.alpha, p_target) - \
+                get_intermediate_log_prob(point, ais.B_space[j], ais.alpha, p_target)
+            torch.testing.assert_close(
+                apply_coefficients(tables.log_w_increment[j], point.log_q, point.log_p),
+                log_w_increment, rtol=1e-4, atol=1e-4)
@@ -1,4 +1,4 @@
-from typing import Tuple, Optional, Union
+from typing import Callable, List, NamedTuple, Tuple, Optional, Union
 import torch
 
 from fab.types_ import LogProbFunc
@@ -6,18 +6,24 @@ from fab.types_ import LogProbFunc
 
 class Point:
     """Keeps important info on points in the AIS chain. Saves us having to re-evaluate the target
-    and base log prob/ score functions."""
+    and base log prob/ score functions.
+
+    If `mask` is set, the point is part of a fixed-shape (masked) AIS chain, where `mask` marks
+    which chains are still valid. Invalid chains are kept in the batch but frozen, rather than
+    being removed, so that the batch size never changes."""
     def __init__(self,
         x: torch.Tensor,
         log_q: torch.Tensor,
         log_p: torch.Tensor,
         grad_log_q: Optional[torch.Tensor] = None,
-        grad_log_p: Optional[torch.Tensor] = None):
+        grad_log_p: Optional[torch.Tensor] = None,
+        mask: Optional[torch.Tensor] = None):
         self.x = x
         self.log_q = log_q
         self.log_p = log_p
         self.grad_log_q = grad_log_q
         self.grad_log_p = grad_log_p
+        self.mask = mask
 
     @property
     def device(self):
@@ -29,14 +35,16 @@ class Point:
         self.log_p = self.log_p.to(device)
         self.grad_log_q = self.grad_log_q.to(device) if self.grad_log_q is not None else None
         self.grad_log_p = self.grad_log_p.to(device) if self.grad_log_p is not None else None
+        self.mask = self.mask.to(device) if self.mask is not None else None
 
     def __getitem__(self, indices):
         log_p = self.log_p[indices]
         grad_log_q = self.grad_log_q[indices] if self.grad_log_q is not None else None
         grad_log_p = self.grad_log_p[indices] if self.grad_log_p is not None else None
+        mask = self.mask[indices] if self.mask is not None else None
         return Point(self.x[indices],
                      self.log_q[indices],
-                     log_p, grad_log_q, grad_log_p)
+                     log_p, grad_log_q, grad_log_p, mask)
 
     def __setitem__(self, indices, values):
         self.x[indices] = values.x
@@ -46,6 +54,43 @@ class Point:
             self.grad_log_q[indices] = values.grad_log_q
             self.grad_log_p[indices] = values.grad_log_p
 
+    def where(self, condition: torch.Tensor, other: "Point") -> "Point":
+        """Return a new point that takes the values of `self` where `condition` is True, and the
+        values of `other` elsewhere. Unlike `__setitem__` with a boolean mask, this keeps all
+        shapes fixed, so it may be used inside compiled/ graph-captured code."""
+        grad_log_q = torch.where(condition[:, None], self.grad_log_q, other.grad_log_q) \
+            if self.grad_log_q is not None else None
+        grad_log_p = torch.where(condition[:, None], self.grad_log_p, other.grad_log_p) \
+            if self.grad_log_p is not None else None
+        return Point(x=torch.where(condition[:, None], self.x, other.x),
+                     log_q=torch.where(condition, self.log_q, other.log_q),
+                     log_p=torch.where(condition, self.log_p, other.log_p),
+                     grad_log_q=grad_log_q,
+                     grad_log_p=grad_log_p,
+                     mask=other.mask)
+
+    def mask_invalid(self) -> "Point":
+        """Update `mask` to exclude chains with non-finite log probs, and overwrite the values of
+        invalid chains with finite placeholders so that they do not propagate NaNs through the
+        batch. Invalid chains have log_q = log_p = -inf."""
+        valid = torch.isfinite(self.log_q) & torch.isfinite(self.log_p) & \
+            torch.isfinite(self.x).all(dim=-1)
+        if self.mask is not None:
+            valid = valid & self.mask
+        neg_inf = torch.full_like(self.log_q, -float("inf"))
+        grad_log_q = torch.where(valid[:, None], self.grad_log_q,
+                                 torch.zeros_like(self.grad_log_q)) \
+            if self.grad_log_q is not None else None
+        grad_log_p = torch.where(valid[:, None], self.grad_log_p,
+                                 torch.zeros_like(self.grad_log_p)) \
+            if self.grad_log_p is not None else None
+        return Point(x=torch.where(valid[:, None], self.x, torch.zeros_like(self.x)),
+                     log_q=torch.where(valid, self.log_q, neg_inf),
+                     log_p=torch.where(valid, self.log_p, neg_inf),
+                     grad_log_q=grad_log_q,
+                     grad_log_p=grad_log_p,
+                     mask=valid)
+
 
 def grad_and_value(x, forward_fn):
     """Calculate the forward pass of a function y = f(x) as well as its gradient w.r.t x."""
@@ -56,22 +101,100 @@ def grad_and_value(x, forward_fn):
     return grad.detach(), y.detach()
 
 
+def get_log_prob_and_grad_fn(log_prob_fn: LogProbFunc
+                             ) -> Optional[Callable[[torch.Tensor],
+                                                    Tuple[torch.Tensor, torch.Tensor]]]:
+    """If `log_prob_fn` is the `log_prob` method of a distribution with a closed form gradient
+    (see `TargetDistribution.log_prob_and_grad`), return its `log_prob_and_grad` method, otherwise
+    return None."""
+    owner = getattr(log_prob_fn, "__self__", None)
+    if getattr(log_prob_fn, "__name__", None) == "log_prob" and \
+            getattr(owner, "has_analytic_grad", False):
+        return owner.log_prob_and_grad
+    return None
+
+
+def grad_and_value_fused(x: torch.Tensor, log_q_fn: LogProbFunc, log_p_fn: LogProbFunc) -> \
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Calculate log_q(x), log_p(x) and their gradients w.r.t x with a single backward pass.
+
+    Each term gets its own leaf copy of x, so both forward passes can be run before a single
+    call to `torch.autograd.grad` over the summed outputs, which returns the per-term gradients
+    separately. As the graph is only traversed once, it does not need to be retained.
+
+    If either function has a closed form gradient (see `get_log_prob_and_grad_fn`), then it is
+    evaluated without building an autograd graph.
+
+    Returns:
+        grad_log_q, log_q, grad_log_p, log_p
+    """
+    log_q_and_grad_fn = get_log_prob_and_grad_fn(log_q_fn)
+    log_p_and_grad_fn = get_log_prob_and_grad_fn(log_p_fn)
+    if log_q_and_grad_fn is not None or log_p_and_grad_fn is not None:
+        x = x.detach()
+        with torch.no_grad():
+            if log_q_and_grad_fn is not None:
+                log_q, grad_log_q = log_q_and_grad_fn(x)
+            if log_p_and_grad_fn is not None:
+                log_p, grad_log_p = log_p_and_grad_fn(x)
+        if log_q_and_grad_fn is None:
+            grad_log_q, log_q = grad_and_value(x, log_q_fn)
+        if log_p_and_grad_fn is None:
+            grad_log_p, log_p = grad_and_value(x, log_p_fn)
+        return grad_log_q, log_q, grad_log_p, log_p
+    with torch.enable_grad():
+        x_q = x.detach().requires_grad_(True)
+        x_p = x.detach().requires_grad_(True)
+        log_q = log_q_fn(x_q)
+        log_p = log_p_fn(x_p)
+        grad_log_q, grad_log_p = torch.autograd.grad(
+            (log_q, log_p), (x_q, x_p),
+            grad_outputs=(torch.ones_like(log_q), torch.ones_like(log_p)))
+    return grad_log_q.detach(), log_q.detach(), grad_log_p.detach(), log_p.detach()
+
+
 def create_point(x: torch.Tensor, log_q_fn: LogProbFunc, log_p_fn: LogProbFunc,
-                 with_grad: bool, log_q_x: Optional[torch.Tensor] = None) -> Point:
+                 with_grad: bool, log_q_x: Optional[torch.Tensor] = None,
+                 mask: Optional[torch.Tensor] = None) -> Point:
     """Create an instance of a `Point` which contains the necessary info on a point for MCMC.
     If this is at the start of an AIS chain, we may already have access to log_q_x, which may then
      be used rather than recalculating log_q_x using the log_q_fn. """
     x = x.detach()  # not backproping through x points in the chains.
     if with_grad:
-        grad_log_q, log_q = grad_and_value(x, log_q_fn)
-        grad_log_p, log_p = grad_and_value(x, log_p_fn)
-        return Point(x=x, log_p=log_p, log_q=log_q, grad_log_p=grad_log_p, grad_log_q=grad_log_q)
+        grad_log_q, log_q, grad_log_p, log_p = grad_and_value_fused(x, log_q_fn, log_p_fn)
+        return Point(x=x, log_p=log_p, log_q=log_q, grad_log_p=grad_log_p, grad_log_q=grad_log_q,
+                     mask=mask)
     else:
         # Use log_q_x if we already have it, otherwise calculate it.
         log_q_x = log_q_x if log_q_x is not None else log_q_fn(x)
-        return Point(x=x, log_q=log_q_x.detach(), log_p=log_p_fn(x).detach())
+        return Point(x=x, log_q=log_q_x.detach(), log_p=log_p_fn(x).detach(), mask=mask)
+
+
+
+def intermediate_log_prob_coefficients(beta: float,
+                                       alpha: Union[float, None],
+                                       p_target: bool) -> Tuple[float, float]:
+    """Coefficients (c_q, c_p) of the intermediate AIS log prob, c_q log_q + c_p log_p.
+    See `get_intermediate_log_prob`."""
+    if not p_target:
+        # Use minimum variance importance sampling distribution for alpha-divergence.
+        # AIS target: g = p^\alpha q^(1-\alpha)
+        return (1-beta) + beta*(1-alpha), beta*alpha
+    else:
+        # AIS target: g = p
+        return 1-beta, beta
 
 
+def grad_intermediate_log_prob_coefficients(beta: float,
+                                            alpha: Union[float, None],
+                                            p_target: bool) -> Tuple[float, float]:
+    """Coefficients (c_q, c_p) of the gradient of the intermediate AIS log prob,
+    c_q grad_log_q + c_p grad_log_p. See `get_grad_intermediate_log_prob`."""
+    if not p_target:
+        return (1-beta) + beta*(1-alpha), 2*beta
+    else:
+        return 1-beta, beta
+
 
 def get_intermediate_log_prob(x: Point,
                               beta: float,
@@ -88,13 +211,8 @@ def get_intermediate_log_prob(x: Point,
         assert alpha is not None, "Must specify alpha if AIS target is not p."
     with torch.no_grad():
         # No grad as we don't backprop through this.
-        if not p_target:
-            # Use minimum variance importance sampling distribution for alpha-divergence.
-            # AIS target: g = p^\alpha q^(1-\alpha)
-            return ((1-beta) + beta*(1-alpha)) * x.log_q + beta*alpha*x.log_p
-        else:
-            # AIS target: g = p
-            return (1-beta) * x.log_q + beta * x.log_p
+        c_q, c_p = intermediate_log_prob_coefficients(beta, alpha, p_target)
+        return c_q * x.log_q + c_p * x.log_p
 
 
 def get_grad_intermediate_log_prob(
@@ -112,15 +230,94 @@ def get_grad_intermediate_log_prob(
         assert alpha is not None, "Must specify alpha if AIS target is not p."
     with torch.no_grad():
         # No grad as we don't backprop through this.
-        if not p_target:
-            return ((1-beta) + beta*(1-alpha)) * x.grad_log_q + 2*beta*x.grad_log_p
-        else:
-            return (1-beta) * x.grad_log_q + beta * x.grad_log_p
+        c_q, c_p = grad_intermediate_log_prob_coefficients(beta, alpha, p_target)
+        return c_q * x.grad_log_q + c_p * x.grad_log_p
+
+
+class AnnealingCoefficientTables(NamedTuple):
+    """Per-stage coefficients (c_q, c_p) of log_q and log_p (or their gradients) for each of the
+    AIS distributions, kept on the device of the AIS chain. This avoids recomputing the
+    coefficients from beta at every step, and the resulting tiny kernels/ host-device transfers.
+    """
+    log_prob: torch.Tensor  # [n_distributions, 2]
+    grad_log_prob: torch.Tensor  # [n_distributions, 2]
+    log_w_increment: torch.Tensor  # [n_distributions - 1, 2], log_prob[j + 1] - log_prob[j]
+    has_log_w_increment: List[bool]  # Whether beta changes between distribution j and j + 1.
+
+
+def make_annealing_coefficient_tables(B_space: torch.Tensor,
+                                      alpha: Union[float, None],
+                                      p_target: bool,
+                                      device: torch.device,
+                                      dtype: torch.dtype) -> AnnealingCoefficientTables:
+    """Precompute the `AnnealingCoefficientTables` for the betas in `B_space` (in float64 on the
+    CPU), and move them to `device` in one transfer per table."""
+    if not p_target:
+        assert alpha is not None, "Must specify alpha if AIS target is not p."
+    B_space = B_space.to(torch.float64).cpu()
+    log_prob = torch.stack(intermediate_log_prob_coefficients(B_space, alpha, p_target), dim=-1)
+    grad_log_prob = torch.stack(
+        grad_intermediate_log_prob_coefficients(B_space, alpha, p_target), dim=-1)
+    log_w_increment = log_prob[1:] - log_prob[:-1]
+    return AnnealingCoefficientTables(
+        log_prob=log_prob.to(device=device, dtype=dtype),
+        grad_log_prob=grad_log_prob.to(device=device, dtype=dtype),
+        log_w_increment=log_w_increment.to(device=device, dtype=dtype),
+        has_log_w_increment=(B_space[1:] != B_space[:-1]).tolist()
+    )
+
+
+def apply_coefficients(coefficients: torch.Tensor, q_value: torch.Tensor, p_value: torch.Tensor,
+                       initial_value: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Compute initial_value + c_q * q_value + c_p * p_value with fused multiply-adds, where
+    `coefficients` is a row (c_q, c_p) of `AnnealingCoefficientTables`."""
+    if initial_value is None:
+        value = coefficients[0] * q_value
+    else:
+        value = torch.addcmul(initial_value, coefficients[0], q_value)
+    return torch.addcmul(value, coefficients[1], p_value)
+
+
+def multinomial_resampling_indices(log_w: torch.Tensor) -> torch.Tensor:
+    """Draw indices of resampled points i.i.d. from the categorical distribution given by the
+    log weights."""
+    return torch.distributions.Categorical(logits=log_w).sample((log_w.shape[0],))
+
+
+def stratified_resampling_indices(log_w: torch.Tensor) -> torch.Tensor:
+    """Draw indices of resampled points with stratified resampling, where a separate uniform
+    sample is drawn within each of the N strata [i/N, (i+1)/N)."""
+    n = log_w.shape[0]
+    u = (torch.arange(n, device=log_w.device) + torch.rand(n, device=log_w.device)) / n
+    return _inverse_cdf_indices(log_w, u)
+
+
+def systematic_resampling_indices(log_w: torch.Tensor) -> torch.Tensor:
+    """Draw indices of resampled points with systematic resampling, where a single uniform sample
+    is shared by all N strata [i/N, (i+1)/N)."""
+    n = log_w.shape[0]
+    u = (torch.arange(n, device=log_w.device) + torch.rand(1, device=log_w.device)) / n
+    return _inverse_cdf_indices(log_w, u)
+
+
+def _inverse_cdf_indices(log_w: torch.Tensor, u: torch.Tensor) -> torch.Tensor:
+    """Map sorted uniform samples `u` to indices via the inverse CDF of the normalised weights."""
+    cdf = torch.cumsum(torch.softmax(log_w.to(torch.float64), dim=0), dim=0)
+    indices = torch.searchsorted(cdf, u.to(torch.float64), right=True)
+    # Guard against the last value of the CDF being slightly below 1 due to rounding.
+    return torch.clamp(indices, max=log_w.shape[0] - 1)
+
+
+RESAMPLING_METHODS = {"multinomial": multinomial_resampling_indices,
+                      "stratified": stratified_resampling_indices,
+                      "systematic": systematic_resampling_indices}
 
 
-def resample(x_or_point: Union[Point, torch.Tensor], log_w: torch.Tensor) -> Point:
-    """Resample points according to the log weights."""
-    indices = torch.distributions.Categorical(logits=log_w).sample_n(log_w.shape[0])
+def resample(x_or_point: Union[Point, torch.Tensor], log_w: torch.Tensor,
+             method: str = "multinomial") -> Union[Point, torch.Tensor]:
+    """Resample points according to the log weights, using the resampling `method`
+    ("multinomial", "stratified" or "systematic")."""
+    indices = RESAMPLING_METHODS[method](log_w)
     return x_or_point[indices]
 
 
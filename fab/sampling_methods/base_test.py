@@ -5,8 +5,9 @@ from functools import partial
 
 from experiments.make_flow.make_normflow_model import make_wrapped_normflow_realnvp
 from fab.target_distributions.gmm import GMM
+from fab.wrappers.torch import WrappedTorchDist
 from fab.sampling_methods.base import Point, get_intermediate_log_prob,\
-    get_grad_intermediate_log_prob, create_point
+    get_grad_intermediate_log_prob, create_point, grad_and_value, get_log_prob_and_grad_fn
 
 
 def test_create_point():
@@ -22,5 +23,46 @@ def test_create_point():
                          )
     print(point)
 
+
+def test_create_point_fused_grad():
+    """Check that the fused evaluation in `create_point` matches separately computing the value
+    and gradient of the flow and target. The target has no closed form gradient, so that both
+    gradients are from the fused autograd call."""
+    dim = 2
+    batch_size = 10
+    flow = make_wrapped_normflow_realnvp(dim=dim)
+    target = WrappedTorchDist(torch.distributions.MultivariateNormal(
+        loc=torch.ones(dim), scale_tril=torch.eye(dim) * 2.0))
+    assert get_log_prob_and_grad_fn(target.log_prob) is None
+    x = torch.randn((batch_size, dim))
+    point = create_point(x=x,
+                         log_q_fn=flow.log_prob,
+                         log_p_fn=target.log_prob,
+                         with_grad=True
+                         )
+    grad_log_q, log_q = grad_and_value(x, flow.log_prob)
+    grad_log_p, log_p = grad_and_value(x, target.log_prob)
+    torch.testing.assert_close(point.log_q, log_q)
+    torch.testing.assert_close(point.log_p, log_p)
+    torch.testing.assert_close(point.grad_log_q, grad_log_q)
+    torch.testing.assert_close(point.grad_log_p, grad_log_p)
+
+
+def test_create_point_analytic_grad():
+    """Check that `create_point` uses the closed form gradient of targets that define one, and
+    that it matches autograd."""
+    dim = 2
+    batch_size = 10
+    target = GMM(dim, n_mixes=3, loc_scaling=1, use_gpu=False)
+    base = torch.distributions.MultivariateNormal(loc=torch.zeros(dim),
+                                                  scale_tril=torch.eye(dim))
+    assert get_log_prob_and_grad_fn(target.log_prob) is not None
+    assert get_log_prob_and_grad_fn(base.log_prob) is None
+    x = torch.randn((batch_size, dim))
+    point = create_point(x=x, log_q_fn=base.log_prob, log_p_fn=target.log_prob, with_grad=True)
+    grad_log_p, log_p = grad_and_value(x, target.log_prob)
+    torch.testing.assert_close(point.log_p, log_p)
+    torch.testing.assert_close(point.grad_log_p, grad_log_p)
+
 if __name__ == '__main__':
     test_create_point()
@@ -0,0 +1,144 @@
+from typing import Dict, List, Tuple
+import copy
+
+import torch
+import torch.multiprocessing as mp
+
+from fab.sampling_methods.ais import AnnealedImportanceSampler
+
+
+def _shared_zeros(*shape: int, dtype: torch.dtype = None) -> torch.Tensor:
+    return torch.zeros(shape, dtype=dtype).share_memory_()
+
+
+def _run_eval_shards(ais: AnnealedImportanceSampler, shards: List[int], seed: int,
+                     n_threads: int, inner_batch_size: int,
+                     outputs: Dict[str, torch.Tensor]) -> None:
+    """Worker for `ParallelAnnealedImportanceSampler.generate_eval_data`. Writes the result of
+    each shard directly into the shared memory `outputs`."""
+    torch.set_num_threads(n_threads)
+    for shard in shards:
+        torch.manual_seed(seed + shard)
+        shard_ais = copy.deepcopy(ais)
+        base_x, base_log_w, ais_x, ais_log_w = \
+            next(shard_ais.generate_eval_data_stream(inner_batch_size, inner_batch_size))
+        n_base, n_ais = base_x.shape[0], ais_x.shape[0]
+        outputs["base_x"][shard, :n_base] = base_x
+        outputs["base_log_w"][shard, :n_base] = base_log_w
+        outputs["ais_x"][shard, :n_ais] = ais_x
+        outputs["ais_log_w"][shard, :n_ais] = ais_log_w
+        outputs["n_valid"][shard] = torch.tensor([n_base, n_ais])
+
+
+def _run_sample_shards(ais: AnnealedImportanceSampler, shards: List[int], seed: int,
+                       n_threads: int, inner_batch_size: int,
+                       outputs: Dict[str, torch.Tensor]) -> None:
+    """Worker for `ParallelAnnealedImportanceSampler.sample`."""
+    torch.set_num_threads(n_threads)
+    for shard in shards:
+        torch.manual_seed(seed + shard)
+        shard_ais = copy.deepcopy(ais)
+        point, log_w = shard_ais.sample_and_log_weights(inner_batch_size, logging=False)
+        n_ais = point.x.shape[0]
+        outputs["x"][shard, :n_ais] = point.x.detach()
+        outputs["log_w"][shard, :n_ais] = log_w.detach()
+        outputs["log_p"][shard, :n_ais] = point.log_p.detach()
+        outputs["n_valid"][shard] = n_ais
+
+
+class ParallelAnnealedImportanceSampler:
+    """Runs many batches of AIS in parallel over a pool of CPU worker processes.
+
+    The outer batch is divided into shards of `inner_batch_size`, which are split between the
+    workers. Each worker holds its own copy of the AIS sampler (flow, target and transition
+    operator), and writes its results directly into shared memory tensors, so the samples are not
+    pickled on the way back. Each shard starts from a fresh copy of the sampler, and uses its own
+    RNG stream seeded with `seed + shard_index`, so results are reproducible, and do not depend on
+    the number of workers.
+
+    Any tuning of the transition operator that occurs within the shards is not copied back, so
+    typically the transition operator should be in eval mode. Only CPU sampling is supported.
+    """
+    def __init__(self,
+                 annealed_importance_sampler: AnnealedImportanceSampler,
+                 n_processes: int,
+                 n_threads_per_process: int = 1,
+                 seed: int = 0,
+                 start_method: str = "fork"):
+        """
+        Args:
+            annealed_importance_sampler: AIS sampler that is copied into each worker.
+            n_processes: Number of worker processes.
+            n_threads_per_process: Number of intra-op threads used by torch within each worker.
+            seed: Seed of the RNG stream of the first shard.
+            start_method: Multiprocessing start method. With "fork" the sampler is inherited by
+                the workers, with "spawn" it must be picklable.
+        """
+        assert n_processes > 0
+        self.annealed_importance_sampler = annealed_importance_sampler
+        self.n_processes = n_processes
+        self.n_threads_per_process = n_threads_per_process
+        self.seed = seed
+        self.start_method = start_method
+
+    def _run(self, worker, n_shards: int, inner_batch_size: int,
+             outputs: Dict[str, torch.Tensor]) -> None:
+        if self.start_method == "fork" and torch.cuda.is_available() and \
+                torch.cuda.is_initialized():
+            raise Exception("CUDA has been initialised, so worker processes cannot be forked. "
+                            "ParallelAnnealedImportanceSampler only supports CPU sampling.")
+        context = mp.get_context(self.start_method)
+        processes = []
+        for rank in range(min(self.n_processes, n_shards)):
+            shards = list(range(rank, n_shards, self.n_processes))
+            process = context.Process(
+                target=worker, args=(self.annealed_importance_sampler, shards, self.seed,
+                                     self.n_threads_per_process, inner_batch_size, outputs))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+        failed = [process.exitcode for process in processes if process.exitcode != 0]
+        if failed:
+            raise Exception(f"{len(failed)} AIS worker processes failed with exit codes {failed}")
+
+    def generate_eval_data(
+        self, outer_batch_size: int, inner_batch_size: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Parallel version of `AnnealedImportanceSampler.generate_eval_data`, with the same
+        arguments and returns."""
+        assert outer_batch_size % inner_batch_size == 0
+        n_shards = outer_batch_size // inner_batch_size
+        dim = self.annealed_importance_sampler.transition_operator.dim
+        dtype = torch.get_default_dtype()
+        outputs = {"base_x": _shared_zeros(n_shards, inner_batch_size, dim, dtype=dtype),
+                   "base_log_w": _shared_zeros(n_shards, inner_batch_size, dtype=dtype),
+                   "ais_x": _shared_zeros(n_shards, inner_batch_size, dim, dtype=dtype),
+                   "ais_log_w": _shared_zeros(n_shards, inner_batch_size, dtype=dtype),
+                   "n_valid": _shared_zeros(n_shards, 2, dtype=torch.long)}
+        self._run(_run_eval_shards, n_shards, inner_batch_size, outputs)
+
+        # Remove the unused rows from shards where invalid samples were dropped.
+        valid_rows = torch.arange(inner_batch_size)[None, :]
+        base_valid = valid_rows < outputs["n_valid"][:, 0:1]
+        ais_valid = valid_rows < outputs["n_valid"][:, 1:2]
+        return outputs["base_x"][base_valid], outputs["base_log_w"][base_valid], \
+            outputs["ais_x"][ais_valid], outputs["ais_log_w"][ais_valid]
+
+    def sample(self, n_samples: int, inner_batch_size: int
+               ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Generate (at most) `n_samples` samples with AIS, as well as their log weights and log
+        probabilities under the target. Fewer samples are returned if AIS generates invalid
+        samples (see `AnnealedImportanceSampler._remove_nan_and_infs`)."""
+        n_shards = -(-n_samples // inner_batch_size)  # round up
+        dim = self.annealed_importance_sampler.transition_operator.dim
+        dtype = torch.get_default_dtype()
+        outputs = {"x": _shared_zeros(n_shards, inner_batch_size, dim, dtype=dtype),
+                   "log_w": _shared_zeros(n_shards, inner_batch_size, dtype=dtype),
+                   "log_p": _shared_zeros(n_shards, inner_batch_size, dtype=dtype),
+                   "n_valid": _shared_zeros(n_shards, dtype=torch.long)}
+        self._run(_run_sample_shards, n_shards, inner_batch_size, outputs)
+
+        valid = torch.arange(inner_batch_size)[None, :] < outputs["n_valid"][:, None]
+        return outputs["x"][valid][:n_samples], outputs["log_w"][valid][:n_samples], \
+            outputs["log_p"][valid][:n_samples]
@@ -0,0 +1,225 @@
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+from fab.sampling_methods.ais import AnnealedImportanceSampler, LoggingInfo
+from fab.sampling_methods.base import Point, create_point, grad_and_value
+from fab.sampling_methods.transition_operators.base import TransitionOperator
+from fab.types_ import Distribution, LogProbFunc
+
+
+class ParallelTempering(AnnealedImportanceSampler):
+    """Runs replica exchange (parallel tempering) over the intermediate distributions of AIS.
+    Has the same interface as `AnnealedImportanceSampler`, so that it may be used in its place.
+
+    Rather than moving each chain through the intermediate distributions sequentially, a
+    population of `population_size` chains is kept at every intermediate distribution
+    j = 1, ..., N, and persists between calls to `sample_and_log_weights`. Each sweep applies the transition
+    operator at every level, followed by vectorised swap moves between adjacent levels (alternating
+    between even and odd pairs). The swap acceptance only uses the `log_q`/`log_p` cached in the
+    `Point`s, so swaps cost no target evaluations. Level 0 is q itself, so each sweep it is filled
+    with fresh samples from the base distribution, which lets new modes found by the flow enter
+    the population via swaps.
+
+    `batch_size` chains of the population at level N (beta_N) are returned (all of them if
+    `batch_size` is equal to the population size, otherwise a uniformly chosen subset), with
+    importance weights log_w = log pi_{N+1}(x) - log pi_N(x) for the final AIS target pi_{N+1}.
+    As the population is (approximately) distributed according to pi_N, these weights are only
+    correct up to a constant, so they may be used in self-normalised estimates (such as the FAB
+    loss) but not to estimate the normalisation constant, and `log_Z` is logged as NaN. Samples
+    returned by successive calls are correlated.
+
+    Evaluation (`generate_eval_data_stream`/ `generate_eval_data`) uses plain AIS, rather than
+    the population, so that it does not disturb the population, and so that the eval weights
+    are unbiased and may be used to estimate the normalisation constant.
+    """
+
+    def __init__(
+        self,
+        base_distribution: Distribution,
+        target_log_prob: LogProbFunc,
+        transition_operator: TransitionOperator,
+        p_target: bool,
+        alpha: Optional[float] = None,
+        n_intermediate_distributions: int = 1,
+        distribution_spacing_type: str = "linear",
+        n_sweeps: int = 1,
+        population_size: Optional[int] = None,
+    ):
+        """
+        Args:
+            n_sweeps: Number of sweeps (transitions at each level followed by swaps) per call to
+                `sample_and_log_weights`.
+            population_size: Number of chains at each level. Defaults to the batch size of the
+                first call to `sample_and_log_weights`.
+            For other args see `AnnealedImportanceSampler`.
+        """
+        assert n_sweeps > 0
+        assert population_size is None or population_size > 0
+        assert distribution_spacing_type != "adaptive", \
+            "Parallel tempering requires a fixed spacing of the distributions."
+        super(ParallelTempering, self).__init__(
+            base_distribution=base_distribution,
+            target_log_prob=target_log_prob,
+            transition_operator=transition_operator,
+            p_target=p_target,
+            alpha=alpha,
+            n_intermediate_distributions=n_intermediate_distributions,
+            distribution_spacing_type=distribution_spacing_type,
+        )
+        self.n_sweeps = n_sweeps
+        self.population_size = population_size
+        # Population of the levels 1, ..., N, stacked along the batch dimension.
+        self._population: Optional[Point] = None
+        self._n_sweeps_total = 0
+        # Running swap acceptance probability of each pair of adjacent levels (0, 1), (1, 2), ...
+        self._swap_accept: torch.Tensor = torch.zeros(n_intermediate_distributions)
+
+    def get_logging_info(self) -> Dict[str, Any]:
+        logging_info = super(ParallelTempering, self).get_logging_info()
+        swap_accept = self._swap_accept.cpu()
+        logging_info.update(swap_p_accept_mean=torch.mean(swap_accept).item(),
+                            swap_p_accept_base=swap_accept[0].item())
+        return logging_info
+
+    def reset_population(self):
+        """Discard the population, so that it is reinitialised with samples from the base
+        distribution at the next call to `sample_and_log_weights`."""
+        self._population = None
+
+    def sample_base(self, batch_size: int) -> Point:
+        """Sample a point from the base distribution."""
+        x, log_q = self.base_distribution.sample_and_log_prob((batch_size,))
+        return create_point(x, self.base_distribution.log_prob, self.target_log_prob,
+                            with_grad=self.transition_operator.uses_grad_info, log_q_x=log_q)
+
+    def _initial_population(self) -> Point:
+        """Initialise every level with samples from the base distribution, where invalid samples
+        are replaced by valid ones."""
+        point = self.sample_base(self.population_size * self.n_intermediate_distributions)
+        valid = torch.isfinite(point.log_q) & torch.isfinite(point.log_p) & \
+            torch.isfinite(point.x).all(dim=-1)
+        if not torch.any(valid):
+            raise Exception("No valid samples from the base distribution")
+        replacement = torch.multinomial(valid.float(), valid.shape[0], replacement=True)
+        return point[torch.where(valid, torch.arange(valid.shape[0], device=valid.device),
+                                 replacement)]
+
+    def _refresh_log_q(self, point: Point) -> Point:
+        """Re-evaluate log_q (which changes as the flow is trained) for the population. The
+        cached target log probs remain valid."""
+        if self.transition_operator.uses_grad_info:
+            point.grad_log_q, point.log_q = grad_and_value(point.x,
+                                                           self.base_distribution.log_prob)
+        else:
+            with torch.no_grad():
+                point.log_q = self.base_distribution.log_prob(point.x)
+        return point
+
+    def sample_and_log_weights(
+        self,
+        batch_size: int,
+        logging: bool = True,
+    ) -> Tuple[Point, torch.Tensor]:
+        n_levels = self.n_intermediate_distributions
+        if self.population_size is None:
+            self.population_size = batch_size
+        population_size = self.population_size
+        if self._population is None:
+            self._population = self._initial_population()
+        else:
+            self._population = self._refresh_log_q(self._population)
+        population = self._population
+        self.setup_coefficient_tables(population.log_q.device, population.log_q.dtype)
+        assert self._coefficient_tables is not None
+
+        swap_accept_sum = torch.zeros(n_levels, device=population.x.device)
+        n_swaps_tried = torch.zeros(n_levels, device=population.x.device)
+        for _ in range(self.n_sweeps):
+            for j in range(1, n_levels + 1):
+                level = slice((j - 1) * population_size, j * population_size)
+                population[level] = self.transition_operator.transition(
+                    population[level], j, self.B_space[j])
+            # Level 0 is filled with fresh samples from the base distribution.
+            population_with_base = self.sample_base(population_size)
+            population_with_base = self._concatenate(population_with_base, population)
+            population_with_base, swap_accept, tried = self._swap(
+                population_with_base, population_size, first_pair=self._n_sweeps_total % 2)
+            swap_accept_sum = swap_accept_sum + swap_accept
+            n_swaps_tried = n_swaps_tried + tried
+            population = population_with_base[population_size:]
+            self._n_sweeps_total += 1
+        self._population = population
+        self._swap_accept = torch.where(n_swaps_tried > 0,
+                                        swap_accept_sum / torch.clamp_min(n_swaps_tried, 1),
+                                        self._swap_accept.to(swap_accept_sum.device))
+
+        # Return chains of the population at the last level, weighted by the final distribution.
+        # Indexing clones them, as the population is updated in place during later calls.
+        if batch_size == population_size:
+            chains = torch.arange(batch_size)
+        elif batch_size < population_size:
+            chains = torch.randperm(population_size)[:batch_size]
+        else:
+            chains = torch.randint(population_size, (batch_size,))
+        point = population[(n_levels - 1) * population_size + chains.to(population.x.device)]
+        log_w = self.intermediate_log_prob(point, n_levels + 1) - \
+            self.intermediate_log_prob(point, n_levels)
+        point, log_w = self._remove_nan_and_infs(point, log_w, descriptor="chain end")
+        if logging:
+            with torch.no_grad():
+                log_w_base = population_with_base.log_p[:population_size] - \
+                    population_with_base.log_q[:population_size]
+                self._logging_info = LoggingInfo(
+                    ess_base=self._effective_sample_size(log_w_base, None).cpu().item(),
+                    ess_ais=self._effective_sample_size(log_w, None).cpu().item(),
+                    log_Z=float("nan"))
+        return point, log_w.detach()
+
+    @staticmethod
+    def _concatenate(point_a: Point, point_b: Point) -> Point:
+        """Concatenate two points along the batch dimension."""
+        def cat(a, b):
+            return torch.cat([a, b], dim=0) if a is not None else None
+        return Point(x=cat(point_a.x, point_b.x), log_q=cat(point_a.log_q, point_b.log_q),
+                     log_p=cat(point_a.log_p, point_b.log_p),
+                     grad_log_q=cat(point_a.grad_log_q, point_b.grad_log_q),
+                     grad_log_p=cat(point_a.grad_log_p, point_b.grad_log_p))
+
+    def _swap(self, population: Point, population_size: int, first_pair: int
+              ) -> Tuple[Point, torch.Tensor, torch.Tensor]:
+        """Propose to swap the states of levels (j, j + 1) for j = first_pair, first_pair + 2, ...
+        in one vectorised step, using the cached log probs. `population` contains the levels
+        0, ..., N stacked along the batch dimension. Returns the population, the swap acceptance
+        probability of each pair of levels (zero for pairs that were not tried), and which pairs
+        were tried."""
+        n_levels = self.n_intermediate_distributions + 1
+        coefficients = self._coefficient_tables.log_prob[:n_levels]  # [n_levels, 2]
+        log_q = population.log_q.view(n_levels, population_size)
+        log_p = population.log_p.view(n_levels, population_size)
+        lower = torch.arange(first_pair, n_levels - 1, 2, device=log_q.device)
+        upper = lower + 1
+
+        def log_prob(levels, states):
+            """Log prob of the states of `states` under the distributions of `levels`."""
+            return coefficients[levels, 0, None] * log_q[states] + \
+                coefficients[levels, 1, None] * log_p[states]
+
+        with torch.no_grad():
+            log_acceptance_prob = log_prob(lower, upper) + log_prob(upper, lower) - \
+                log_prob(lower, lower) - log_prob(upper, upper)
+            log_acceptance_prob = torch.nan_to_num(log_acceptance_prob, nan=-float("inf"))
+            accept = log_acceptance_prob > \
+                -torch.empty_like(log_acceptance_prob).exponential_()
+            chain = torch.arange(population_size, device=log_q.device)
+            index = torch.arange(n_levels * population_size, device=log_q.device)
+            lower_index = lower[:, None] * population_size + chain
+            upper_index = upper[:, None] * population_size + chain
+            index[lower_index] = torch.where(accept, upper_index, lower_index)
+            index[upper_index] = torch.where(accept, lower_index, upper_index)
+            swap_accept = torch.zeros(n_levels - 1, device=log_q.device)
+            swap_accept[lower] = torch.mean(torch.exp(torch.clamp_max(log_acceptance_prob, 0.0)),
+                                            dim=-1)
+            tried = torch.zeros(n_levels - 1, device=log_q.device)
+            tried[lower] = 1.0
+        return population[index], swap_accept, tried
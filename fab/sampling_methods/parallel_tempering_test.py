@@ -0,0 +1,63 @@
+import torch
+
+from fab.sampling_methods import ParallelTempering, HamiltonianMonteCarlo
+from fab.wrappers.torch import WrappedTorchDist
+
+
+def test_parallel_tempering(dim: int = 2,
+                            batch_size: int = 500,
+                            n_intermediate_distributions: int = 6,
+                            n_iterations: int = 20,
+                            seed: int = 0):
+    """Check that the population persists between calls, that swaps are accepted, and that the
+    self-normalised estimate of the target mean is accurate."""
+    torch.manual_seed(seed)
+    base_dist = WrappedTorchDist(torch.distributions.MultivariateNormal(
+        loc=torch.zeros(dim) + 1.0, scale_tril=torch.eye(dim)))
+    target = WrappedTorchDist(torch.distributions.MultivariateNormal(
+        loc=torch.zeros(dim) - 1.0, scale_tril=torch.eye(dim)))
+    transition_operator = HamiltonianMonteCarlo(
+        n_ais_intermediate_distributions=n_intermediate_distributions,
+        dim=dim,
+        base_log_prob=base_dist.log_prob,
+        target_log_prob=target.log_prob,
+        p_target=True,
+        n_outer=1,
+        epsilon=0.5,
+        L=5,
+    )
+    parallel_tempering = ParallelTempering(base_distribution=base_dist,
+                                           target_log_prob=target.log_prob,
+                                           transition_operator=transition_operator,
+                                           p_target=True,
+                                           n_intermediate_distributions=n_intermediate_distributions,
+                                           n_sweeps=2)
+    means = []
+    for i in range(n_iterations):
+        point, log_w = parallel_tempering.sample_and_log_weights(batch_size)
+        assert point.x.shape == (batch_size, dim)
+        assert torch.isfinite(log_w).all()
+        means.append(torch.sum(torch.softmax(log_w, dim=0)[:, None] * point.x, dim=0))
+    assert parallel_tempering._population.x.shape == (batch_size * n_intermediate_distributions,
+                                                      dim)
+    info = parallel_tempering.get_logging_info()
+    assert 0 < info["swap_p_accept_mean"] <= 1
+    assert 0 < info["swap_p_accept_base"] <= 1
+    mean = torch.stack(means[n_iterations // 2:]).mean(dim=0)
+    torch.testing.assert_close(mean, -torch.ones(dim), atol=0.2, rtol=0.0)
+
+    # A different batch size is drawn from the population, rather than reinitialising it.
+    population_x = parallel_tempering._population.x.clone()
+    point, log_w = parallel_tempering.sample_and_log_weights(batch_size // 2)
+    assert point.x.shape == (batch_size // 2, dim)
+    assert parallel_tempering._population.x.shape == population_x.shape
+
+    # Evaluation uses plain AIS, so it leaves the population unchanged, and the weights give an
+    # estimate of the normalisation constant (which is 1).
+    population_x = parallel_tempering._population.x.clone()
+    base_x, base_log_w, ais_x, ais_log_w = parallel_tempering.generate_eval_data(
+        outer_batch_size=batch_size * 2, inner_batch_size=batch_size)
+    assert ais_x.shape == (batch_size * 2, dim)
+    assert torch.equal(parallel_tempering._population.x, population_x)
+    log_Z = torch.logsumexp(ais_log_w, dim=0) - torch.log(torch.tensor(ais_log_w.shape[0]))
+    assert torch.abs(log_Z) < 0.2
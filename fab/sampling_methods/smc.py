@@ -0,0 +1,88 @@
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+from fab.sampling_methods.ais import AnnealedImportanceSampler
+from fab.sampling_methods.base import Point, RESAMPLING_METHODS
+from fab.sampling_methods.transition_operators.base import TransitionOperator
+from fab.types_ import Distribution, LogProbFunc
+
+
+class SequentialMonteCarlo(AnnealedImportanceSampler):
+    """Runs Sequential Monte Carlo (SMC), which is AIS with an additional resampling step before
+    each MCMC transition if the ESS falls below `resampling_threshold`. This moves chains with
+    negligible weight to where the probability mass is, so that the MCMC compute is not wasted.
+    Has the same interface as `AnnealedImportanceSampler`, so that it may be used in its place.
+
+    After resampling all chains are given the average weight of the chains before resampling,
+    so the mean of the returned weights is still an unbiased estimate of the normalisation
+    constant. However, the returned samples are no longer independent."""
+
+    def __init__(
+        self,
+        base_distribution: Distribution,
+        target_log_prob: LogProbFunc,
+        transition_operator: TransitionOperator,
+        p_target: bool,
+        alpha: Optional[float] = None,
+        n_intermediate_distributions: int = 1,
+        distribution_spacing_type: str = "linear",
+        fixed_shape: bool = False,
+        adaptive_ess_target: float = 0.5,
+        adaptive_n_iterations: Optional[int] = None,
+        prune_log_w_margin: Optional[float] = None,
+        resampling_threshold: float = 0.5,
+        resampling_method: str = "systematic",
+    ):
+        """
+        Args:
+            resampling_threshold: Resample if the normalised ESS falls below this threshold.
+            resampling_method: Either "multinomial", "stratified" or "systematic".
+            For other args see `AnnealedImportanceSampler`.
+        """
+        assert resampling_method in RESAMPLING_METHODS, \
+            f"resampling_method must be one of {list(RESAMPLING_METHODS.keys())}"
+        super(SequentialMonteCarlo, self).__init__(
+            base_distribution=base_distribution,
+            target_log_prob=target_log_prob,
+            transition_operator=transition_operator,
+            p_target=p_target,
+            alpha=alpha,
+            n_intermediate_distributions=n_intermediate_distributions,
+            distribution_spacing_type=distribution_spacing_type,
+            fixed_shape=fixed_shape,
+            adaptive_ess_target=adaptive_ess_target,
+            adaptive_n_iterations=adaptive_n_iterations,
+            prune_log_w_margin=prune_log_w_margin,
+        )
+        self.resampling_threshold = resampling_threshold
+        self.resampling_method = resampling_method
+        self._n_resampling_steps = 0
+
+    def get_logging_info(self) -> Dict[str, Any]:
+        logging_info = super(SequentialMonteCarlo, self).get_logging_info()
+        logging_info.update(n_resampling_steps=self._n_resampling_steps)
+        return logging_info
+
+    def perform_transition(self, x_new: Point, log_w: torch.Tensor, j: int):
+        """Resample if the ESS is below the threshold, and then transition via MCMC with the j'th
+        intermediate distribution as the target."""
+        if j == 1:
+            self._n_resampling_steps = 0
+        x_new, log_w = self.resample_if_below_threshold(x_new, log_w)
+        return super(SequentialMonteCarlo, self).perform_transition(x_new, log_w, j)
+
+    def resample_if_below_threshold(self, point: Point, log_w: torch.Tensor
+                                    ) -> Tuple[Point, torch.Tensor]:
+        with torch.no_grad():
+            ess = self._effective_sample_size(log_w, point.mask)
+        if ess < self.resampling_threshold:
+            indices = RESAMPLING_METHODS[self.resampling_method](log_w)
+            point = point[indices]
+            # Resampled chains are each given the average weight of the chains before resampling.
+            # Chains with a weight of zero (such as invalid chains) are never resampled.
+            log_w_mean = torch.logsumexp(log_w, dim=0) - np.log(log_w.shape[0])
+            log_w = torch.ones_like(log_w) * log_w_mean
+            self._n_resampling_steps += 1
+        return point, log_w
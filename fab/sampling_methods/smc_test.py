@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+
+from fab.sampling_methods import SequentialMonteCarlo, HamiltonianMonteCarlo
+from fab.sampling_methods.base import RESAMPLING_METHODS
+from fab.wrappers.torch import WrappedTorchDist
+
+
+def test_resampling_methods(n_points: int = 10000):
+    """Check that each resampling method gives indices with frequencies close to the weights, and
+    never selects zero weight points."""
+    torch.manual_seed(0)
+    log_w = torch.randn(n_points)
+    log_w[:100] = -float("inf")
+    for method, resampling_fn in RESAMPLING_METHODS.items():
+        indices = resampling_fn(log_w)
+        assert indices.shape == (n_points,)
+        assert (indices >= 100).all() and (indices < n_points).all()
+        # Test the mean of a function under the resampled distribution.
+        f = torch.linspace(0, 1, n_points)
+        expectation = torch.sum(torch.softmax(log_w, dim=0) * f)
+        assert torch.abs(torch.mean(f[indices]) - expectation) < 0.02, method
+
+
+def test_smc(dim: int = 2,
+             batch_size: int = 1000,
+             n_intermediate_distributions: int = 8,
+             seed: int = 0):
+    """Check that SMC resamples, and gives a good estimate of the normalisation constant (which
+    is 1 for the normalised target)."""
+    base_dist = WrappedTorchDist(torch.distributions.MultivariateNormal(
+        loc=torch.zeros(dim) + 1.0, scale_tril=torch.eye(dim)))
+    target = WrappedTorchDist(torch.distributions.MultivariateNormal(
+        loc=torch.zeros(dim) - 1.0, scale_tril=torch.eye(dim)))
+    for resampling_method in RESAMPLING_METHODS.keys():
+        # Reseed, so that each resampling method is tested independently of the others.
+        torch.manual_seed(seed)
+        transition_operator = HamiltonianMonteCarlo(
+            n_ais_intermediate_distributions=n_intermediate_distributions,
+            dim=dim,
+            base_log_prob=base_dist.log_prob,
+            target_log_prob=target.log_prob,
+            p_target=True,
+            n_outer=2,
+            epsilon=0.5,
+            L=5,
+        )
+        smc = SequentialMonteCarlo(base_distribution=base_dist,
+                                   target_log_prob=target.log_prob,
+                                   transition_operator=transition_operator,
+                                   p_target=True,
+                                   n_intermediate_distributions=n_intermediate_distributions,
+                                   resampling_threshold=0.9,
+                                   resampling_method=resampling_method)
+        point, log_w = smc.sample_and_log_weights(batch_size)
+        info = smc.get_logging_info()
+        assert info["n_resampling_steps"] > 0
+        assert point.x.shape == (batch_size, dim)
+        log_Z = torch.logsumexp(log_w, dim=0) - np.log(batch_size)
+        # The tolerance is a few standard errors of the (single run) log Z estimate.
+        assert torch.abs(log_Z) < 0.25, resampling_method
@@ -1,3 +1,8 @@
 from .hmc import HamiltonianMonteCarlo
 from .base import TransitionOperator
-from .metropolis import Metropolis
\ No newline at end of file
+from .metropolis import Metropolis
+from .mala import MetropolisAdjustedLangevin
+from .nuts import NoUTurnSampler
+from .latent_hmc import LatentHamiltonianMonteCarlo, LatentPoint
+from .block_metropolis import BlockMetropolis
+from .multiple_try_metropolis import MultipleTryMetropolis
\ No newline at end of file
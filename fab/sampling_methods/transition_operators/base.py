@@ -1,9 +1,10 @@
-from typing import Mapping, Any, Callable
+from typing import Mapping, Any, Callable, Optional
 import torch
 
 from fab.types_ import LogProbFunc
 from fab.sampling_methods.base import Point, get_intermediate_log_prob, \
-    get_grad_intermediate_log_prob, create_point
+    get_grad_intermediate_log_prob, create_point, AnnealingCoefficientTables, \
+    apply_coefficients, intermediate_log_prob_coefficients
 
 
 TransitionTargetLogProbFn = Callable[[Point], torch.Tensor]
@@ -25,26 +26,51 @@ class TransitionOperator(torch.nn.Module):
         self.n_ais_intermediate_distributions = n_ais_intermediate_distributions
         self.p_target = p_target
         super(TransitionOperator, self).__init__()
+        self.coefficient_tables: Optional[AnnealingCoefficientTables] = None
 
 
-    def create_new_point(self, x: torch.Tensor) -> Point:
+    def create_new_point(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> Point:
         """Create a new instance of a `Point` given an x (sample). See the `Point` definition
         for further details. """
         return create_point(x, self.base_log_prob, self.target_log_prob,
-                            with_grad=self.uses_grad_info)
-
-
-    def intermediate_target_log_prob(self, point: Point, beta: float) -> torch.Tensor:
+                            with_grad=self.uses_grad_info, mask=mask)
+
+
+    def set_coefficient_tables(self, coefficient_tables: Optional[AnnealingCoefficientTables]):
+        """Set the per-stage coefficient tables of the intermediate AIS distributions (set by the
+        AIS sampler), which are used when the intermediate target log prob (or its gradient) is
+        called with the AIS distribution number `i`."""
+        self.coefficient_tables = coefficient_tables
+
+    def get_coefficients(self, i: int, beta: float, device: torch.device, dtype: torch.dtype
+                         ) -> torch.Tensor:
+        """Coefficients (c_q, c_p) of the intermediate AIS distribution `i`."""
+        if self.coefficient_tables is not None:
+            return self.coefficient_tables.log_prob[i]
+        if not self.p_target:
+            assert self.alpha is not None, "Must specify alpha if AIS target is not p."
+        return torch.tensor(intermediate_log_prob_coefficients(beta, self.alpha, self.p_target),
+                            device=device, dtype=dtype)
+
+    def intermediate_target_log_prob(self, point: Point, beta: float,
+                                     i: Optional[int] = None) -> torch.Tensor:
         with torch.no_grad():
             # We do not backprop through MCMC/AIS. So do not include these gradients.
+            if i is not None and self.coefficient_tables is not None:
+                return apply_coefficients(self.coefficient_tables.log_prob[i],
+                                          point.log_q, point.log_p)
             return get_intermediate_log_prob(point, beta,
                                              alpha=self.alpha,
                                              p_target=self.p_target)
 
-    def grad_intermediate_target_log_prob(self, point: Point, beta: float) -> torch.Tensor:
+    def grad_intermediate_target_log_prob(self, point: Point, beta: float,
+                                          i: Optional[int] = None) -> torch.Tensor:
         with torch.no_grad():
             # We do not backprop through MCMC/AIS. So do not include second order grads through the
             # intermediate log prob grad.
+            if i is not None and self.coefficient_tables is not None:
+                return apply_coefficients(self.coefficient_tables.grad_log_prob[i],
+                                          point.grad_log_q, point.grad_log_p)
             return get_grad_intermediate_log_prob(
                 point,
                 beta,
@@ -71,7 +97,8 @@ class TransitionOperator(torch.nn.Module):
 
         Args:
             point: Input samples from previous AIS step. Also contains info on the log prob
-                of p & q, and if required their gradients.
+                of p & q, and if required their gradients. If `point.mask` is set, the
+                transition must keep the batch shape fixed, and leave invalid chains unchanged.
             i: Intermediate AIS distribution number.
             beta: Beta controlling interpolation between base and target log prob.
 
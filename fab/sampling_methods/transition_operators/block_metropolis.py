@@ -0,0 +1,133 @@
+from typing import Dict
+
+import torch
+
+from fab.sampling_methods.transition_operators.base import TransitionOperator
+from fab.sampling_methods.base import Point
+from fab.target_distributions.base import TargetDistribution
+from fab.types_ import LogProbFunc
+
+
+class BlockMetropolis(TransitionOperator):
+    def __init__(self,
+                 n_ais_intermediate_distributions: int,
+                 dim: int,
+                 base_log_prob: LogProbFunc,
+                 target: TargetDistribution,
+                 n_updates: int,
+                 alpha: float = None,
+                 p_target: bool = False,
+                 max_step_size: float = 1.0,
+                 min_step_size: float = 0.1,
+                 adjust_step_size: bool = True,
+                 target_p_accept: float = 0.65,
+                 eval_mode: bool = False):
+        """
+        Block-wise Metropolis for targets that factorise over blocks of dimensions (see
+        `TargetDistribution.block_indices`), such as `ManyWellEnergy`.
+
+        The intermediate AIS distribution is q^(c_q) p^(c_p), where only p factorises. Each update
+        is a two stage Metropolis-Hastings step:
+            1. A Gaussian random walk is proposed in every dimension, and each block is accepted
+                or rejected independently, with the ratio of its factor p_b(x_b)^(c_p). All blocks
+                are handled in one vectorised pass, with a single evaluation of the target.
+            2. As the proposal from the first stage is reversible w.r.t. p^(c_p), the combined
+                move is accepted with probability min(1, (q(x') / q(x))^(c_q)), which requires
+                a single flow evaluation.
+        When c_q = 0 (e.g. the final distribution with the target p) the second stage always
+        accepts, so one global accept/reject is replaced by one per block.
+        """
+        super(BlockMetropolis, self).__init__(n_ais_intermediate_distributions, dim,
+                                              base_log_prob, target.log_prob,
+                                              alpha=alpha, p_target=p_target)
+        block_indices = target.block_indices
+        assert block_indices is not None, "The target must define `block_indices`."
+        assert torch.equal(torch.sort(block_indices.flatten())[0], torch.arange(dim)), \
+            "Each dimension must be in exactly one block."
+        self.target_log_prob_blocks = target.log_prob_blocks
+        self.n_blocks = block_indices.shape[0]
+        dim_to_block = torch.empty(dim, dtype=torch.long)
+        dim_to_block[block_indices.flatten()] = torch.arange(self.n_blocks).repeat_interleave(
+            block_indices.shape[1])
+        self.register_buffer("dim_to_block", dim_to_block, persistent=False)
+        self.n_updates = n_updates
+        self.adjust_step_size = adjust_step_size
+        self.register_buffer("noise_scalings", torch.linspace(max_step_size, min_step_size,
+                                                              n_updates).repeat(
+            (n_ais_intermediate_distributions, 1)))
+        self.target_prob_accept = target_p_accept
+        self.eval_mode = eval_mode
+        self.first_dist_p_accept_blocks = torch.tensor(0.0)
+        self.first_dist_p_accept_flow = torch.tensor(0.0)
+
+    @property
+    def uses_grad_info(self) -> bool:
+        """Block Metropolis does not use info on grad of target."""
+        return False
+
+    def set_eval_mode(self, eval_setting: bool):
+        """When eval_mode is turned on, no tuning of the noise scaling occurs."""
+        self.eval_mode = eval_setting
+
+    def get_logging_info(self) -> Dict:
+        """Return the first and last noise scaling size, and the p_accept of each stage for the
+        first AIS distribution, for logging."""
+        interesting_dict = {}
+        interesting_dict["noise_scaling_0_0"] = self.noise_scalings[0, 0].cpu().item()
+        interesting_dict["noise_scaling_0_-1"] = self.noise_scalings[0, -1].cpu().item()
+        interesting_dict["dist0_p_accept_blocks"] = self.first_dist_p_accept_blocks.cpu().item()
+        interesting_dict["dist0_p_accept_flow"] = self.first_dist_p_accept_flow.cpu().item()
+        return interesting_dict
+
+    def transition(self, point: Point, i: int, beta: float) -> Point:
+        """Returns a new Point generated by block-wise Metropolis."""
+        coefficients = self.get_coefficients(i, beta, point.device, point.log_q.dtype)
+        valid = point.mask if point.mask is not None else \
+            torch.ones_like(point.log_q, dtype=torch.bool)
+        with torch.no_grad():
+            log_p_blocks = self.target_log_prob_blocks(point.x)
+            for n in range(self.n_updates):
+                x = point.x
+                x_proposed = x + torch.randn_like(x) * self.noise_scalings[i - 1, n]
+                log_p_blocks_proposed = self.target_log_prob_blocks(x_proposed)
+
+                # Stage 1: accept/reject each block independently.
+                log_acceptance_blocks = torch.nan_to_num(
+                    coefficients[1] * (log_p_blocks_proposed - log_p_blocks),
+                    nan=-float("inf"), posinf=-float("inf"))
+                accept_blocks = log_acceptance_blocks > \
+                    -torch.empty_like(log_acceptance_blocks).exponential_()
+                accept_blocks = accept_blocks & valid[:, None]
+                x_proposed = torch.where(accept_blocks[:, self.dim_to_block], x_proposed, x)
+                log_p_blocks_proposed = torch.where(accept_blocks, log_p_blocks_proposed,
+                                                    log_p_blocks)
+
+                # Stage 2: accept/reject the combined move with the flow term.
+                log_q_proposed = self.base_log_prob(x_proposed)
+                log_acceptance_flow = torch.nan_to_num(
+                    coefficients[0] * (log_q_proposed - point.log_q),
+                    nan=-float("inf"), posinf=-float("inf"), neginf=-float("inf"))
+                accept = log_acceptance_flow > \
+                    -torch.empty_like(log_acceptance_flow).exponential_()
+                accept = accept & valid & torch.any(accept_blocks, dim=-1)
+                point_proposed = Point(x=x_proposed, log_q=log_q_proposed,
+                                       log_p=torch.sum(log_p_blocks_proposed, dim=-1),
+                                       mask=point.mask)
+                point = point_proposed.where(accept, point)
+                log_p_blocks = torch.where(accept[:, None], log_p_blocks_proposed, log_p_blocks)
+
+                p_accept_blocks = torch.sum(
+                    torch.mean(torch.exp(torch.clamp_max(log_acceptance_blocks, 0.0)), dim=-1)
+                    * valid) / torch.clamp_min(torch.sum(valid), 1)
+                if i == 1 and n == 0:
+                    self.first_dist_p_accept_blocks = p_accept_blocks
+                    self.first_dist_p_accept_flow = torch.sum(
+                        torch.exp(torch.clamp_max(log_acceptance_flow, 0.0)) * valid
+                    ) / torch.clamp_min(torch.sum(valid), 1)
+                if self.adjust_step_size and not self.eval_mode:
+                    # Branch-free update (too much accept -> increase step size), to avoid a
+                    # sync.
+                    multiplier = torch.where(p_accept_blocks > self.target_prob_accept,
+                                             1.05, 1 / 1.05)
+                    self.noise_scalings[i - 1, n] = self.noise_scalings[i - 1, n] * multiplier
+        return point
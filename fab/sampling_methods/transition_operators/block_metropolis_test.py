@@ -0,0 +1,40 @@
+import torch
+
+from fab.sampling_methods import AnnealedImportanceSampler
+from fab.sampling_methods.transition_operators import BlockMetropolis
+from fab.target_distributions.many_well import ManyWellEnergy
+from fab.wrappers.torch import WrappedTorchDist
+
+
+def test_block_metropolis(
+        dim: int = 16,
+        n_ais_intermediate_distributions: int = 4,
+        batch_size: int = 128,
+        seed: int = 0):
+    """Check that AIS with block-wise Metropolis on the Many Well target gives finite weights, and
+    that the target log probs stored in the points are consistent with the target."""
+    torch.manual_seed(seed)
+    target = ManyWellEnergy(dim, use_gpu=False)
+    base_dist = WrappedTorchDist(torch.distributions.MultivariateNormal(
+        loc=torch.zeros(dim), scale_tril=2 * torch.eye(dim)))
+    transition_operator = BlockMetropolis(
+        n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+        dim=dim,
+        base_log_prob=base_dist.log_prob,
+        target=target,
+        n_updates=5,
+        p_target=True)
+    ais = AnnealedImportanceSampler(base_distribution=base_dist,
+                                    target_log_prob=target.log_prob,
+                                    transition_operator=transition_operator,
+                                    n_intermediate_distributions=n_ais_intermediate_distributions,
+                                    p_target=True)
+    for _ in range(3):
+        point, log_w = ais.sample_and_log_weights(batch_size)
+        assert point.x.shape == (batch_size, dim)
+        assert torch.isfinite(log_w).all()
+    torch.testing.assert_close(point.log_p, target.log_prob(point.x))
+    torch.testing.assert_close(point.log_q, base_dist.log_prob(point.x))
+    info = transition_operator.get_logging_info()
+    assert 0 < info["dist0_p_accept_blocks"] <= 1
+    assert 0 < info["dist0_p_accept_flow"] <= 1
@@ -1,10 +1,24 @@
-from typing import Callable, Union
+from typing import Callable, Optional, Union
+import math
 
 import torch
 from fab.sampling_methods.transition_operators.base import Point, TransitionOperator
 from fab.types_ import LogProbFunc
 
 
+# Splitting integrators, given by the coefficients of the momentum updates (with the gradient at
+# the current position), interleaved with the position updates: p -= a_0 eps grad_U,
+# x += b_0 eps M^-1 p, p -= a_1 eps grad_U, ... Each step costs one gradient evaluation per
+# position update, as the gradient at the end of a step is reused at the start of the next one.
+_MINIMAL_NORM_LAMBDA = 0.1931833275037836  # Omelyan, Mryglod & Folk (2002).
+INTEGRATORS = {
+    "leapfrog": ((0.5, 0.5), (1.0,)),
+    "jittered_leapfrog": ((0.5, 0.5), (1.0,)),
+    "minimal_norm": ((_MINIMAL_NORM_LAMBDA, 1 - 2 * _MINIMAL_NORM_LAMBDA, _MINIMAL_NORM_LAMBDA),
+                     (0.5, 0.5)),
+}
+
+
 class HamiltonianMonteCarlo(TransitionOperator):
     def __init__(
         self,
@@ -24,10 +38,38 @@ class HamiltonianMonteCarlo(TransitionOperator):
         common_epsilon_init_weight: float = 0.1,
         eval_mode: bool = False,
         sampling_bounds: torch.Tensor | None = None,
+        adaptation_mode: str = "p_accept",
+        mass_adaptation_rate: float = 0.05,
+        integrator: str = "leapfrog",
+        step_size_jitter: float = 0.2,
     ):
         """
         Step tuning with p_accept if used.
+
+        If `adaptation_mode` is "dual_averaging", then the step size of each (intermediate
+        distribution, outer step) is tuned with dual averaging (Hoffman & Gelman, 2014) towards
+        `target_p_accept`, and a diagonal mass is adapted for each intermediate distribution, set
+        to the inverse of an exponential moving average (with rate `mass_adaptation_rate`) of the
+        per-dimension variance of the chains. All of this state is stored in buffers, so it is
+        saved with the model.
+
+        `integrator` sets the integrator of each of the `L` steps of the trajectory (see
+        `INTEGRATORS`):
+            - "leapfrog": Stormer-Verlet leapfrog, with one gradient evaluation per step.
+            - "minimal_norm": the 2-stage minimal norm integrator of Omelyan et al. (2002), with
+                two gradient evaluations per step. Its energy error is much smaller than that of
+                two leapfrog steps of half the size, so it allows larger steps (and fewer steps
+                per trajectory) at the same acceptance rate.
+            - "jittered_leapfrog": leapfrog where the step size of each chain is multiplied by
+                a factor drawn uniformly from [1 - step_size_jitter, 1 + step_size_jitter] for
+                each trajectory, which avoids trajectory lengths that resonate with the target.
+        The mean absolute energy error of the trajectories is logged for the first and last
+        intermediate distributions, along with the acceptance probabilities, so that the
+        integrators may be compared.
         """
+        assert adaptation_mode in ["p_accept", "dual_averaging"]
+        assert integrator in INTEGRATORS, f"Unknown integrator {integrator}."
+        assert 0 <= step_size_jitter < 1
         super(HamiltonianMonteCarlo, self).__init__(
             n_ais_intermediate_distributions,
             dim,
@@ -56,11 +98,35 @@ class HamiltonianMonteCarlo(TransitionOperator):
         self.L = L
         self.target_p_accept = target_p_accept
         self.max_grad = max_grad  # max grad used when taking steps
+        self.integrator = integrator
+        self.step_size_jitter = step_size_jitter
         self.first_dist_p_accepts = [torch.tensor([0.0]) for _ in range(n_outer)]
         self.last_dist_p_accepts = [torch.tensor([0.0]) for _ in range(n_outer)]
+        self.first_dist_energy_errors = [torch.tensor(0.0) for _ in range(n_outer)]
+        self.last_dist_energy_errors = [torch.tensor(0.0) for _ in range(n_outer)]
         self.average_distance_first_dist: torch.Tensor
         self.average_distance_last_dist: torch.Tensor
         self.eval_mode = eval_mode  # turn off step size tuning
+        self.adaptation_mode = adaptation_mode
+        if adaptation_mode == "dual_averaging":
+            self.mass_adaptation_rate = mass_adaptation_rate
+            # Dual averaging hyper-parameters, using the defaults from Hoffman & Gelman (2014).
+            self.da_t0 = 10.0
+            self.da_gamma = 0.05
+            self.da_kappa = 0.75
+            log_epsilon = torch.full([n_ais_intermediate_distributions, n_outer],
+                                     math.log(epsilon))
+            self.register_buffer("da_log_epsilon", log_epsilon.clone())
+            self.register_buffer("da_log_epsilon_bar", log_epsilon.clone())
+            self.register_buffer("da_mu", log_epsilon + math.log(10.0))
+            self.register_buffer("da_h_bar", torch.zeros_like(log_epsilon))
+            self.register_buffer("da_count", torch.zeros_like(log_epsilon))
+            self.register_buffer(
+                "mass_vectors",
+                (torch.ones(dim) * mass_init).repeat((n_ais_intermediate_distributions, 1)),
+            )
+            self.register_buffer("x_mean", torch.zeros(n_ais_intermediate_distributions, dim))
+            self.register_buffer("x_var", 1 / self.mass_vectors.clone())
 
         self._sampling_bounds = sampling_bounds
 
@@ -82,6 +148,15 @@ class HamiltonianMonteCarlo(TransitionOperator):
                 interesting_dict[
                     f"dist{self.n_ais_intermediate_distributions - 1}_p_accept_{i}"
                 ] = val.item()
+        for i, val in enumerate(self.first_dist_energy_errors):
+            interesting_dict[f"dist0_energy_error_{i}"] = val.cpu().item()
+        if self.n_ais_intermediate_distributions > 1:
+            for i, val in enumerate(self.last_dist_energy_errors):
+                interesting_dict[
+                    f"dist{self.n_ais_intermediate_distributions - 1}_energy_error_{i}"
+                ] = val.cpu().item()
+        interesting_dict["n_grad_evals_per_trajectory"] = \
+            self.L * len(INTEGRATORS[self.integrator][1])
         epsilon_first_dist_first_loop = self.get_epsilon(0, 0)
         if epsilon_first_dist_first_loop.numel() == 1:
             interesting_dict[f"epsilons_dist0_loop0"] = (
@@ -117,6 +192,9 @@ class HamiltonianMonteCarlo(TransitionOperator):
             interesting_dict[
                 f"average_distance_dist_{self.n_ais_intermediate_distributions - 1}"
             ] = self.average_distance_last_dist.cpu().item()
+        if self.adaptation_mode == "dual_averaging":
+            interesting_dict["mass_dist0_min"] = torch.min(self.mass_vectors[0]).cpu().item()
+            interesting_dict["mass_dist0_max"] = torch.max(self.mass_vectors[0]).cpu().item()
         return interesting_dict
 
     def get_epsilon(self, i: int, n: int) -> torch.Tensor:
@@ -129,8 +207,33 @@ class HamiltonianMonteCarlo(TransitionOperator):
 
         """
         index = i - 1
+        if self.adaptation_mode == "dual_averaging":
+            # When tuning is turned off, use the averaged iterate of dual averaging.
+            log_epsilon = self.da_log_epsilon_bar if self.eval_mode else self.da_log_epsilon
+            return torch.exp(log_epsilon[index, n])
         return self.epsilons[index, n] + self.common_epsilon
 
+    def get_mass_vector(self, i: int) -> torch.Tensor:
+        """Returns the diagonal of the mass matrix for AIS intermediate distribution `i`."""
+        if self.adaptation_mode == "dual_averaging":
+            return self.mass_vectors[i - 1]
+        return self.mass_vector
+
+    def get_trajectory_epsilon(self, i: int, n: int, x: torch.Tensor) -> torch.Tensor:
+        """Step size used for the trajectories starting at `x`. For the jittered leapfrog this
+        has shape [batch_size, 1], with a separate random step size for each chain."""
+        epsilon = self.get_epsilon(i, n)
+        if self.integrator == "jittered_leapfrog":
+            jitter = 1 + self.step_size_jitter * (2 * torch.rand_like(x[:, :1]) - 1)
+            epsilon = epsilon * jitter
+        return epsilon
+
+    def sample_momentum(self, x: torch.Tensor, mass_vector: torch.Tensor) -> torch.Tensor:
+        if self.adaptation_mode == "dual_averaging":
+            # p ~ N(0, M), which matches the kinetic energy for a general diagonal mass.
+            return torch.randn_like(x) * torch.sqrt(mass_vector)
+        return torch.randn_like(x) * mass_vector
+
     def joint_log_prob(self, point: Point, p, mass_matrix, U):
         return -U(point) - self.kinetic_energy(p, mass_matrix)
 
@@ -142,7 +245,11 @@ class HamiltonianMonteCarlo(TransitionOperator):
         p_current: torch.Tensor,
         mass_matrix: torch.Tensor,
         U: Callable,
+        mask: Optional[torch.Tensor] = None,
     ):
+        """Metropolis accept/reject step. If `mask` is given, then chains for which the mask is
+        False are always rejected, and are excluded from the mean acceptance probability and the
+        mean absolute energy error, which are returned along with the accepted chains."""
         log_prob_current = self.joint_log_prob(point_current, p_current, mass_matrix, U)
         log_prob_proposed = self.joint_log_prob(
             point_proposed, p_proposed, mass_matrix, U
@@ -151,39 +258,56 @@ class HamiltonianMonteCarlo(TransitionOperator):
             log_acceptance_prob = log_prob_proposed - log_prob_current
             # reject samples with nan acceptance probability
             valid_samples = torch.isfinite(log_acceptance_prob)
+            energy_error_valid = valid_samples if mask is None else valid_samples & mask
+            energy_error_mean = torch.sum(
+                torch.where(energy_error_valid, torch.abs(log_acceptance_prob),
+                            torch.zeros_like(log_acceptance_prob))
+            ) / torch.clamp_min(torch.sum(energy_error_valid), 1)
             log_acceptance_prob = torch.nan_to_num(
                 log_acceptance_prob,
                 nan=-float("inf"),
                 posinf=-float("inf"),
                 neginf=-float("inf"),
             )
-            accept = log_acceptance_prob > -torch.distributions.Exponential(1.0).sample(
-                log_acceptance_prob.shape
-            ).to(log_acceptance_prob.device)
+            # Sample on the device, rather than transferring samples from the host.
+            accept = log_acceptance_prob > -torch.empty_like(log_acceptance_prob).exponential_()
             accept = accept & valid_samples
             log_acceptance_prob = torch.clamp(
                 log_acceptance_prob, max=0.0
             )  # prob can't be higher than 1.
-            log_p_accept_mean = torch.logsumexp(
-                log_acceptance_prob, dim=-1
-            ) - torch.log(torch.tensor(log_acceptance_prob.shape[0])).to(
-                log_acceptance_prob.device
-            )
-            return accept, log_p_accept_mean
+            if mask is not None:
+                accept = accept & mask
+                log_acceptance_prob = torch.where(
+                    mask, log_acceptance_prob, torch.full_like(log_acceptance_prob, -float("inf"))
+                )
+                log_n_chains = torch.log(torch.clamp_min(torch.sum(mask), 1).to(log_acceptance_prob))
+            else:
+                log_n_chains = math.log(log_acceptance_prob.shape[0])
+            log_p_accept_mean = torch.logsumexp(log_acceptance_prob, dim=-1) - log_n_chains
+            return accept, log_p_accept_mean, energy_error_mean
 
     def kinetic_energy(self, p, mass_matrix):
         return torch.sum(p**2 / mass_matrix, dim=-1) / 2
 
+    def out_of_bounds(self, x: torch.Tensor) -> torch.Tensor:
+        """Returns a mask of which samples are outside of the sampling bounds."""
+        return torch.any(x < self._sampling_bounds[:, 0].view(1, -1), dim=1) | \
+            torch.any(x > self._sampling_bounds[:, 1].view(1, -1), dim=1)
+
     def HMC_func(self, U, point: Point, grad_U, i):
+        if point.mask is not None:
+            return self.HMC_func_fixed_shape(U, point, grad_U, i)
         current_point = point
+        mass_vector = self.get_mass_vector(i)
         for n in range(self.n_outer):
             point = current_point
             original_point = current_point  # Only used for logging
 
-            epsilon = self.get_epsilon(i, n)
-            p = torch.randn_like(point.x) * self.mass_vector
+            epsilon = self.get_trajectory_epsilon(i, n, point.x)
+            p = self.sample_momentum(point.x, mass_vector)
             current_p = p
             grad_u = grad_U(point)
+            momentum_coefficients, position_coefficients = INTEGRATORS[self.integrator]
 
             local_oob_mask = torch.zeros(
                 current_point.x.shape[0], dtype=bool, device=current_point.x.device
@@ -194,44 +318,46 @@ class HamiltonianMonteCarlo(TransitionOperator):
 
             # all_OOB = False
 
-            # Now loop through position and momentum leapfrogs
+            # Now loop through the integrator steps
             for l in range(self.L):
-                # Make momentum half step
-                p = p - epsilon * grad_u / 2
+                # Make first momentum update
+                p = p - momentum_coefficients[0] * epsilon * grad_u
 
-                # Make full step for position
-                x = point.x + epsilon / self.mass_vector * p
+                for k, position_coefficient in enumerate(position_coefficients):
+                    # Make position update
+                    x = point.x + position_coefficient * epsilon / mass_vector * p
 
-                if self._sampling_bounds is not None:  # Update OOB mask
-                    local_oob_mask = (
-                        torch.any(x < self._sampling_bounds[:, 0].view(1, -1), dim=1)
-                    ) | (torch.any(x > self._sampling_bounds[:, 1].view(1, -1), dim=1))
-                    x = x[~local_oob_mask]
+                    if self._sampling_bounds is not None:  # Update OOB mask
+                        local_oob_mask = self.out_of_bounds(x)
+                        x = x[~local_oob_mask]
+                        p = p[~local_oob_mask]
+                        if epsilon.dim() == 2:  # A step size per chain.
+                            epsilon = epsilon[~local_oob_mask]
 
-                    global_oob_mask[~global_oob_mask] = local_oob_mask
+                        global_oob_mask[~global_oob_mask] = local_oob_mask
 
-                    # if torch.sum(~local_oob_mask) == 0:
-                    #     all_OOB = True
-                    #     break
+                        # if torch.sum(~local_oob_mask) == 0:
+                        #     all_OOB = True
+                        #     break
 
-                # Update grad_u, only for the non-OOB samples
-                point = self.create_new_point(x)
-                grad_u = grad_U(point)
+                    # Update grad_u, only for the non-OOB samples
+                    point = self.create_new_point(x)
+                    grad_u = grad_U(point)
 
-                # Make momentum half step
-                p = p[~local_oob_mask] - epsilon * grad_u / 2
+                    # Make momentum update
+                    p = p - momentum_coefficients[k + 1] * epsilon * grad_u
 
             # if all_OOB:
             #     print("Warning: All samples OOB in HMC step.")
             #     continue
 
-            accept, log_p_accept_mean = self.metropolis_accept(
+            accept, log_p_accept_mean, energy_error_mean = self.metropolis_accept(
                 point_proposed=point,
                 point_current=current_point[~global_oob_mask],
                 p_proposed=p,
                 p_current=current_p[~global_oob_mask],
                 U=U,
-                mass_matrix=self.mass_vector,
+                mass_matrix=mass_vector,
             )
 
             global_accept = torch.zeros(
@@ -248,36 +374,157 @@ class HamiltonianMonteCarlo(TransitionOperator):
                 p_accept_mean=torch.exp(log_p_accept_mean),
                 current_x=point.x,
                 original_x=original_point.x[~global_oob_mask],
+                energy_error_mean=energy_error_mean,
             )
             if not self.eval_mode:
-                self.adjust_step_size_p_accept(
+                self.adjust_step_size(
                     log_p_accept_mean=log_p_accept_mean, i=i, n=n
                 )
         return current_point
 
-    def adjust_step_size_p_accept(self, log_p_accept_mean, i, n):
-        """Adjust step size to reach the target p-accept."""
+    def HMC_func_fixed_shape(self, U, point: Point, grad_U, i):
+        """Equivalent to `HMC_func`, but keeps the batch size fixed for use in fixed shape (masked)
+        AIS. Chains that are invalid (`point.mask` is False), or that leave the sampling bounds
+        during the trajectory, are frozen via `torch.where` and rejected, rather than removed."""
+        current_point = point
+        mass_vector = self.get_mass_vector(i)
+        for n in range(self.n_outer):
+            point = current_point
+            original_point = current_point  # Only used for logging
+
+            epsilon = self.get_trajectory_epsilon(i, n, point.x)
+            p = self.sample_momentum(point.x, mass_vector)
+            current_p = p
+            grad_u = grad_U(point)
+            oob_mask = torch.zeros_like(current_point.mask)
+            momentum_coefficients, position_coefficients = INTEGRATORS[self.integrator]
+
+            # Now loop through the integrator steps
+            for l in range(self.L):
+                # Make first momentum update
+                p = p - momentum_coefficients[0] * epsilon * grad_u
+
+                for k, position_coefficient in enumerate(position_coefficients):
+                    # Make position update
+                    x = point.x + position_coefficient * epsilon / mass_vector * p
+
+                    if self._sampling_bounds is not None:
+                        # Freeze OOB samples at their starting point, they are rejected below.
+                        oob_mask = oob_mask | self.out_of_bounds(x)
+                        x = torch.where(oob_mask[:, None], current_point.x, x)
+
+                    point = self.create_new_point(x, mask=current_point.mask)
+                    grad_u = grad_U(point)
+
+                    # Make momentum update
+                    p = p - momentum_coefficients[k + 1] * epsilon * grad_u
+
+            valid = current_point.mask & ~oob_mask
+            accept, log_p_accept_mean, energy_error_mean = self.metropolis_accept(
+                point_proposed=point,
+                point_current=current_point,
+                p_proposed=p,
+                p_current=current_p,
+                U=U,
+                mass_matrix=mass_vector,
+                mask=valid,
+            )
+            current_point = point.where(accept, current_point)
+            self.store_info(
+                i=i,
+                n=n,
+                p_accept_mean=torch.exp(log_p_accept_mean),
+                current_x=point.x,
+                original_x=original_point.x,
+                mask=valid,
+                energy_error_mean=energy_error_mean,
+            )
+            if not self.eval_mode:
+                self.adjust_step_size(
+                    log_p_accept_mean=log_p_accept_mean, i=i, n=n
+                )
+        return current_point
+
+    def adjust_step_size(self, log_p_accept_mean, i, n):
+        """Adjust step size according to `self.adaptation_mode`."""
+        if self.adaptation_mode == "dual_averaging":
+            self.adjust_step_size_dual_averaging(log_p_accept_mean, i, n)
+        else:
+            self.adjust_step_size_p_accept(log_p_accept_mean, i, n)
+
+    def adjust_step_size_dual_averaging(self, log_p_accept_mean, i, n):
+        """Dual averaging step size update (Hoffman & Gelman, 2014, Algorithm 5), towards the
+        target p-accept. Like `adjust_step_size_p_accept`, this does not require a device to host
+        sync."""
+        index = i - 1
+        t = self.da_count[index, n] + 1
+        w = 1 / (t + self.da_t0)
+        h_bar = (1 - w) * self.da_h_bar[index, n] + \
+            w * (self.target_p_accept - torch.exp(log_p_accept_mean))
+        log_epsilon = self.da_mu[index, n] - torch.sqrt(t) / self.da_gamma * h_bar
+        eta = t ** (-self.da_kappa)
+        self.da_log_epsilon_bar[index, n] = eta * log_epsilon + \
+            (1 - eta) * self.da_log_epsilon_bar[index, n]
+        self.da_log_epsilon[index, n] = log_epsilon
+        self.da_h_bar[index, n] = h_bar
+        self.da_count[index, n] = t
+
+    def adapt_mass(self, point: Point, i: int):
+        """Update the running per-dimension mean and variance of the chains for AIS intermediate
+        distribution `i`, and set the mass to the inverse of the variance. If `point.mask` is set,
+        then only the valid chains are used."""
         index = i - 1
-        if log_p_accept_mean > torch.log(
-            torch.tensor(self.target_p_accept).to(log_p_accept_mean.device)
-        ):  # too much accept
-            self.epsilons[index, n] = self.epsilons[index, n] * 1.05
-            self.common_epsilon = self.common_epsilon * 1.02
+        x = point.x.detach()
+        if point.mask is None:
+            weights = torch.full_like(x[:, 0], 1 / x.shape[0])
         else:
-            self.epsilons[index, n] = self.epsilons[index, n] / 1.05
-            self.common_epsilon = self.common_epsilon / 1.02
+            weights = point.mask.to(x) / torch.clamp_min(torch.sum(point.mask), 1)
+        batch_mean = torch.sum(weights[:, None] * x, dim=0)
+        batch_var = torch.sum(weights[:, None] * (x - batch_mean) ** 2, dim=0)
+        rate = self.mass_adaptation_rate
+        mean = self.x_mean[index]
+        # Exponential moving average of the first two moments.
+        self.x_var[index] = (1 - rate) * (self.x_var[index] + rate * (batch_mean - mean) ** 2) + \
+            rate * batch_var
+        self.x_mean[index] = mean + rate * (batch_mean - mean)
+        self.mass_vectors[index] = 1 / torch.clamp_min(self.x_var[index], 1e-6)
 
-    def store_info(self, i, n, p_accept_mean, current_x, original_x):
-        """Store info that will be retrieved for logging."""
+    def adjust_step_size_p_accept(self, log_p_accept_mean, i, n):
+        """Adjust step size to reach the target p-accept. This is a branch-free tensor update, so
+        that it does not require a device to host sync."""
+        index = i - 1
+        too_much_accept = log_p_accept_mean > math.log(self.target_p_accept)
+        epsilon_multiplier = torch.where(too_much_accept, 1.05, 1 / 1.05)
+        common_epsilon_multiplier = torch.where(too_much_accept, 1.02, 1 / 1.02)
+        self.epsilons[index, n] = self.epsilons[index, n] * epsilon_multiplier
+        self.common_epsilon = self.common_epsilon * common_epsilon_multiplier
+
+    def store_info(self, i, n, p_accept_mean, current_x, original_x, mask=None,
+                   energy_error_mean=None):
+        """Store info that will be retrieved for logging. If `mask` is given, the average distance
+        is only taken over the chains for which the mask is True. The info is kept on the device,
+        and is only copied to the host in `get_logging_info`."""
         if i == 1:  # save info from the first AIS distribution.
             # save as interesting info for plotting
-            self.first_dist_p_accepts[n] = p_accept_mean.cpu().detach()
-            distance = torch.linalg.norm((original_x - current_x), ord=2, dim=-1)
-            self.average_distance_first_dist = torch.mean(distance).detach().cpu()
+            self.first_dist_p_accepts[n] = p_accept_mean.detach()
+            if energy_error_mean is not None:
+                self.first_dist_energy_errors[n] = energy_error_mean.detach()
+            distance = self.average_distance(current_x, original_x, mask)
+            self.average_distance_first_dist = distance.detach()
         elif i == self.n_ais_intermediate_distributions:
-            self.last_dist_p_accepts[n] = p_accept_mean.cpu().detach()
-            distance = torch.linalg.norm((original_x - current_x), ord=2, dim=-1)
-            self.average_distance_last_dist = torch.mean(distance).detach().cpu()
+            self.last_dist_p_accepts[n] = p_accept_mean.detach()
+            if energy_error_mean is not None:
+                self.last_dist_energy_errors[n] = energy_error_mean.detach()
+            distance = self.average_distance(current_x, original_x, mask)
+            self.average_distance_last_dist = distance.detach()
+
+    @staticmethod
+    def average_distance(current_x, original_x, mask=None) -> torch.Tensor:
+        distance = torch.linalg.norm((original_x - current_x), ord=2, dim=-1)
+        if mask is None:
+            return torch.mean(distance)
+        return torch.sum(torch.where(mask, distance, torch.zeros_like(distance))) / \
+            torch.clamp_min(torch.sum(mask), 1)
 
     def transition(self, point: Point, i: int, beta: float) -> Point:
         """
@@ -285,10 +532,10 @@ class HamiltonianMonteCarlo(TransitionOperator):
         """
 
         def U(point: Point):
-            return -self.intermediate_target_log_prob(point, beta)
+            return -self.intermediate_target_log_prob(point, beta, i)
 
         def grad_U(point: Point):
-            grad = -self.grad_intermediate_target_log_prob(point, beta)
+            grad = -self.grad_intermediate_target_log_prob(point, beta, i)
             return torch.nan_to_num(
                 torch.clamp(grad, max=self.max_grad, min=-self.max_grad),
                 nan=0.0,
@@ -297,6 +544,8 @@ class HamiltonianMonteCarlo(TransitionOperator):
             )
 
         point = self.HMC_func(U, point, grad_U, i)
+        if self.adaptation_mode == "dual_averaging" and not self.eval_mode:
+            self.adapt_mass(point, i)
         return point
 
     def save_model(self, save_path, epoch=None):
@@ -27,5 +27,63 @@ def test_hmc(
                              n_samples=batch_size
                              )
 
+
+def test_hmc__dual_averaging(
+        config: TransitionOperatorTestConfig = TransitionOperatorTestConfig(),
+        n_iterations: int = 20,
+        batch_size: int = 64):
+    """Test HMC with dual averaging step sizes and diagonal mass adaptation, and check that the
+    adapted state is saved in the state dict."""
+    hmc = HamiltonianMonteCarlo(
+        n_ais_intermediate_distributions=config.n_ais_intermediate_distributions,
+        dim=config.dim,
+        base_log_prob=config.learnt_sampler.log_prob,
+        target_log_prob=config.target.log_prob,
+        alpha=config.alpha,
+        p_target=config.p_target,
+        n_outer=2,
+        epsilon=1.0, L=3,
+        adaptation_mode="dual_averaging")
+    test_transition_operator(transition_operator=hmc,
+                             config=config,
+                             n_iterations=n_iterations,
+                             n_samples=batch_size
+                             )
+    assert (hmc.da_count == n_iterations).all()
+    assert torch.isfinite(hmc.da_log_epsilon).all()
+    assert torch.isfinite(hmc.mass_vectors).all() and (hmc.mass_vectors > 0).all()
+    assert not (hmc.mass_vectors == 1.0).all()
+    state_dict = hmc.state_dict()
+    for name in ["da_log_epsilon", "da_log_epsilon_bar", "da_h_bar", "da_count", "mass_vectors",
+                 "x_var"]:
+        assert name in state_dict
+
+
+def test_hmc__integrators(
+        config: TransitionOperatorTestConfig = TransitionOperatorTestConfig(),
+        n_iterations: int = 20,
+        batch_size: int = 64):
+    """Test HMC with each of the integrators, and check that the energy error is logged."""
+    for integrator in ["minimal_norm", "jittered_leapfrog"]:
+        hmc = HamiltonianMonteCarlo(
+            n_ais_intermediate_distributions=config.n_ais_intermediate_distributions,
+            dim=config.dim,
+            base_log_prob=config.learnt_sampler.log_prob,
+            target_log_prob=config.target.log_prob,
+            alpha=config.alpha,
+            p_target=config.p_target,
+            n_outer=2,
+            epsilon=1.0, L=3,
+            integrator=integrator)
+        test_transition_operator(transition_operator=hmc,
+                                 config=config,
+                                 n_iterations=n_iterations,
+                                 n_samples=batch_size
+                                 )
+        info = hmc.get_logging_info()
+        assert info["dist0_energy_error_0"] >= 0.0
+        assert info["n_grad_evals_per_trajectory"] == (6 if integrator == "minimal_norm" else 3)
+
+
 if __name__ == '__main__':
     test_hmc()
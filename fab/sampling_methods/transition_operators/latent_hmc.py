@@ -0,0 +1,180 @@
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from fab.sampling_methods.transition_operators.base import TransitionOperator
+from fab.sampling_methods.base import Point
+from fab.trainable_distributions import TrainableDistribution
+from fab.types_ import LogProbFunc
+
+
+class LatentPoint(Point):
+    """A `Point` that also keeps the latent `z` of the flow, where x = f(z). This lets latent space
+    transition operators continue the chain without inverting the flow. If a subset of the
+    values is set from a plain `Point`, then `z` is set to None, and must be recomputed."""
+    def __init__(self,
+                 x: torch.Tensor,
+                 log_q: torch.Tensor,
+                 log_p: torch.Tensor,
+                 z: Optional[torch.Tensor],
+                 mask: Optional[torch.Tensor] = None):
+        super(LatentPoint, self).__init__(x=x, log_q=log_q, log_p=log_p, mask=mask)
+        self.z = z
+
+    def to(self, device):
+        super(LatentPoint, self).to(device)
+        self.z = self.z.to(device) if self.z is not None else None
+
+    def __getitem__(self, indices):
+        point = super(LatentPoint, self).__getitem__(indices)
+        z = self.z[indices] if self.z is not None else None
+        return LatentPoint(point.x, point.log_q, point.log_p, z, point.mask)
+
+    def __setitem__(self, indices, values):
+        super(LatentPoint, self).__setitem__(indices, values)
+        if self.z is not None and isinstance(values, LatentPoint) and values.z is not None:
+            self.z[indices] = values.z
+        else:
+            self.z = None
+
+    def where(self, condition: torch.Tensor, other: "Point") -> "Point":
+        point = super(LatentPoint, self).where(condition, other)
+        if self.z is None or not isinstance(other, LatentPoint) or other.z is None:
+            return point
+        return LatentPoint(point.x, point.log_q, point.log_p,
+                           torch.where(condition[:, None], self.z, other.z), point.mask)
+
+
+class LatentHamiltonianMonteCarlo(TransitionOperator):
+    def __init__(self,
+                 n_ais_intermediate_distributions: int,
+                 dim: int,
+                 flow: TrainableDistribution,
+                 target_log_prob: LogProbFunc,
+                 alpha: float = None,
+                 p_target: bool = False,
+                 epsilon: float = 0.5,
+                 n_outer: int = 1,
+                 L: int = 5,
+                 target_p_accept: float = 0.65,
+                 max_grad: float = 1e3,
+                 eval_mode: bool = False):
+        """
+        HMC in the latent space of the flow, x = f(z). The intermediate AIS distribution
+        q^(c_q) p^(c_p) pulled back to the latent space is
+
+            log pi(z) = c_q log q_0(z) + (1 - c_q) log|det df/dz| + c_p log p(f(z)),
+
+        where q_0 is the base distribution of the flow. So each leapfrog step only requires a
+        forward pass of the flow with its log determinant (and a backward pass), rather than the
+        inverse pass needed for log q(x) in data space. As the flow approximates the target, the
+        pulled back distribution is typically much better conditioned than in data space.
+
+        The flow must implement `forward_and_log_det`, `inverse_and_log_det` and
+        `base_log_prob` (see `TrainableDistribution`). The returned points are `LatentPoint`s,
+        so that the flow only needs to be inverted at the start of AIS.
+        """
+        super(LatentHamiltonianMonteCarlo, self).__init__(
+            n_ais_intermediate_distributions, dim, flow.log_prob, target_log_prob,
+            alpha=alpha, p_target=p_target)
+        # Keep the bound methods, rather than the flow itself, so that the flow parameters are
+        # not part of the state dict of the transition operator.
+        self.flow_forward_and_log_det = flow.forward_and_log_det
+        self.flow_inverse_and_log_det = flow.inverse_and_log_det
+        self.flow_base_log_prob = flow.base_log_prob
+        self.register_buffer("epsilons", torch.full([n_ais_intermediate_distributions, n_outer],
+                                                    epsilon))
+        self.n_outer = n_outer
+        self.L = L
+        self.target_p_accept = target_p_accept
+        self.max_grad = max_grad  # max grad used when taking steps
+        self.eval_mode = eval_mode  # turn off step size tuning
+        self.first_dist_p_accept = torch.tensor(0.0)
+
+    @property
+    def uses_grad_info(self) -> bool:
+        """Gradients are taken w.r.t. the latent z, so the data space gradients are not used."""
+        return False
+
+    def set_eval_mode(self, eval_setting: bool):
+        """When eval_mode is turned on, no tuning of the step size occurs."""
+        self.eval_mode = eval_setting
+
+    def get_logging_info(self) -> Dict:
+        """Log the step sizes, and the p_accept of the first AIS distribution."""
+        interesting_dict = {}
+        interesting_dict["epsilons_dist0_loop0"] = self.epsilons[0, 0].cpu().item()
+        interesting_dict["epsilons_dist-1_loop0"] = self.epsilons[-1, 0].cpu().item()
+        interesting_dict["dist0_p_accept"] = self.first_dist_p_accept.cpu().item()
+        return interesting_dict
+
+    def create_latent_point(self, z: torch.Tensor, coefficients: torch.Tensor,
+                            mask: Optional[torch.Tensor] = None
+                            ) -> Tuple[LatentPoint, torch.Tensor, torch.Tensor]:
+        """Evaluate the flow forward pass at z, returning the `LatentPoint`, as well as the latent
+        space intermediate log prob and its gradient w.r.t. z."""
+        with torch.enable_grad():
+            z = z.detach().requires_grad_(True)
+            x, log_det = self.flow_forward_and_log_det(z)
+            log_q_base = self.flow_base_log_prob(z)
+            log_p = self.target_log_prob(x)
+            log_prob = coefficients[0] * log_q_base + (1 - coefficients[0]) * log_det + \
+                coefficients[1] * log_p
+            grad = torch.autograd.grad(log_prob, z, grad_outputs=torch.ones_like(log_prob))[0]
+        grad = torch.nan_to_num(torch.clamp(grad, max=self.max_grad, min=-self.max_grad),
+                                nan=0.0, posinf=0.0, neginf=0.0)
+        point = LatentPoint(x=x.detach(), log_q=(log_q_base - log_det).detach(),
+                            log_p=log_p.detach(), z=z.detach(), mask=mask)
+        return point, log_prob.detach(), grad.detach()
+
+    def transition(self, point: Point, i: int, beta: float) -> Point:
+        """Perform HMC in the latent space. Invalid chains (if `point.mask` is set) are left
+        unchanged, and the batch shape is kept fixed."""
+        if isinstance(point, LatentPoint) and point.z is not None:
+            z = point.z
+        else:
+            with torch.no_grad():
+                z, _ = self.flow_inverse_and_log_det(point.x)
+        coefficients = self.get_coefficients(i, beta, point.device, point.log_q.dtype)
+        current_point, log_prob, grad = self.create_latent_point(z, coefficients, point.mask)
+        valid = point.mask if point.mask is not None else \
+            torch.ones_like(log_prob, dtype=torch.bool)
+
+        for n in range(self.n_outer):
+            epsilon = self.epsilons[i - 1, n]
+            p_current = torch.randn_like(current_point.z)
+            p = p_current
+            proposed_point, log_prob_proposed, grad_proposed = current_point, log_prob, grad
+            for l in range(self.L):
+                p = p + epsilon * grad_proposed / 2
+                z = proposed_point.z + epsilon * p
+                proposed_point, log_prob_proposed, grad_proposed = self.create_latent_point(
+                    z, coefficients, point.mask)
+                p = p + epsilon * grad_proposed / 2
+
+            with torch.no_grad():
+                log_acceptance_prob = log_prob_proposed - torch.sum(p**2, dim=-1) / 2 - \
+                    (log_prob - torch.sum(p_current**2, dim=-1) / 2)
+                log_acceptance_prob = torch.nan_to_num(log_acceptance_prob, nan=-float("inf"),
+                                                       posinf=-float("inf"),
+                                                       neginf=-float("inf"))
+                accept = log_acceptance_prob > \
+                    -torch.empty_like(log_acceptance_prob).exponential_()
+                accept = accept & valid
+                current_point = proposed_point.where(accept, current_point)
+                log_prob = torch.where(accept, log_prob_proposed, log_prob)
+                grad = torch.where(accept[:, None], grad_proposed, grad)
+
+                p_accept = torch.sum(torch.exp(torch.clamp_max(log_acceptance_prob, 0.0)) * valid
+                                     ) / torch.clamp_min(torch.sum(valid), 1)
+                if i == 1 and n == 0:
+                    self.first_dist_p_accept = p_accept
+                if not self.eval_mode:
+                    # Branch-free update (too much accept -> increase step size), to avoid a
+                    # sync.
+                    multiplier = torch.where(p_accept > self.target_p_accept, 1.05, 1 / 1.05)
+                    self.epsilons[i - 1, n] = self.epsilons[i - 1, n] * multiplier
+        # Invalid chains keep their original values.
+        if point.mask is not None:
+            current_point = current_point.where(valid, point)
+        return current_point
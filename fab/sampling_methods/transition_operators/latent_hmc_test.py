@@ -0,0 +1,44 @@
+import torch
+
+from fab.sampling_methods import AnnealedImportanceSampler
+from fab.sampling_methods.transition_operators import LatentHamiltonianMonteCarlo, LatentPoint
+from fab.target_distributions.gmm import GMM
+from experiments.make_flow.make_normflow_model import make_wrapped_normflow_realnvp
+
+
+def test_latent_hmc(
+        dim: int = 2,
+        n_ais_intermediate_distributions: int = 4,
+        batch_size: int = 64,
+        seed: int = 0):
+    """Check that AIS with HMC in the latent space of the flow gives finite weights, and that the
+    returned points are consistent with the flow."""
+    torch.manual_seed(seed)
+    target = GMM(dim=dim, n_mixes=4, loc_scaling=8)
+    flow = make_wrapped_normflow_realnvp(dim, n_flow_layers=2, layer_nodes_per_dim=5)
+    transition_operator = LatentHamiltonianMonteCarlo(
+        n_ais_intermediate_distributions=n_ais_intermediate_distributions,
+        dim=dim,
+        flow=flow,
+        target_log_prob=target.log_prob,
+        alpha=2.0,
+        p_target=False,
+        L=3)
+    assert "flow" not in "".join(transition_operator.state_dict().keys())
+    ais = AnnealedImportanceSampler(base_distribution=flow,
+                                    target_log_prob=target.log_prob,
+                                    transition_operator=transition_operator,
+                                    n_intermediate_distributions=n_ais_intermediate_distributions,
+                                    p_target=False,
+                                    alpha=2.0)
+    for _ in range(3):
+        point, log_w = ais.sample_and_log_weights(batch_size)
+        assert point.x.shape == (batch_size, dim)
+        assert torch.isfinite(log_w).all()
+    assert isinstance(point, LatentPoint)
+    with torch.no_grad():
+        x, _ = flow.forward_and_log_det(point.z)
+        log_q = flow.log_prob(point.x)
+    torch.testing.assert_close(x, point.x)
+    torch.testing.assert_close(log_q, point.log_q, atol=1e-4, rtol=1e-4)
+    assert 0 < transition_operator.get_logging_info()["dist0_p_accept"] <= 1
@@ -0,0 +1,114 @@
+from typing import Dict
+
+import torch
+
+from fab.sampling_methods.transition_operators.base import TransitionOperator
+from fab.types_ import LogProbFunc
+from fab.sampling_methods.base import Point
+
+
+class MetropolisAdjustedLangevin(TransitionOperator):
+    def __init__(self,
+                 n_ais_intermediate_distributions: int,
+                 dim: int,
+                 base_log_prob: LogProbFunc,
+                 target_log_prob: LogProbFunc,
+                 n_updates: int = 1,
+                 alpha: float = None,
+                 p_target: bool = False,
+                 step_size: float = 0.1,
+                 adjust_step_size: bool = True,
+                 target_p_accept: float = 0.574,
+                 max_grad: float = 1e3,
+                 eval_mode: bool = False):
+        """
+        Metropolis-adjusted Langevin algorithm (MALA). Each of the `n_updates` accept/reject steps
+        only requires a single gradient evaluation of the flow and target, which is re-used from
+        the `Point` for the reverse proposal density. The step size of each
+        (intermediate distribution, update) is tuned towards `target_p_accept` if
+        `adjust_step_size` is True.
+        """
+        super(MetropolisAdjustedLangevin, self).__init__(
+            n_ais_intermediate_distributions, dim, base_log_prob, target_log_prob,
+            alpha=alpha, p_target=p_target)
+        self.n_updates = n_updates
+        self.adjust_step_size = adjust_step_size
+        self.register_buffer("step_sizes", torch.full([n_ais_intermediate_distributions,
+                                                       n_updates], step_size))
+        self.target_p_accept = target_p_accept
+        self.max_grad = max_grad  # max grad used when taking steps
+        self.first_dist_p_accept = torch.tensor(0.0)
+        self.eval_mode = eval_mode
+
+    @property
+    def uses_grad_info(self) -> bool:
+        return True
+
+    def set_eval_mode(self, eval_setting: bool):
+        """When eval_mode is turned on, no tuning of the step size occurs."""
+        self.eval_mode = eval_setting
+
+    def get_logging_info(self) -> Dict:
+        """Return the first and last step size, and the p_accept of the first AIS distribution
+        for logging."""
+        interesting_dict = {}
+        interesting_dict["step_size_dist0_0"] = self.step_sizes[0, 0].cpu().item()
+        interesting_dict["step_size_dist-1_0"] = self.step_sizes[-1, 0].cpu().item()
+        interesting_dict["dist0_p_accept"] = self.first_dist_p_accept.cpu().item()
+        return interesting_dict
+
+    def grad_log_prob(self, point: Point, beta: float, i: int) -> torch.Tensor:
+        grad = self.grad_intermediate_target_log_prob(point, beta, i)
+        return torch.nan_to_num(torch.clamp(grad, max=self.max_grad, min=-self.max_grad),
+                                nan=0.0, posinf=0.0, neginf=0.0)
+
+    @staticmethod
+    def log_proposal_density(x_to: torch.Tensor, x_from: torch.Tensor,
+                             grad_from: torch.Tensor, step_size: torch.Tensor) -> torch.Tensor:
+        """Log density (up to a constant) of proposing `x_to` from `x_from`, for the Langevin
+        proposal N(x_from + step_size * grad_from, 2 * step_size * I)."""
+        return - torch.sum((x_to - x_from - step_size * grad_from) ** 2, dim=-1) / (4 * step_size)
+
+    def transition(self, point: Point, i: int, beta: float) -> Point:
+        """Returns a new Point generated by MALA."""
+        log_prob = self.intermediate_target_log_prob(point, beta, i)
+        grad = self.grad_log_prob(point, beta, i)
+
+        for n in range(self.n_updates):
+            step_size = self.step_sizes[i - 1, n]
+            x = point.x
+            x_proposed = x + step_size * grad + torch.sqrt(2 * step_size) * torch.randn_like(x)
+            point_proposed = self.create_new_point(x_proposed, mask=point.mask)
+            log_prob_proposed = self.intermediate_target_log_prob(point_proposed, beta, i)
+            grad_proposed = self.grad_log_prob(point_proposed, beta, i)
+
+            with torch.no_grad():
+                log_acceptance_prob = log_prob_proposed - log_prob + \
+                    self.log_proposal_density(x, x_proposed, grad_proposed, step_size) - \
+                    self.log_proposal_density(x_proposed, x, grad, step_size)
+                log_acceptance_prob = torch.nan_to_num(log_acceptance_prob, nan=-float("inf"),
+                                                       posinf=-float("inf"),
+                                                       neginf=-float("inf"))
+                accept = log_acceptance_prob > \
+                    -torch.empty_like(log_acceptance_prob).exponential_()
+                acceptance_prob = torch.exp(torch.clamp_max(log_acceptance_prob, 0.0))
+
+            if point.mask is not None:
+                # Fixed shape mode: invalid chains are frozen, and the batch size kept fixed.
+                accept = accept & point.mask
+                point = point_proposed.where(accept, point)
+                p_accept = torch.sum(acceptance_prob * point.mask) / \
+                    torch.clamp_min(torch.sum(point.mask), 1)
+            else:
+                point[accept] = point_proposed[accept]
+                p_accept = torch.mean(acceptance_prob)
+            log_prob = torch.where(accept, log_prob_proposed, log_prob)
+            grad = torch.where(accept[:, None], grad_proposed, grad)
+
+            if i == 1 and n == 0:
+                self.first_dist_p_accept = p_accept.detach()
+            if self.adjust_step_size and not self.eval_mode:
+                # Branch-free update (too much accept -> increase step size), to avoid a sync.
+                multiplier = torch.where(p_accept > self.target_p_accept, 1.05, 1 / 1.05)
+                self.step_sizes[i - 1, n] = self.step_sizes[i - 1, n] * multiplier
+        return point
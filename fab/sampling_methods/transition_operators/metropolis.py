@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Optional
 
 import torch
 
@@ -19,7 +19,24 @@ class Metropolis(TransitionOperator):
                  min_step_size=0.1,
                  adjust_step_size=True,
                  target_p_accept=0.65,
-                 eval_mode: bool = False):
+                 eval_mode: bool = False,
+                 delayed_acceptance: bool = False,
+                 surrogate_log_prob: Optional[LogProbFunc] = None):
+        """
+        Random walk Metropolis.
+
+        If `delayed_acceptance` is True, each proposal is first screened with a cheap surrogate
+        of the target (Christen & Fox, 2005), and the target is only evaluated for the proposals
+        that pass the screen. Proposals that pass are accepted with a second stage that corrects
+        for the error of the surrogate, so the intermediate AIS distributions remain exactly
+        invariant. This saves most target evaluations when these are expensive (e.g. for
+        `AldpBoltzmann`), at the cost of a lower acceptance rate if the surrogate is poor.
+
+        Args:
+            delayed_acceptance: Whether to use delayed acceptance.
+            surrogate_log_prob: Cheap approximation of the target log prob, used in the first
+                stage of delayed acceptance. If None, the flow (`base_log_prob`) is used.
+        """
         super(Metropolis, self).__init__(n_ais_intermediate_distributions, dim, base_log_prob, target_log_prob,
             alpha=alpha, p_target=p_target)
         self.n_distributions = n_ais_intermediate_distributions
@@ -30,6 +47,12 @@ class Metropolis(TransitionOperator):
             (n_ais_intermediate_distributions, 1)))
         self.target_prob_accept = target_p_accept
         self.eval_mode = eval_mode
+        self.delayed_acceptance = delayed_acceptance
+        self.surrogate_log_prob = surrogate_log_prob
+        # Delayed acceptance logging info, kept on the device until `get_logging_info` is called.
+        self.first_dist_p_accept_surrogate = torch.tensor(0.0)
+        self.first_dist_p_accept_target = torch.tensor(0.0)
+        self.first_dist_target_evals_per_proposal = torch.tensor(0.0)
 
     @property
     def uses_grad_info(self) -> bool:
@@ -45,30 +68,121 @@ class Metropolis(TransitionOperator):
         interesting_dict = {}
         interesting_dict[f"noise_scaling_0_0"] = self.noise_scalings[0, 0].cpu().item()
         interesting_dict[f"noise_scaling_0_-1"] = self.noise_scalings[0, -1].cpu().item()
+        if self.delayed_acceptance:
+            interesting_dict["dist0_p_accept_surrogate"] = \
+                self.first_dist_p_accept_surrogate.cpu().item()
+            interesting_dict["dist0_p_accept_target"] = \
+                self.first_dist_p_accept_target.cpu().item()
+            interesting_dict["dist0_target_evals_per_proposal"] = \
+                self.first_dist_target_evals_per_proposal.cpu().item()
         return interesting_dict
 
-
     def transition(self, point: Point, i: int, beta: float) -> Point:
         """Returns a new Point generated by the Metropolis algorithm."""
-        x_prev_log_prob = self.intermediate_target_log_prob(point, beta)
+        if self.delayed_acceptance:
+            return self.transition_delayed_acceptance(point, i, beta)
+        x_prev_log_prob = self.intermediate_target_log_prob(point, beta, i)
 
         for n in range(self.n_updates):
             x = point.x
-            x_proposed = x + torch.randn(x.shape).to(x.device) * self.noise_scalings[i - 1, n]
-            point_proposed = self.create_new_point(x_proposed)
-            x_proposed_log_prob = self.intermediate_target_log_prob(point_proposed, beta)
+            x_proposed = x + torch.randn_like(x) * self.noise_scalings[i - 1, n]
+            point_proposed = self.create_new_point(x_proposed, mask=point.mask)
+            x_proposed_log_prob = self.intermediate_target_log_prob(point_proposed, beta, i)
             acceptance_probability = torch.exp(x_proposed_log_prob - x_prev_log_prob)
             # not that sometimes this will be greater than one, corresonding to 100% probability of
             # acceptance
             acceptance_probability = torch.nan_to_num(acceptance_probability, nan=0.0, posinf=0.0,
                                                       neginf=0.0)
-            accept = (acceptance_probability > torch.rand(acceptance_probability.shape
-                                                          ).to(x.device)).int()
-            point[accept.bool()] = point_proposed[accept.bool()]
+            accept = (acceptance_probability > torch.rand_like(acceptance_probability)).int()
+            if point.mask is not None:
+                # Fixed shape mode: invalid chains are frozen, and the batch size kept fixed.
+                accept = accept.bool() & point.mask
+                point = point_proposed.where(accept, point)
+            else:
+                point[accept.bool()] = point_proposed[accept.bool()]
+            x_prev_log_prob = torch.where(accept.bool(), x_proposed_log_prob, x_prev_log_prob)
             if self.adjust_step_size and not self.eval_mode:
-                p_accept = torch.mean(torch.clamp_max(acceptance_probability, 1))
-                if p_accept > self.target_prob_accept:  # too much accept
-                    self.noise_scalings[i - 1, n] = self.noise_scalings[i - 1, n] * 1.05
+                if point.mask is not None:
+                    p_accept = torch.sum(torch.clamp_max(acceptance_probability, 1) * point.mask
+                                         ) / torch.clamp_min(torch.sum(point.mask), 1)
                 else:
-                    self.noise_scalings[i - 1, n] = self.noise_scalings[i - 1, n] / 1.05
+                    p_accept = torch.mean(torch.clamp_max(acceptance_probability, 1))
+                # Branch-free update (too much accept -> increase step size), to avoid a sync.
+                multiplier = torch.where(p_accept > self.target_prob_accept, 1.05, 1 / 1.05)
+                self.noise_scalings[i - 1, n] = self.noise_scalings[i - 1, n] * multiplier
+        return point
+
+    def surrogate_intermediate_log_prob(self, x: torch.Tensor, log_q: torch.Tensor,
+                                        coefficients: torch.Tensor) -> torch.Tensor:
+        """Intermediate AIS log prob with the target replaced by its surrogate."""
+        log_p_surrogate = log_q if self.surrogate_log_prob is None else self.surrogate_log_prob(x)
+        return coefficients[0] * log_q + coefficients[1] * log_p_surrogate
+
+    def transition_delayed_acceptance(self, point: Point, i: int, beta: float) -> Point:
+        """Returns a new Point generated by delayed acceptance Metropolis. The target is only
+        evaluated for the proposals that pass the first (surrogate) stage, so the number of
+        points passed to the target is data dependent. The batch shape of the returned point is
+        kept fixed, and if `point.mask` is set then invalid chains are left unchanged."""
+        coefficients = self.get_coefficients(i, beta, point.device, point.log_q.dtype)
+        valid = point.mask if point.mask is not None else \
+            torch.ones_like(point.log_q, dtype=torch.bool)
+        with torch.no_grad():
+            log_prob = self.intermediate_target_log_prob(point, beta, i)
+            log_prob_surrogate = self.surrogate_intermediate_log_prob(point.x, point.log_q,
+                                                                      coefficients)
+            n_target_evals = torch.zeros((), device=point.device)
+            for n in range(self.n_updates):
+                x = point.x
+                x_proposed = x + torch.randn_like(x) * self.noise_scalings[i - 1, n]
+                log_q_proposed = self.base_log_prob(x_proposed)
+                log_prob_surrogate_proposed = self.surrogate_intermediate_log_prob(
+                    x_proposed, log_q_proposed, coefficients)
+
+                # Stage 1: screen the proposals with the surrogate.
+                log_acceptance_surrogate = torch.nan_to_num(
+                    log_prob_surrogate_proposed - log_prob_surrogate,
+                    nan=-float("inf"), posinf=-float("inf"))
+                screened = log_acceptance_surrogate > \
+                    -torch.empty_like(log_acceptance_surrogate).exponential_()
+                screened = screened & valid
+
+                # Stage 2: evaluate the target only for the proposals that passed the screen, and
+                # correct for the error of the surrogate.
+                indices = torch.nonzero(screened).squeeze(-1)
+                log_p_proposed = torch.full_like(log_q_proposed, -float("inf"))
+                if indices.shape[0] > 0:
+                    log_p_proposed[indices] = self.target_log_prob(x_proposed[indices]).detach()
+                n_target_evals = n_target_evals + indices.shape[0]
+                point_proposed = Point(x=x_proposed, log_q=log_q_proposed, log_p=log_p_proposed,
+                                       mask=point.mask)
+                log_prob_proposed = self.intermediate_target_log_prob(point_proposed, beta, i)
+                log_acceptance_target = torch.nan_to_num(
+                    (log_prob_proposed - log_prob) -
+                    (log_prob_surrogate_proposed - log_prob_surrogate),
+                    nan=-float("inf"), posinf=-float("inf"))
+                accept = log_acceptance_target > \
+                    -torch.empty_like(log_acceptance_target).exponential_()
+                accept = accept & screened
+                point = point_proposed.where(accept, point)
+                log_prob = torch.where(accept, log_prob_proposed, log_prob)
+                log_prob_surrogate = torch.where(accept, log_prob_surrogate_proposed,
+                                                 log_prob_surrogate)
+
+                n_valid = torch.clamp_min(torch.sum(valid), 1)
+                if i == 1 and n == 0:
+                    self.first_dist_p_accept_surrogate = torch.sum(
+                        torch.exp(torch.clamp_max(log_acceptance_surrogate, 0.0)) * valid
+                    ) / n_valid
+                    self.first_dist_p_accept_target = torch.sum(
+                        torch.exp(torch.clamp_max(log_acceptance_target, 0.0)) * screened
+                    ) / torch.clamp_min(torch.sum(screened), 1)
+                if self.adjust_step_size and not self.eval_mode:
+                    # Tune on the overall acceptance rate of both stages. Branch-free update (too
+                    # much accept -> increase step size), to avoid a sync.
+                    p_accept = torch.sum(accept) / n_valid
+                    multiplier = torch.where(p_accept > self.target_prob_accept, 1.05, 1 / 1.05)
+                    self.noise_scalings[i - 1, n] = self.noise_scalings[i - 1, n] * multiplier
+            if i == 1:
+                self.first_dist_target_evals_per_proposal = n_target_evals / \
+                    (self.n_updates * point.x.shape[0])
         return point
@@ -27,5 +27,28 @@ def test_metropolis(
                              n_samples=batch_size
                              )
 
+
+def test_metropolis__delayed_acceptance(
+        config: TransitionOperatorTestConfig = TransitionOperatorTestConfig(),
+        n_iterations: int = 50,
+        batch_size: int = 64):
+    """Test that delayed acceptance Metropolis (with the flow as the surrogate) can be used to
+    estimate the mean, and that it evaluates the target for fewer points than it proposes."""
+    metropolis_transition = Metropolis(
+        n_ais_intermediate_distributions=config.n_ais_intermediate_distributions,
+        dim=config.dim,
+        base_log_prob=config.learnt_sampler.log_prob,
+        target_log_prob=config.target.log_prob,
+        p_target=config.p_target, alpha=config.alpha, n_updates=5,
+        delayed_acceptance=True)
+    test_transition_operator(transition_operator=metropolis_transition,
+                             config=config,
+                             n_iterations=n_iterations,
+                             n_samples=batch_size
+                             )
+    info = metropolis_transition.get_logging_info()
+    assert 0 < info["dist0_target_evals_per_proposal"] < 1
+
+
 if __name__ == '__main__':
     test_metropolis()
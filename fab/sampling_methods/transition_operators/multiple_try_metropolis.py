@@ -0,0 +1,174 @@
+from typing import Dict, Tuple
+
+import torch
+
+from fab.sampling_methods.transition_operators.base import TransitionOperator
+from fab.types_ import LogProbFunc
+from fab.sampling_methods.base import Point
+
+
+class MultipleTryMetropolis(TransitionOperator):
+    def __init__(self,
+                 n_ais_intermediate_distributions: int,
+                 dim: int,
+                 base_log_prob: LogProbFunc,
+                 target_log_prob: LogProbFunc,
+                 n_updates: int,
+                 n_tries: int = 4,
+                 alpha: float = None,
+                 p_target: bool = False,
+                 step_size: float = 1.0,
+                 adjust_step_size: bool = True,
+                 adapt_covariance: bool = True,
+                 covariance_adaptation_rate: float = 0.05,
+                 target_p_accept: float = 0.5,
+                 eval_mode: bool = False):
+        """
+        Gradient-free multiple-try Metropolis (Liu, Liang & Wong, 2000) with a Gaussian random walk
+        proposal. Each update makes `n_tries` proposals per chain, which are evaluated in a
+        single batched call of the flow and target, and selects one of them in proportion to its
+        intermediate target density. The selection is then accepted or rejected against
+        `n_tries - 1` reference points drawn around it (a second batched call). As doing more work
+        per call is cheap when the per-call overhead dominates, this is the recommended operator
+        for targets that are not differentiable.
+
+        The proposal covariance of each intermediate distribution is step_size^2 * 2.38^2 / dim
+        times the covariance of the chains, estimated with an exponential moving average (with
+        rate `covariance_adaptation_rate`) if `adapt_covariance` is True. The step size of each
+        (intermediate distribution, update) is tuned towards `target_p_accept` if
+        `adjust_step_size` is True.
+        """
+        super(MultipleTryMetropolis, self).__init__(
+            n_ais_intermediate_distributions, dim, base_log_prob, target_log_prob,
+            alpha=alpha, p_target=p_target)
+        assert n_tries > 1
+        self.n_updates = n_updates
+        self.n_tries = n_tries
+        self.adjust_step_size = adjust_step_size
+        self.adapt_covariance = adapt_covariance
+        self.covariance_adaptation_rate = covariance_adaptation_rate
+        self.register_buffer("noise_scalings", torch.full([n_ais_intermediate_distributions,
+                                                           n_updates], step_size))
+        self.register_buffer("x_mean", torch.zeros(n_ais_intermediate_distributions, dim))
+        # Initialise the covariance such that the proposal is isotropic with std `step_size`.
+        self.register_buffer("x_cov", torch.eye(dim).repeat(
+            (n_ais_intermediate_distributions, 1, 1)) * dim / 2.38**2)
+        self.target_prob_accept = target_p_accept
+        self.eval_mode = eval_mode
+        self.first_dist_p_accept = torch.tensor(0.0)
+
+    @property
+    def uses_grad_info(self) -> bool:
+        """Multiple-try Metropolis does not use info on grad of target."""
+        return False
+
+    def set_eval_mode(self, eval_setting: bool):
+        """When eval_mode is turned on, no tuning of the step size or covariance occurs."""
+        self.eval_mode = eval_setting
+
+    def get_logging_info(self) -> Dict:
+        """Return the first and last noise scaling size, and the p_accept of the first AIS
+        distribution for logging."""
+        interesting_dict = {}
+        interesting_dict["noise_scaling_0_0"] = self.noise_scalings[0, 0].cpu().item()
+        interesting_dict["noise_scaling_0_-1"] = self.noise_scalings[0, -1].cpu().item()
+        interesting_dict["dist0_p_accept"] = self.first_dist_p_accept.cpu().item()
+        return interesting_dict
+
+    def proposal_scale_tril(self, i: int) -> torch.Tensor:
+        """Cholesky factor of the (unscaled) proposal covariance for AIS distribution `i`."""
+        cov = self.x_cov[i - 1] * 2.38**2 / self.dim + \
+            1e-6 * torch.eye(self.dim, device=self.x_cov.device)
+        # Avoid `torch.linalg.cholesky`, which checks for errors and so syncs with the host.
+        scale_tril, _ = torch.linalg.cholesky_ex(cov)
+        return scale_tril
+
+    def evaluate(self, x: torch.Tensor, beta: float, i: int) -> Tuple[Point, torch.Tensor]:
+        """Evaluate points x of shape [batch_size, n, dim] in a single call of the flow and
+        target, returning the flattened `Point` and the intermediate log probs of shape
+        [batch_size, n]."""
+        point = self.create_new_point(x.reshape(-1, self.dim))
+        log_prob = self.intermediate_target_log_prob(point, beta, i)
+        log_prob = torch.nan_to_num(log_prob, nan=-float("inf"), posinf=-float("inf"))
+        return point, log_prob.view(x.shape[:-1])
+
+    def transition(self, point: Point, i: int, beta: float) -> Point:
+        """Returns a new Point generated by multiple-try Metropolis."""
+        scale_tril = self.proposal_scale_tril(i)
+        batch_size = point.x.shape[0]
+        valid = point.mask if point.mask is not None else \
+            torch.ones_like(point.log_q, dtype=torch.bool)
+        log_prob = self.intermediate_target_log_prob(point, beta, i)
+
+        for n in range(self.n_updates):
+            noise_scaling = self.noise_scalings[i - 1, n]
+            x = point.x
+            # Make `n_tries` proposals for each chain.
+            noise = torch.randn(batch_size, self.n_tries, self.dim, device=x.device,
+                                dtype=x.dtype)
+            x_tries = x[:, None] + noise_scaling * noise @ scale_tril.T
+            points_tries, log_prob_tries = self.evaluate(x_tries, beta, i)
+
+            # Select one of the tries with probability proportional to its weight, using the
+            # Gumbel-max trick to avoid a host sync.
+            gumbel = -torch.log(torch.empty_like(log_prob_tries).exponential_())
+            selected = torch.argmax(log_prob_tries + gumbel, dim=-1)
+            flat_index = torch.arange(batch_size, device=x.device) * self.n_tries + selected
+            point_selected = points_tries[flat_index]
+            point_selected.mask = point.mask
+            log_prob_selected = log_prob_tries[torch.arange(batch_size, device=x.device),
+                                               selected]
+
+            # Reference points drawn around the selected point, together with the current point.
+            noise = torch.randn(batch_size, self.n_tries - 1, self.dim, device=x.device,
+                                dtype=x.dtype)
+            x_reference = point_selected.x[:, None] + noise_scaling * noise @ scale_tril.T
+            _, log_prob_reference = self.evaluate(x_reference, beta, i)
+            log_prob_reference = torch.cat([log_prob_reference, log_prob[:, None]], dim=-1)
+
+            with torch.no_grad():
+                log_acceptance_prob = torch.logsumexp(log_prob_tries, dim=-1) - \
+                    torch.logsumexp(log_prob_reference, dim=-1)
+                log_acceptance_prob = torch.nan_to_num(log_acceptance_prob, nan=-float("inf"))
+                accept = log_acceptance_prob > \
+                    -torch.empty_like(log_acceptance_prob).exponential_()
+                accept = accept & valid
+                point = point_selected.where(accept, point)
+                log_prob = torch.where(accept, log_prob_selected, log_prob)
+
+                p_accept = torch.sum(torch.exp(torch.clamp_max(log_acceptance_prob, 0.0)) * valid
+                                     ) / torch.clamp_min(torch.sum(valid), 1)
+                if i == 1 and n == 0:
+                    self.first_dist_p_accept = p_accept
+                if self.adjust_step_size and not self.eval_mode:
+                    # Branch-free update (too much accept -> increase step size), to avoid a
+                    # sync.
+                    multiplier = torch.where(p_accept > self.target_prob_accept, 1.05, 1 / 1.05)
+                    self.noise_scalings[i - 1, n] = self.noise_scalings[i - 1, n] * multiplier
+
+        if self.adapt_covariance and not self.eval_mode:
+            # The covariance is only updated after the transition, so it is fixed within an AIS
+            # pass.
+            self.update_covariance(point, i)
+        return point
+
+    def update_covariance(self, point: Point, i: int):
+        """Update the running mean and covariance of the chains for AIS distribution `i`. If
+        `point.mask` is set, then only the valid chains are used."""
+        index = i - 1
+        with torch.no_grad():
+            x = point.x
+            if point.mask is None:
+                weights = torch.full_like(x[:, 0], 1 / x.shape[0])
+            else:
+                weights = point.mask.to(x) / torch.clamp_min(torch.sum(point.mask), 1)
+                x = torch.where(point.mask[:, None], x, torch.zeros_like(x))
+            batch_mean = torch.sum(weights[:, None] * x, dim=0)
+            x_centered = x - batch_mean
+            batch_cov = (weights[:, None] * x_centered).T @ x_centered
+            rate = self.covariance_adaptation_rate
+            delta = batch_mean - self.x_mean[index]
+            # Exponential moving average of the first two moments.
+            self.x_cov[index] = (1 - rate) * (self.x_cov[index] + rate * torch.outer(delta, delta)
+                                              ) + rate * batch_cov
+            self.x_mean[index] = self.x_mean[index] + rate * delta
@@ -0,0 +1,29 @@
+import torch
+
+torch.autograd.set_detect_anomaly(True)
+from fab.sampling_methods.transition_operators import MultipleTryMetropolis
+from fab.sampling_methods.transition_operators.testing_utils import test_transition_operator, \
+    TransitionOperatorTestConfig
+
+
+def test_multiple_try_metropolis(
+        config: TransitionOperatorTestConfig = TransitionOperatorTestConfig(),
+        n_iterations: int = 50,
+        batch_size: int = 64):
+    mtm = MultipleTryMetropolis(
+        n_ais_intermediate_distributions=config.n_ais_intermediate_distributions,
+        dim=config.dim,
+        base_log_prob=config.learnt_sampler.log_prob,
+        target_log_prob=config.target.log_prob,
+        p_target=config.p_target, alpha=config.alpha, n_updates=3, n_tries=4)
+    test_transition_operator(transition_operator=mtm,
+                             config=config,
+                             n_iterations=n_iterations,
+                             n_samples=batch_size
+                             )
+    # The chain covariance has been adapted, and remains positive definite.
+    assert not torch.allclose(mtm.x_cov[0], torch.eye(config.dim) * config.dim / 2.38**2)
+    assert (torch.linalg.eigvalsh(mtm.x_cov) > 0).all()
+
+if __name__ == '__main__':
+    test_multiple_try_metropolis()
@@ -0,0 +1,236 @@
+from typing import Callable, Dict, Union
+
+import torch
+
+from fab.sampling_methods.transition_operators.base import TransitionOperator
+from fab.types_ import LogProbFunc
+from fab.sampling_methods.base import Point
+
+
+def _copy_point(point: Point) -> Point:
+    """Copy of `point` that does not share memory with it (indexing with a tensor copies)."""
+    return point[torch.arange(point.x.shape[0], device=point.device)]
+
+
+class NoUTurnSampler(TransitionOperator):
+    def __init__(self,
+                 n_ais_intermediate_distributions: int,
+                 dim: int,
+                 base_log_prob: LogProbFunc,
+                 target_log_prob: LogProbFunc,
+                 alpha: float = None,
+                 p_target: bool = False,
+                 epsilon: float = 0.5,
+                 n_outer: int = 1,
+                 max_tree_depth: int = 6,
+                 mass_init: Union[float, torch.Tensor] = 1.0,
+                 target_p_accept: float = 0.8,
+                 max_grad: float = 1e3,
+                 max_energy_error: float = 1000.0,
+                 eval_mode: bool = False):
+        """
+        Batched No-U-Turn sampler (NUTS) with multinomial sampling from the trajectory, as in
+        Betancourt (2017). All chains build their trajectories in lockstep: at each doubling
+        every chain extends its trajectory by a subtree of the same size, in its own random
+        direction. Chains whose trajectory makes a U-turn (or diverges) are marked as done, and
+        stop being evaluated, so they no longer cost flow and target gradient evaluations.
+
+        The step size of each (intermediate distribution, outer step) is tuned towards
+        `target_p_accept`, using the average acceptance statistic over the trajectory. The
+        average number of gradient evaluations per chain is logged, for comparison with the
+        `L * n_outer` evaluations of `HamiltonianMonteCarlo`.
+
+        Args:
+            epsilon: Initial step size.
+            n_outer: Number of NUTS transitions per AIS intermediate distribution.
+            max_tree_depth: Max number of trajectory doublings, so a trajectory has at most
+                2**max_tree_depth - 1 leapfrog steps.
+            mass_init: Diagonal of the mass matrix.
+            max_energy_error: Chains with a larger increase in energy along the trajectory are
+                treated as diverging.
+        """
+        super(NoUTurnSampler, self).__init__(
+            n_ais_intermediate_distributions, dim, base_log_prob, target_log_prob,
+            alpha=alpha, p_target=p_target)
+        if isinstance(mass_init, torch.Tensor):
+            assert mass_init.shape == (dim,)  # check mass_init dim is correct if a vector
+        self.register_buffer("epsilons", torch.full([n_ais_intermediate_distributions, n_outer],
+                                                    epsilon))
+        self.register_buffer("mass_vector", torch.ones(dim) * mass_init)
+        self.n_outer = n_outer
+        self.max_tree_depth = max_tree_depth
+        self.target_p_accept = target_p_accept
+        self.max_grad = max_grad  # max grad used when taking steps
+        self.max_energy_error = max_energy_error
+        self.eval_mode = eval_mode  # turn off step size tuning
+        # Logging info, kept on the device until `get_logging_info` is called.
+        self.first_dist_p_accept = torch.tensor(0.0)
+        self.n_grad_evals_per_chain = torch.tensor(0.0)
+
+    @property
+    def uses_grad_info(self) -> bool:
+        return True
+
+    def set_eval_mode(self, eval_setting: bool):
+        """When eval_mode is turned on, no tuning of the step size occurs."""
+        self.eval_mode = eval_setting
+
+    def get_logging_info(self) -> Dict:
+        """Log the step sizes, the p_accept of the first AIS distribution, and the average
+        number of gradient evaluations per chain over the last AIS pass."""
+        interesting_dict = {}
+        interesting_dict["epsilons_dist0_loop0"] = self.epsilons[0, 0].cpu().item()
+        interesting_dict["epsilons_dist-1_loop0"] = self.epsilons[-1, 0].cpu().item()
+        interesting_dict["dist0_p_accept"] = self.first_dist_p_accept.cpu().item()
+        interesting_dict["n_grad_evals_per_chain"] = self.n_grad_evals_per_chain.cpu().item()
+        return interesting_dict
+
+    def kinetic_energy(self, p: torch.Tensor) -> torch.Tensor:
+        return torch.sum(p**2 / self.mass_vector, dim=-1) / 2
+
+    def is_turning(self, p_start: torch.Tensor, p_end: torch.Tensor, rho: torch.Tensor
+                   ) -> torch.Tensor:
+        """Generalised no-U-turn criterion for the trajectory with end momenta `p_start` and
+        `p_end`, and summed momentum `rho`."""
+        return (torch.sum(p_start / self.mass_vector * rho, dim=-1) <= 0) | \
+            (torch.sum(p_end / self.mass_vector * rho, dim=-1) <= 0)
+
+    def transition(self, point: Point, i: int, beta: float) -> Point:
+        """Perform NUTS transition. If `point.mask` is set, then invalid chains are left
+        unchanged. Note that the number of leapfrog steps is data dependent, so unlike the
+        other transition operators this may not be graph-captured in fixed shape mode."""
+
+        def log_prob_fn(point: Point) -> torch.Tensor:
+            return self.intermediate_target_log_prob(point, beta, i)
+
+        def grad_log_prob_fn(point: Point) -> torch.Tensor:
+            grad = self.grad_intermediate_target_log_prob(point, beta, i)
+            return torch.nan_to_num(torch.clamp(grad, max=self.max_grad, min=-self.max_grad),
+                                    nan=0.0, posinf=0.0, neginf=0.0)
+
+        if i == 1:
+            self.n_grad_evals_per_chain = torch.zeros((), device=point.device)
+        for n in range(self.n_outer):
+            point = self.nuts_step(point, log_prob_fn, grad_log_prob_fn, i, n)
+        return point
+
+    def nuts_step(self, point: Point,
+                  log_prob_fn: Callable[[Point], torch.Tensor],
+                  grad_log_prob_fn: Callable[[Point], torch.Tensor],
+                  i: int, n: int) -> Point:
+        """A single NUTS transition, with all chains built in lockstep."""
+        batch_size = point.x.shape[0]
+        epsilon = self.epsilons[i - 1, n]
+        valid = torch.ones_like(point.log_q, dtype=torch.bool) if point.mask is None \
+            else point.mask
+
+        p = torch.randn_like(point.x) * torch.sqrt(self.mass_vector)
+        grad = grad_log_prob_fn(point)
+        initial_energy = -log_prob_fn(point) + self.kinetic_energy(p)
+
+        # Backward ("minus") and forward ("plus") ends of each trajectory.
+        x_minus, p_minus, grad_minus = point.x, p, grad
+        x_plus, p_plus, grad_plus = point.x, p, grad
+        proposal = _copy_point(point)
+        log_w_tree = torch.zeros_like(initial_energy)  # The initial point has weight 1.
+        rho_tree = p
+        active = valid.clone()
+        # Summed acceptance statistic, and number of leaves, used for step size tuning.
+        sum_p_accept = torch.zeros_like(initial_energy)
+        n_leaves = torch.zeros_like(initial_energy)
+        n_grad_evals = torch.zeros((), device=point.device)
+
+        for depth in range(self.max_tree_depth):
+            if not torch.any(active):
+                break
+            forward = torch.rand_like(initial_energy) < 0.5
+            direction = torch.where(forward, 1.0, -1.0)
+            x = torch.where(forward[:, None], x_plus, x_minus)
+            p = torch.where(forward[:, None], p_plus, p_minus)
+            grad = torch.where(forward[:, None], grad_plus, grad_minus)
+
+            # Build a subtree of 2**depth leapfrog steps from the end of the trajectory.
+            subtree_ok = active.clone()
+            proposal_subtree = _copy_point(proposal)
+            log_w_subtree = torch.full_like(initial_energy, -float("inf"))
+            rho_subtree = torch.zeros_like(p)
+            # Start momenta and summed momenta before the start of each (sub-)subtree, which
+            # are used to check for U-turns within the subtree.
+            p_checkpoints = {}
+            rho_checkpoints = {}
+            for k in range(2**depth):
+                indices = torch.nonzero(subtree_ok).squeeze(-1)
+                if indices.shape[0] == 0:
+                    break
+                step_size = (epsilon * direction[indices])[:, None]
+                p_half = p[indices] + step_size * grad[indices] / 2
+                x_new = x[indices] + step_size / self.mass_vector * p_half
+                leaf = self.create_new_point(x_new)
+                grad_new = grad_log_prob_fn(leaf)
+                p_new = p_half + step_size * grad_new / 2
+                n_grad_evals = n_grad_evals + indices.shape[0]
+                x[indices], p[indices], grad[indices] = x_new, p_new, grad_new
+
+                with torch.no_grad():
+                    log_w_leaf = initial_energy[indices] + log_prob_fn(leaf) - \
+                        self.kinetic_energy(p_new)
+                    log_w_leaf = torch.nan_to_num(log_w_leaf, nan=-float("inf"),
+                                                  posinf=-float("inf"))
+                    diverging = ~(log_w_leaf > -self.max_energy_error)
+                    sum_p_accept[indices] += torch.exp(torch.clamp_max(log_w_leaf, 0.0))
+                    n_leaves[indices] += 1
+
+                    # Progressive multinomial sampling of the proposal within the subtree.
+                    log_w_subtree_new = torch.logaddexp(log_w_subtree[indices], log_w_leaf)
+                    take_leaf = torch.rand_like(log_w_leaf) < \
+                        torch.exp(log_w_leaf - log_w_subtree_new)
+                    proposal_subtree[indices[take_leaf]] = leaf[take_leaf]
+                    log_w_subtree[indices] = log_w_subtree_new
+
+                    # Check for U-turns in each (sub-)subtree ending at this leaf.
+                    rho_subtree[indices] += p_new
+                    for level in range(1, depth + 1):
+                        if k % 2**level == 0:
+                            p_checkpoints[level] = p.clone()
+                            rho_checkpoints[level] = rho_subtree - p
+                    turning = torch.zeros_like(subtree_ok)
+                    for level in range(1, depth + 1):
+                        if (k + 1) % 2**level == 0:
+                            turning = turning | self.is_turning(
+                                p_checkpoints[level], p, rho_subtree - rho_checkpoints[level])
+                    subtree_ok[indices] = subtree_ok[indices] & ~diverging
+                    subtree_ok = subtree_ok & ~turning
+
+            with torch.no_grad():
+                # Chains whose subtree made a U-turn or diverged are done, and the subtree is
+                # not used. Otherwise, the subtree is merged into the trajectory, with biased
+                # progressive sampling of the proposal.
+                merged = subtree_ok
+                take_subtree = merged & (torch.rand_like(log_w_tree) <
+                                         torch.exp(log_w_subtree - log_w_tree))
+                proposal[take_subtree] = proposal_subtree[take_subtree]
+                log_w_tree = torch.where(merged, torch.logaddexp(log_w_tree, log_w_subtree),
+                                         log_w_tree)
+                rho_tree = torch.where(merged[:, None], rho_tree + rho_subtree, rho_tree)
+                merged_forward = (merged & forward)[:, None]
+                merged_backward = (merged & ~forward)[:, None]
+                x_plus = torch.where(merged_forward, x, x_plus)
+                p_plus = torch.where(merged_forward, p, p_plus)
+                grad_plus = torch.where(merged_forward, grad, grad_plus)
+                x_minus = torch.where(merged_backward, x, x_minus)
+                p_minus = torch.where(merged_backward, p, p_minus)
+                grad_minus = torch.where(merged_backward, grad, grad_minus)
+                active = merged & ~self.is_turning(p_minus, p_plus, rho_tree)
+
+        with torch.no_grad():
+            p_accept_chain = sum_p_accept / torch.clamp_min(n_leaves, 1)
+            p_accept = torch.sum(p_accept_chain * valid) / torch.clamp_min(torch.sum(valid), 1)
+            self.n_grad_evals_per_chain = self.n_grad_evals_per_chain + \
+                n_grad_evals / batch_size
+            if i == 1 and n == 0:
+                self.first_dist_p_accept = p_accept
+            if not self.eval_mode:
+                # Branch-free update (too much accept -> increase step size), to avoid a sync.
+                multiplier = torch.where(p_accept > self.target_p_accept, 1.05, 1 / 1.05)
+                self.epsilons[i - 1, n] = self.epsilons[i - 1, n] * multiplier
+        return proposal
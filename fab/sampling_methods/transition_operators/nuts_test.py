@@ -0,0 +1,34 @@
+import torch
+
+torch.autograd.set_detect_anomaly(True)
+from fab.sampling_methods.transition_operators import NoUTurnSampler
+from fab.sampling_methods.transition_operators.testing_utils import test_transition_operator, \
+    TransitionOperatorTestConfig
+
+
+def test_nuts(
+        config: TransitionOperatorTestConfig = TransitionOperatorTestConfig(),
+        n_iterations: int = 20,
+        batch_size: int = 64):
+    max_tree_depth = 5
+    nuts = NoUTurnSampler(
+        n_ais_intermediate_distributions=config.n_ais_intermediate_distributions,
+        dim=config.dim,
+        base_log_prob=config.learnt_sampler.log_prob,
+        target_log_prob=config.target.log_prob,
+        alpha=config.alpha,
+        p_target=config.p_target,
+        epsilon=1.0,
+        max_tree_depth=max_tree_depth)
+    test_transition_operator(transition_operator=nuts,
+                             config=config,
+                             n_iterations=n_iterations,
+                             n_samples=batch_size
+                             )
+    # Each chain has at least one, and at most 2**max_tree_depth - 1 leapfrog steps per transition.
+    n_grad_evals = nuts.get_logging_info()["n_grad_evals_per_chain"]
+    assert config.n_ais_intermediate_distributions <= n_grad_evals <= \
+           config.n_ais_intermediate_distributions * (2**max_tree_depth - 1)
+
+if __name__ == '__main__':
+    test_nuts()
@@ -1 +1 @@
-from fab.target_distributions.base import TargetDistribution
\ No newline at end of file
+from fab.target_distributions.base import TargetDistribution, PerformanceMetricsAccumulator
\ No newline at end of file
@@ -1,8 +1,70 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 
 import abc
 import torch
 from fab.types_ import LogProbFunc
+from fab.utils.numerical import ImportanceWeightAccumulator
+
+
+class PerformanceMetricsAccumulator(abc.ABC):
+    """Computes `TargetDistribution.performance_metrics` over a stream of batches of samples and
+    log weights, so that very large evaluation sets may be used."""
+
+    @abc.abstractmethod
+    def update(self, samples: torch.Tensor, log_w: torch.Tensor) -> None:
+        """Add a batch of samples & log weights from the trained model."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def result(self) -> Dict:
+        """Return the performance metrics over all batches passed to `update`."""
+        raise NotImplementedError
+
+
+class ConcatenatingPerformanceMetrics(PerformanceMetricsAccumulator):
+    """Fallback accumulator that stores all of the batches, and computes the performance metrics
+    once over the concatenated batches. This does NOT run in constant memory, and is only used for
+    targets that do not define their own `PerformanceMetricsAccumulator`."""
+    def __init__(self, target: "TargetDistribution",
+                 log_q_fn: Optional[LogProbFunc] = None,
+                 batch_size: Optional[int] = None):
+        self.target = target
+        self.log_q_fn = log_q_fn
+        self.batch_size = batch_size
+        self.samples: List[torch.Tensor] = []
+        self.log_w: List[torch.Tensor] = []
+
+    def update(self, samples: torch.Tensor, log_w: torch.Tensor) -> None:
+        self.samples.append(samples.detach().cpu())
+        self.log_w.append(log_w.detach().cpu())
+
+    def result(self) -> Dict:
+        return self.target.performance_metrics(torch.cat(self.samples, dim=0),
+                                               torch.cat(self.log_w, dim=0),
+                                               self.log_q_fn, self.batch_size)
+
+
+class ExpectationPerformanceMetrics(PerformanceMetricsAccumulator):
+    """Computes the performance metrics of targets with a known expectation (e.g. `GMM` or
+    `Gaussian`) online, over a stream of batches."""
+    def __init__(self, target: "TargetDistribution", log_q_fn: Optional[LogProbFunc] = None):
+        self.target = target
+        self.log_q_fn = log_q_fn
+        self.expectation_accumulator = ImportanceWeightAccumulator()
+        self.expectation_no_correction_accumulator = ImportanceWeightAccumulator()
+
+    def update(self, samples: torch.Tensor, log_w: torch.Tensor) -> None:
+        f_x = self.target.expectation_function(samples)
+        self.expectation_accumulator.update(log_w, f_x)
+        self.expectation_no_correction_accumulator.update(torch.ones_like(log_w), f_x)
+
+    def result(self) -> Dict:
+        bias_normed = self.target.normed_bias(self.expectation_accumulator.expectation)
+        bias_no_correction = self.target.normed_bias(
+            self.expectation_no_correction_accumulator.expectation)
+        return self.target.summarise_performance_metrics(bias_normed, bias_no_correction,
+                                                         self.log_q_fn)
+
 
 class TargetDistribution(abc.ABC):
 
@@ -31,6 +93,38 @@ class TargetDistribution(abc.ABC):
         """
         raise NotImplementedError
 
+    def performance_metrics_accumulator(self, log_q_fn: Optional[LogProbFunc] = None,
+                                        batch_size: Optional[int] = None
+                                        ) -> PerformanceMetricsAccumulator:
+        """Returns an accumulator that computes the same metrics as `performance_metrics` over a
+        stream of batches (e.g. from `AnnealedImportanceSampler.generate_eval_data_stream`).
+        Targets that can compute their performance metrics online should override this, by default
+        the batches are concatenated."""
+        return ConcatenatingPerformanceMetrics(self, log_q_fn, batch_size)
+
+    @property
+    def has_analytic_grad(self) -> bool:
+        """Whether `log_prob_and_grad` is implemented. If so, it is used by `create_point` (and
+        hence the transition operators) instead of differentiating `log_prob` with autograd."""
+        return False
+
+    def log_prob_and_grad(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns `log_prob(x)` and its gradient w.r.t. x, computed in closed form. Only
+        defined if `has_analytic_grad` is True."""
+        raise NotImplementedError
+
+    @property
+    def block_indices(self) -> Optional[torch.Tensor]:
+        """If the target factorises over blocks of dimensions, log p(x) = sum_b log p_b(x_b), this
+        returns the dimension indices of each block, of shape [n_blocks, block_dim], where each
+        dimension is in exactly one block. Otherwise returns None. See `log_prob_blocks`."""
+        return None
+
+    def log_prob_blocks(self, x: torch.Tensor) -> torch.Tensor:
+        """Returns the per-block log probs log p_b(x_b), of shape [batch_size, n_blocks], which
+        sum to `log_prob(x)`. Only defined if `block_indices` is not None."""
+        raise NotImplementedError
+
 
     def sample(self, shape):
         raise NotImplementedError
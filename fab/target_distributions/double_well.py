@@ -57,6 +57,17 @@ class DoubleWellEnergy(Energy, nn.Module):
     def log_prob(self, x):
         return torch.squeeze(-self.energy(x))
 
+    @property
+    def has_analytic_grad(self) -> bool:
+        return True
+
+    def log_prob_and_grad(self, x):
+        """Log prob and its gradient w.r.t. x, computed in closed form."""
+        x_1 = x[:, 0]
+        x_2 = x[:, 1]
+        grad_x_1 = -(self._a + 2 * self._b * x_1 + 4 * self._c * x_1.pow(3))
+        return torch.squeeze(-self.energy(x)), torch.stack([grad_x_1, -x_2], dim=-1)
+
     def sample_first_dimension(self, shape):
         assert len(shape) == 1
         # see fab.sampling_methods.rejection_sampling_test.py
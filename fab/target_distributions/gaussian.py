@@ -1,10 +1,11 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 from fab.types_ import LogProbFunc
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as f
-from fab.target_distributions.base import TargetDistribution
+from fab.target_distributions.base import TargetDistribution, PerformanceMetricsAccumulator, \
+    ExpectationPerformanceMetrics
 from fab.utils.numerical import MC_estimate_true_expectation, quadratic_function, \
     importance_weighted_expectation, effective_sample_size_over_p
 
@@ -60,12 +61,26 @@ class Gaussian(nn.Module, TargetDistribution):
         log_prob = log_prob + mask
         return log_prob
 
+    @property
+    def has_analytic_grad(self) -> bool:
+        return True
+
+    def log_prob_and_grad(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Log prob and its gradient w.r.t. x, -Sigma^-1 (x - mu), computed in closed form."""
+        log_prob = self.log_prob(x)
+        diff = torch.linalg.solve_triangular(self.scale_tril, (x - self.locs).T, upper=False)
+        grad = -torch.linalg.solve_triangular(self.scale_tril.T, diff, upper=True).T
+        return log_prob, grad
+
     def sample(self, shape=(1,)):
         return self.distribution.sample(shape)
 
     def evaluate_expectation(self, samples, log_w):
         expectation = importance_weighted_expectation(self.expectation_function,
                                                          samples, log_w)
+        return self.normed_bias(expectation)
+
+    def normed_bias(self, expectation):
         true_expectation = self.true_expectation.to(expectation.device)
         bias_normed = (expectation - true_expectation) / true_expectation
         return bias_normed
@@ -75,6 +90,16 @@ class Gaussian(nn.Module, TargetDistribution):
                             batch_size: Optional[int] = None) -> Dict:
         bias_normed = self.evaluate_expectation(samples, log_w)
         bias_no_correction = self.evaluate_expectation(samples, torch.ones_like(log_w))
+        return self.summarise_performance_metrics(bias_normed, bias_no_correction, log_q_fn)
+
+    def performance_metrics_accumulator(self, log_q_fn: Optional[LogProbFunc] = None,
+                                        batch_size: Optional[int] = None
+                                        ) -> PerformanceMetricsAccumulator:
+        return ExpectationPerformanceMetrics(self, log_q_fn)
+
+    def summarise_performance_metrics(self, bias_normed: torch.Tensor,
+                                      bias_no_correction: torch.Tensor,
+                                      log_q_fn: Optional[LogProbFunc] = None) -> Dict:
         if log_q_fn:
             log_q_test = log_q_fn(self.test_set)
             log_p_test = self.log_prob(self.test_set)
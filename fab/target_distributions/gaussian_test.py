@@ -0,0 +1,16 @@
+import torch
+
+from fab.sampling_methods.base import grad_and_value
+from fab.target_distributions.gaussian import Gaussian
+
+
+def test_gaussian__log_prob_and_grad(dim: int = 3, batch_size: int = 10):
+    """Check the closed form gradient against autograd."""
+    torch.manual_seed(0)
+    target = Gaussian(mean=torch.randn(dim), use_gpu=False,
+                      true_expectation_estimation_n_samples=1000)
+    x = torch.randn(batch_size, dim)
+    log_prob, grad = target.log_prob_and_grad(x)
+    grad_autograd, log_prob_autograd = grad_and_value(x, target.log_prob)
+    torch.testing.assert_close(log_prob, log_prob_autograd)
+    torch.testing.assert_close(grad, grad_autograd)
@@ -1,11 +1,11 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 
 import numpy as np
 
 from fab.types_ import LogProbFunc
 
 import torch
-from fab.target_distributions.base import TargetDistribution
+from fab.target_distributions.base import TargetDistribution, PerformanceMetricsAccumulator
 from fab.utils.training import DatasetIterator
 from fab.sampling_methods import AnnealedImportanceSampler, HamiltonianMonteCarlo
 from fab.wrappers.torch import WrappedTorchDist
@@ -60,10 +60,14 @@ class ManyWellEnergy(DoubleWellEnergy, TargetDistribution):
 
     def sample(self, shape):
         """Sample by sampling each pair of dimensions from the double well problem
-        using rejection sampling for the first dimension, and exact sampling for the second. """
-        return torch.concat([super(ManyWellEnergy, self).sample(shape)
-                             for _ in range(self.n_wells)],
-                            dim=-1)
+        using rejection sampling for the first dimension, and exact sampling for the second.
+        The first dimensions of all wells are i.i.d., so they are drawn in a single rejection
+        sampling call."""
+        assert len(shape) == 1
+        dim1_samples = self.sample_first_dimension((shape[0] * self.n_wells,))
+        dim2_samples = torch.randn(shape[0] * self.n_wells, device=dim1_samples.device,
+                                   dtype=dim1_samples.dtype)
+        return torch.stack([dim1_samples, dim2_samples], dim=-1).reshape(shape[0], self.dim)
 
     def get_modes_test_set_iterator(self, batch_size: int):
         """Test set created from points manually placed near each mode."""
@@ -78,17 +82,41 @@ class ManyWellEnergy(DoubleWellEnergy, TargetDistribution):
         return DatasetIterator(batch_size=batch_size, dataset=test_set,
                                device=self.device)
 
+    def _log_prob_wells(self, x: torch.Tensor) -> torch.Tensor:
+        """Unnormalised log prob of each well, of shape [batch_size, n_wells], evaluated for all
+        wells in a single batched call."""
+        return super(ManyWellEnergy, self).log_prob(x.reshape(-1, 2)).reshape(
+            x.shape[0], self.n_wells)
+
     def log_prob(self, x):
-        log_prob = torch.sum(
-            torch.stack(
-                [super(ManyWellEnergy, self).log_prob(x[:, i*2:i*2+2])
-                 for i in range(self.n_wells)]),
-            dim=0)
+        log_prob = torch.sum(self._log_prob_wells(x), dim=-1)
         if self.normalised:
             return log_prob - self.log_Z
         else:
             return log_prob
 
+    def log_prob_and_grad(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Log prob and its gradient w.r.t. x, computed in closed form for all wells in a single
+        batched call."""
+        log_prob, grad = super(ManyWellEnergy, self).log_prob_and_grad(x.reshape(-1, 2))
+        log_prob = torch.sum(log_prob.reshape(x.shape[0], self.n_wells), dim=-1)
+        if self.normalised:
+            log_prob = log_prob - self.log_Z
+        return log_prob, grad.reshape(x.shape)
+
+    @property
+    def block_indices(self) -> torch.Tensor:
+        """Each well (pair of dimensions) is an independent block."""
+        return torch.arange(self.dim).view(self.n_wells, 2)
+
+    def log_prob_blocks(self, x: torch.Tensor) -> torch.Tensor:
+        """Log prob of each well, evaluated for all wells in a single batched call."""
+        log_prob = self._log_prob_wells(x)
+        if self.normalised:
+            return log_prob - self.log_Z_2D
+        else:
+            return log_prob
+
     def log_prob_2D(self, x):
         # for plotting, given 2D x
         return super(ManyWellEnergy, self).log_prob(x)
@@ -99,12 +127,35 @@ class ManyWellEnergy(DoubleWellEnergy, TargetDistribution):
 
         del samples
         n_runs = 50
-        n_vals_per_split = log_w.shape[0] // n_runs
+        n_samples = log_w.shape[0]
+        n_vals_per_split = n_samples // n_runs
         log_w = log_w[:n_vals_per_split*n_runs]
         log_w = torch.stack(log_w.split(n_runs), dim=-1)
 
         # Check accuracy in estimating normalisation constant.
         log_Z_estimate = torch.logsumexp(log_w, dim=-1) - np.log(log_w.shape[-1])
+        info = self.log_Z_estimate_metrics(log_Z_estimate)
+
+        if log_q_fn is not None:
+            # Used later for estimation of test set probabilities.
+            assert batch_size is not None
+            info.update(self.test_set_metrics(log_q_fn, batch_size,
+                                              self.n_test_set_batches(n_samples, batch_size)))
+        return info
+
+    @staticmethod
+    def n_test_set_batches(n_samples: int, batch_size: int) -> int:
+        """Number of batches of exact samples in the test set, such that it has (about) as many
+        samples as were used for evaluation."""
+        return max(n_samples // batch_size, 1)
+
+    def performance_metrics_accumulator(self, log_q_fn: Optional[LogProbFunc] = None,
+                                        batch_size: Optional[int] = None
+                                        ) -> PerformanceMetricsAccumulator:
+        return ManyWellPerformanceMetrics(self, log_q_fn, batch_size)
+
+    def log_Z_estimate_metrics(self, log_Z_estimate: torch.Tensor) -> Dict:
+        """Metrics for the accuracy of a set of estimates of the normalisation constant."""
         relative_error = torch.exp(log_Z_estimate - self.log_Z) - 1
         MSE_Z_estimate = torch.mean(torch.abs(relative_error))
 
@@ -113,39 +164,77 @@ class ManyWellEnergy(DoubleWellEnergy, TargetDistribution):
         info = {}
         info.update(relative_MSE_Z_estimate=MSE_Z_estimate.cpu().item())
         info.update(abs_MSE_log_Z_estimate=abs_MSE_log_Z_estimate.cpu().item())
+        return info
 
-        if log_q_fn is not None:
-            # Used later for estimation of test set probabilities.
-            assert batch_size is not None
-            n_batches = max(log_w.shape[0] // batch_size, 1)
-
-            sum_log_prob = 0.0
-            sum_log_prob_exact = 0.0
-            sum_kl_exact = 0.0
-            test_set_iterator_modes = self.get_modes_test_set_iterator(batch_size=batch_size)
-
-            for x in test_set_iterator_modes:
-                # Mode test set.
-                log_q_x_modes = torch.sum(log_q_fn(x)).detach().cpu()
-                sum_log_prob += log_q_x_modes
-
-            for _ in range(n_batches):
-                # Samples from p test set.
-                x_exact = self.sample((batch_size,))
-                log_q_x_exact = log_q_fn(x_exact)
-                sum_log_prob_exact += torch.sum(log_q_x_exact).detach().cpu()
-                sum_kl_exact += torch.sum(self.log_prob(x_exact) - self.log_Z - log_q_x_exact).detach().cpu()
-
-            eval_batch_size = batch_size * n_batches
-
-            info.update(
-                test_set_modes_mean_log_prob=(sum_log_prob / test_set_iterator_modes.test_set_n_points).cpu().item(),
-                test_set_exact_mean_log_prob=(sum_log_prob_exact / eval_batch_size).cpu().item(),
-                forward_kl=(sum_kl_exact / eval_batch_size).cpu().item(),
-                eval_batch_size=eval_batch_size
-            )
+    def test_set_metrics(self, log_q_fn: LogProbFunc, batch_size: int, n_batches: int) -> Dict:
+        """Metrics of the trained model over the modes test set and exact samples from the
+        target."""
+        sum_log_prob = 0.0
+        sum_log_prob_exact = 0.0
+        sum_kl_exact = 0.0
+        test_set_iterator_modes = self.get_modes_test_set_iterator(batch_size=batch_size)
+
+        for x in test_set_iterator_modes:
+            # Mode test set.
+            log_q_x_modes = torch.sum(log_q_fn(x)).detach().cpu()
+            sum_log_prob += log_q_x_modes
+
+        for _ in range(n_batches):
+            # Samples from p test set.
+            x_exact = self.sample((batch_size,))
+            log_q_x_exact = log_q_fn(x_exact)
+            sum_log_prob_exact += torch.sum(log_q_x_exact).detach().cpu()
+            sum_kl_exact += torch.sum(self.log_prob(x_exact) - self.log_Z - log_q_x_exact).detach().cpu()
+
+        eval_batch_size = batch_size * n_batches
+
+        return dict(
+            test_set_modes_mean_log_prob=(sum_log_prob / test_set_iterator_modes.test_set_n_points).cpu().item(),
+            test_set_exact_mean_log_prob=(sum_log_prob_exact / eval_batch_size).cpu().item(),
+            forward_kl=(sum_kl_exact / eval_batch_size).cpu().item(),
+            eval_batch_size=eval_batch_size
+        )
+
+
+class ManyWellPerformanceMetrics(PerformanceMetricsAccumulator):
+    """Computes `ManyWellEnergy.performance_metrics` online, over a stream of batches. As in
+    `ManyWellEnergy.performance_metrics`, the samples are divided into `n_runs`, where sample i
+    belongs to run i % n_runs, and the normalisation constant is estimated separately for each run.
+    """
+    def __init__(self, target: ManyWellEnergy,
+                 log_q_fn: Optional[LogProbFunc] = None,
+                 batch_size: Optional[int] = None,
+                 n_runs: int = 50):
+        self.target = target
+        self.log_q_fn = log_q_fn
+        self.batch_size = batch_size
+        self.n_runs = n_runs
+        self.log_sum_w = torch.full((n_runs,), -float("inf"))
+        self.n_per_run = torch.zeros(n_runs)
+        self.n_total = 0
+
+    def update(self, samples: torch.Tensor, log_w: torch.Tensor) -> None:
+        run_index = (torch.arange(log_w.shape[0]) + self.n_total) % self.n_runs
+        log_w = log_w.detach().cpu().to(self.log_sum_w.dtype)
+        # Per-run logsumexp of this batch, via a scatter over the max-shifted weights.
+        max_log_w = torch.max(log_w)
+        if torch.isfinite(max_log_w):
+            sum_w = torch.zeros(self.n_runs, dtype=log_w.dtype).index_add_(
+                0, run_index, torch.exp(log_w - max_log_w))
+            self.log_sum_w = torch.logaddexp(self.log_sum_w, torch.log(sum_w) + max_log_w)
+        self.n_per_run += torch.bincount(run_index, minlength=self.n_runs)
+        self.n_total += log_w.shape[0]
+
+    def result(self) -> Dict:
+        log_Z_estimate = self.log_sum_w - torch.log(self.n_per_run)
+        info = self.target.log_Z_estimate_metrics(log_Z_estimate)
+        if self.log_q_fn is not None:
+            assert self.batch_size is not None
+            n_batches = self.target.n_test_set_batches(self.n_total, self.batch_size)
+            info.update(self.target.test_set_metrics(self.log_q_fn, self.batch_size, n_batches))
         return info
 
+
 if __name__ == '__main__':
     from fab.utils.plotting import plot_contours, plot_marginal_pair
     import matplotlib.pyplot as plt
@@ -1,4 +1,5 @@
 from fab.target_distributions.many_well import ManyWellEnergy
+from fab.sampling_methods.base import grad_and_value
 import torch
 import matplotlib.pyplot as plt
 
@@ -30,5 +31,65 @@ def test_many_well(dim: int = 6):
     print(target.performance_metrics(samples=samples, log_w=torch.ones(samples.shape[0]),
                                log_q_fn=target.log_prob, batch_size=500))
 
+def test_many_well__log_prob_blocks(dim: int = 8, batch_size: int = 10):
+    for normalised in [False, True]:
+        target = ManyWellEnergy(dim, use_gpu=False, normalised=normalised)
+        x = torch.randn(batch_size, dim)
+        log_prob_blocks = target.log_prob_blocks(x)
+        assert log_prob_blocks.shape == (batch_size, target.block_indices.shape[0])
+        torch.testing.assert_close(torch.sum(log_prob_blocks, dim=-1), target.log_prob(x))
+
+
+def test_many_well__log_prob_and_grad(dim: int = 8, batch_size: int = 10):
+    """Check the closed form gradient against autograd."""
+    for normalised in [False, True]:
+        target = ManyWellEnergy(dim, use_gpu=False, normalised=normalised)
+        x = torch.randn(batch_size, dim)
+        log_prob, grad = target.log_prob_and_grad(x)
+        grad_autograd, log_prob_autograd = grad_and_value(x, target.log_prob)
+        torch.testing.assert_close(log_prob, log_prob_autograd)
+        torch.testing.assert_close(grad, grad_autograd)
+
+
+def test_many_well__sample(dim: int = 8, batch_size: int = 1000):
+    """Check the shape of the (vectorised) exact samples, and that each well is sampled with
+    the marginal statistics of the double well."""
+    torch.manual_seed(0)
+    target = ManyWellEnergy(dim, use_gpu=False)
+    samples = target.sample((batch_size,))
+    assert samples.shape == (batch_size, dim)
+    assert torch.isfinite(target.log_prob(samples)).all()
+    # The second dimension of each well is a standard normal.
+    torch.testing.assert_close(torch.std(samples[:, 1::2], dim=0),
+                               torch.ones(dim // 2), atol=0.1, rtol=0.0)
+    # The deep well (x_1 > 0) has ~84% of the mass of each well.
+    torch.testing.assert_close((samples[:, ::2] > 0).float().mean(dim=0),
+                               torch.full((dim // 2,), 0.844), atol=0.05, rtol=0.0)
+
+
+def test_many_well__performance_metrics_accumulator(dim: int = 4, n_samples: int = 500,
+                                                    batch_size: int = 50):
+    """Check that the streaming metrics match `performance_metrics`, including the size of the
+    test set of exact samples."""
+    torch.manual_seed(0)
+    target = ManyWellEnergy(dim, use_gpu=False)
+    flow = torch.distributions.MultivariateNormal(loc=torch.zeros(dim), scale_tril=torch.eye(dim))
+    samples = flow.sample((n_samples,))
+    log_w = target.log_prob(samples) - flow.log_prob(samples)
+
+    torch.manual_seed(1)
+    info = target.performance_metrics(samples, log_w, log_q_fn=flow.log_prob,
+                                      batch_size=batch_size)
+    accumulator = target.performance_metrics_accumulator(flow.log_prob, batch_size=batch_size)
+    for samples_batch, log_w_batch in zip(samples.split(batch_size), log_w.split(batch_size)):
+        accumulator.update(samples_batch, log_w_batch)
+    torch.manual_seed(1)
+    info_streaming = accumulator.result()
+    assert info["eval_batch_size"] == n_samples
+    assert info.keys() == info_streaming.keys()
+    for key in info:
+        torch.testing.assert_close(torch.tensor(info_streaming[key]), torch.tensor(info[key]))
+
+
 if __name__ == '__main__':
     test_many_well(32)
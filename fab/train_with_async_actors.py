@@ -0,0 +1,237 @@
+from typing import Any, Dict, List, NamedTuple, Optional
+import copy
+import queue
+import threading
+from time import time
+
+import torch
+
+from fab.core import FABModel
+from fab.train_with_prioritised_buffer import PrioritisedBufferTrainer
+from fab.utils.buffer_storage import stored_sample_log_probs
+
+
+class ActorBatch(NamedTuple):
+    """A batch of AIS samples generated by an actor, with the version of the flow weights that
+    was used to generate it. If the buffer stores x in reduced precision, then `log_q` is that of
+    the rounded x under the actor's flow."""
+    x: torch.Tensor
+    log_w: torch.Tensor
+    log_q: torch.Tensor
+    weights_version: int
+    info: Dict[str, Any]
+
+
+class AsyncPrioritisedBufferTrainer(PrioritisedBufferTrainer):
+    """A `PrioritisedBufferTrainer` where AIS runs in background actor threads, concurrently with
+    the gradient steps of the learner (the main thread).
+
+    Each actor has its own copy of the flow, AIS sampler and transition operator (the target is
+    shared), and runs AIS in a loop, pushing the batches into a bounded queue. The learner
+    publishes a snapshot of the flow weights every `weight_sync_period` iterations, which the
+    actors load before their next AIS call. At each iteration the learner adds all the batches in
+    the queue to the buffer (without waiting for new ones), and then takes
+    `n_batches_buffer_sampling` gradient steps on replay batches as usual.
+
+    The samples are generated with stale flow weights. As the log q under the actor's weights is
+    stored in the buffer as `log_q_old`, this is corrected for by the existing importance weight
+    adjustment of the replay loss. If the buffer stores x in reduced precision, then the actor
+    re-evaluates log q at the rounded x with its own flow, rather than the learner doing so with
+    the current flow, which would lose the staleness correction. The staleness (number of learner iterations since the weights
+    used by the newest batch were published), and the actor and learner throughput, are logged.
+
+    On CUDA each actor uses its own stream, so that AIS and the gradient steps may overlap.
+    """
+    def __init__(self,
+                 model: FABModel,
+                 *args,
+                 n_actors: int = 1,
+                 queue_size: int = 4,
+                 weight_sync_period: int = 1,
+                 **kwargs):
+        """
+        Args:
+            n_actors: Number of actor threads running AIS.
+            queue_size: Max number of batches waiting to be added to the buffer. Actors block
+                when the queue is full.
+            weight_sync_period: Number of learner iterations between publishing the flow weights
+                to the actors.
+            For other args see `PrioritisedBufferTrainer`.
+        """
+        super(AsyncPrioritisedBufferTrainer, self).__init__(model, *args, **kwargs)
+        assert n_actors > 0
+        self.n_actors = n_actors
+        self.weight_sync_period = weight_sync_period
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._weights_lock = threading.Lock()
+        self._weights_snapshot: Dict[str, torch.Tensor] = {}
+        self._weights_version = 0
+        self._learner_iteration = 0
+        self._actor_models: List[FABModel] = []
+        self._actor_threads: List[threading.Thread] = []
+        self._actor_error: Optional[BaseException] = None
+        self._n_samples_generated = 0
+        self._last_actor_info: Optional[Dict[str, Any]] = None
+        self._last_collect_time: Optional[float] = None
+
+    def publish_weights(self) -> None:
+        """Publish a snapshot of the current flow weights to the actors."""
+        snapshot = {name: value.detach().clone()
+                    for name, value in self.model.flow.state_dict().items()}
+        with self._weights_lock:
+            self._weights_snapshot = snapshot
+            self._weights_version = self._learner_iteration
+
+    def make_actor_model(self) -> FABModel:
+        """Copy the model for use by an actor. The target distribution is shared rather than
+        copied."""
+        memo = {id(self.model.target_distribution): self.model.target_distribution}
+        actor_model = copy.deepcopy(self.model, memo)
+        for parameter in actor_model.flow.parameters():
+            parameter.requires_grad_(False)
+        return actor_model
+
+    def generate_batch(self, actor_model: FABModel, batch_size: int, weights_version: int
+                       ) -> ActorBatch:
+        """Run AIS with `actor_model`. If the buffer stores x in reduced precision, then log q is
+        re-evaluated at the rounded x with the actor's flow, which generated the samples."""
+        point, log_w = actor_model.annealed_importance_sampler.sample_and_log_weights(batch_size)
+        x = point.x.detach()
+        log_q, _, buffer_info = stored_sample_log_probs(
+            x, self.buffer.x_dtype, point.log_q.detach(), actor_model.flow.log_prob)
+        return ActorBatch(x=x, log_w=log_w.detach(), log_q=log_q,
+                          weights_version=weights_version,
+                          info=dict(actor_model.get_iter_info(), **buffer_info))
+
+    def actor_loop(self, actor_model: FABModel, batch_size: int) -> None:
+        """Run AIS with `actor_model` until the trainer is stopped, pushing the batches into the
+        queue."""
+        stream = torch.cuda.Stream(self.flow_device) if self.flow_device.type == "cuda" \
+            else None
+        # The weights are loaded, and the batches are used by the learner, on the default stream.
+        default_stream = torch.cuda.default_stream(self.flow_device) if stream is not None \
+            else None
+        weights_version = -1
+        try:
+            while not self._stop_event.is_set():
+                with self._weights_lock:
+                    if self._weights_version != weights_version:
+                        actor_model.flow.load_state_dict(self._weights_snapshot)
+                        weights_version = self._weights_version
+                if stream is not None:
+                    # Make sure the weights have been copied before AIS uses them.
+                    stream.wait_stream(default_stream)
+                    with torch.cuda.stream(stream):
+                        batch = self.generate_batch(actor_model, batch_size, weights_version)
+                    # Make sure the batch is ready before it is used on the learner's stream, and
+                    # that its memory (allocated on the side stream) is not reused before then.
+                    stream.synchronize()
+                    for tensor in (batch.x, batch.log_w, batch.log_q):
+                        tensor.record_stream(default_stream)
+                else:
+                    batch = self.generate_batch(actor_model, batch_size, weights_version)
+                while not self._stop_event.is_set():
+                    try:
+                        self._queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except BaseException as e:
+            self._actor_error = e
+            self._stop_event.set()
+
+    def start_actors(self, batch_size: int) -> None:
+        self._stop_event.clear()
+        self.publish_weights()
+        self._actor_models = [self.make_actor_model() for _ in range(self.n_actors)]
+        self._actor_threads = [
+            threading.Thread(target=self.actor_loop, args=(actor_model, batch_size), daemon=True)
+            for actor_model in self._actor_models]
+        for thread in self._actor_threads:
+            thread.start()
+        self._last_collect_time = time()
+
+    def stop_actors(self) -> None:
+        self._stop_event.set()
+        for thread in self._actor_threads:
+            thread.join()
+        self._actor_threads = []
+        # Drain the queue, so that the trainer may be restarted.
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def sync_transition_operator(self) -> None:
+        """Copy the transition operator state (e.g. tuned step sizes) of the first actor into the
+        model, so that it is used in evaluation and saved in checkpoints."""
+        if self._actor_models:
+            self.model.transition_operator.load_state_dict(
+                self._actor_models[0].transition_operator.state_dict())
+
+    def check_actors(self) -> None:
+        """Raise an error if an actor has failed, or the actors have been stopped."""
+        if self._actor_error is not None:
+            raise RuntimeError("AIS actor failed.") from self._actor_error
+        if self._stop_event.is_set():
+            raise RuntimeError("AIS actors have been stopped.")
+
+    def collect_samples(self, batch_size: int) -> Dict[str, Any]:
+        """Add all of the batches generated by the actors since the last call to the buffer.
+        Only blocks if no batch has been generated yet, in which case the actors are polled, so
+        that an actor failing before it generates a batch raises an error rather than hanging."""
+        self.check_actors()
+        if self._learner_iteration % self.weight_sync_period == 0:
+            self.publish_weights()
+        self._learner_iteration += 1
+
+        batches = []
+        while self._last_actor_info is None and not batches:
+            try:
+                batches.append(self._queue.get(timeout=0.1))
+            except queue.Empty:
+                self.check_actors()
+        while True:
+            try:
+                batches.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for batch in batches:
+            # log q has already been evaluated at the stored x by the actor.
+            self.buffer.add(batch.x, batch.log_w, batch.log_q)
+            self._n_samples_generated += batch.x.shape[0]
+        if batches:
+            self._last_actor_info = batches[-1].info
+
+        current_time = time()
+        iteration_time = current_time - self._last_collect_time
+        self._last_collect_time = current_time
+        info = dict(self._last_actor_info)
+        info.update(
+            actor_samples_per_second=sum(batch.x.shape[0] for batch in batches) / iteration_time,
+            learner_steps_per_second=self.n_batches_buffer_sampling / iteration_time,
+            n_actor_batches_added=len(batches),
+            actor_queue_size=self._queue.qsize(),
+            n_samples_generated=self._n_samples_generated,
+        )
+        if batches:
+            info.update(actor_weights_staleness=self._learner_iteration -
+                        max(batch.weights_version for batch in batches))
+        return info
+
+    def save_checkpoint(self, i):
+        self.sync_transition_operator()
+        super(AsyncPrioritisedBufferTrainer, self).save_checkpoint(i)
+
+    def perform_eval(self, i, eval_batch_size, batch_size):
+        self.sync_transition_operator()
+        super(AsyncPrioritisedBufferTrainer, self).perform_eval(i, eval_batch_size, batch_size)
+
+    def run(self, n_iterations: int, batch_size: int, *args, **kwargs) -> None:
+        """See `PrioritisedBufferTrainer.run`. The actors run for the duration of training."""
+        self.start_actors(batch_size)
+        try:
+            super(AsyncPrioritisedBufferTrainer, self).run(n_iterations, batch_size, *args,
+                                                           **kwargs)
+        finally:
+            self.stop_actors()
+            self.sync_transition_operator()
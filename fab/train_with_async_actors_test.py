@@ -0,0 +1,102 @@
+from typing import Optional
+import copy
+
+import normflows as nf
+import pytest
+import torch
+
+from fab import FABModel
+from fab.sampling_methods import Metropolis
+from fab.target_distributions.gmm import GMM
+from fab.train_with_async_actors import AsyncPrioritisedBufferTrainer
+from fab.utils.buffer_storage import stored_sample_log_probs
+from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer
+from fab.wrappers.normflows import WrappedNormFlowModel
+
+
+def make_trainer(dim: int = 2, batch_size: int = 16, n_ais_intermediate_distributions: int = 2,
+                 x_dtype: Optional[torch.dtype] = None, weight_sync_period: int = 1
+                 ) -> AsyncPrioritisedBufferTrainer:
+    """Create a small trainer on the CPU, with one actor."""
+    torch.manual_seed(0)
+    base = nf.distributions.base.DiagGaussian(dim)
+    flows = []
+    for i in range(2):
+        flows.append(nf.flows.AffineCouplingBlock(nf.nets.MLP([1, 8, 2], init_zeros=True)))
+        flows.append(nf.flows.Permute(2, mode='swap'))
+    flow = WrappedNormFlowModel(nf.NormalizingFlow(base, flows))
+    target = GMM(dim=dim, n_mixes=2, loc_scaling=2.0, use_gpu=False, n_test_set_samples=100,
+                 true_expectation_estimation_n_samples=1000)
+    transition_operator = Metropolis(
+        n_ais_intermediate_distributions=n_ais_intermediate_distributions, dim=dim,
+        base_log_prob=flow.log_prob, target_log_prob=target.log_prob, n_updates=1, alpha=2.0)
+    model = FABModel(flow=flow, target_distribution=target,
+                     n_intermediate_distributions=n_ais_intermediate_distributions,
+                     transition_operator=transition_operator, alpha=2.0)
+
+    def initial_sampler():
+        point, log_w = model.annealed_importance_sampler.sample_and_log_weights(
+            batch_size, logging=False)
+        log_q, _, _ = stored_sample_log_probs(point.x.detach(), x_dtype, point.log_q.detach(),
+                                              flow.log_prob)
+        return point.x.detach(), log_w, log_q
+
+    buffer = PrioritisedReplayBuffer(dim=dim, max_length=batch_size * 8,
+                                     min_sample_length=batch_size * 2,
+                                     initial_sampler=initial_sampler, x_dtype=x_dtype)
+    optimizer = torch.optim.Adam(flow.parameters(), lr=1e-4)
+    return AsyncPrioritisedBufferTrainer(model, optimizer=optimizer, buffer=buffer, alpha=2.0,
+                                         n_actors=1, weight_sync_period=weight_sync_period)
+
+
+def test_async_trainer(batch_size: int = 16):
+    """Run a few iterations of training with one actor on the CPU."""
+    trainer = make_trainer(batch_size=batch_size)
+    trainer.run(n_iterations=3, batch_size=batch_size, save=False)
+    assert trainer._n_samples_generated >= batch_size
+    assert not trainer._actor_threads
+    assert trainer._actor_error is None
+
+
+def test_async_trainer__actor_error(batch_size: int = 16):
+    """Check that an actor failing before it generates a batch raises an error in the learner,
+    rather than the learner waiting forever."""
+    trainer = make_trainer(batch_size=batch_size)
+
+    def failing_sampler(*args, **kwargs):
+        raise ValueError("AIS failed")
+
+    # The actor models are copies of the model, so they use the failing sampler.
+    trainer.model.annealed_importance_sampler.sample_and_log_weights = failing_sampler
+    with pytest.raises(RuntimeError) as error_info:
+        trainer.run(n_iterations=3, batch_size=batch_size, save=False)
+    assert isinstance(error_info.value.__cause__, ValueError)
+
+
+def test_async_trainer__reduced_precision(batch_size: int = 16):
+    """Check that with x stored in bfloat16, the log q stored for the actor's samples is that of
+    the rounded x under the (stale) flow of the actor, rather than the current flow."""
+    trainer = make_trainer(batch_size=batch_size, x_dtype=torch.bfloat16,
+                           weight_sync_period=1000)
+    actor_flow = copy.deepcopy(trainer.model.flow)
+    trainer.start_actors(batch_size)
+    try:
+        # Change the learner's flow after the actor has been given its weights, and skip
+        # publishing the new weights.
+        with torch.no_grad():
+            for parameter in trainer.model.flow.parameters():
+                parameter.add_(0.1)
+        trainer._learner_iteration = 1
+        start_index = trainer.buffer.current_index
+        info = trainer.collect_samples(batch_size)
+    finally:
+        trainer.stop_actors()
+    n_added = info["n_actor_batches_added"] * batch_size
+    assert n_added > 0
+    indices = torch.arange(start_index, start_index + n_added) % trainer.buffer.max_length
+    x, _, log_q_old = trainer.buffer._gather(indices)
+    with torch.no_grad():
+        torch.testing.assert_close(log_q_old, actor_flow.log_prob(x))
+        assert not torch.allclose(log_q_old, trainer.model.flow.log_prob(x))
+    assert info["actor_weights_staleness"] == 2
+    assert "buffer_log_q_quantisation_error_mean" in info
@@ -1,4 +1,4 @@
-from typing import Callable, Any, Optional, List
+from typing import Callable, Any, Optional, List, Tuple
 
 import torch.optim.optimizer
 from tqdm import tqdm
@@ -9,7 +9,9 @@ import os
 
 from fab.utils.logging import Logger, ListLogger
 from fab.core import FABModel
+from fab.sampling_methods.base import Point
 from fab.utils.replay_buffer import ReplayBuffer
+from fab.utils.buffer_storage import stored_sample_log_probs
 
 
 lr_scheduler = Any  # a learning rate schedular from torch.optim.lr_scheduler
@@ -44,6 +46,33 @@ class BufferTrainer:
         self.flow_device = next(model.flow.parameters()).device
         self.clip_ais_weights_frac = clip_ais_weights_frac
 
+    def get_buffer_point(self, x: torch.Tensor, log_w: torch.Tensor,
+                         log_q: Optional[torch.Tensor] = None,
+                         log_p: Optional[torch.Tensor] = None) -> Point:
+        """Create a `Point` from a batch sampled from the buffer. If the buffer stores log probs
+        then the log_p computed by AIS is reused, otherwise the target is re-evaluated. The
+        replay losses re-evaluate log_q with the current flow, so if it is not stored then it is
+        set to NaN rather than evaluated."""
+        x = x.to(self.flow_device)
+        if log_p is None:
+            with torch.no_grad():
+                log_p = self.model.target_distribution.log_prob(x)
+            log_q = torch.full_like(log_p, float("nan"))
+        return Point(x=x, log_q=log_q.to(self.flow_device), log_p=log_p.to(self.flow_device))
+
+    def replay_step(self, batch: Tuple[torch.Tensor, ...]) -> torch.Tensor:
+        """Take a gradient step on a batch sampled from the buffer. Returns the loss."""
+        point = self.get_buffer_point(*batch)
+        log_w = batch[1].to(self.flow_device)
+        self.optimizer.zero_grad()
+        loss = self.model.inner_loss(point, log_w)
+        if not torch.isnan(loss) and not torch.isinf(loss):
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_gradient_norm)
+            self.optimizer.step()
+        else:
+            print("nan loss in replay step")
+        return loss
 
     def run(self,
             n_iterations: int,
@@ -70,9 +99,8 @@ class BufferTrainer:
         for i in pbar:
             self.optimizer.zero_grad()
             # collect samples and log weights with AIS.
-            x_ais, log_w_ais = self.model.\
+            point_ais, log_w_ais = self.model.\
                 annealed_importance_sampler.sample_and_log_weights(batch_size)
-            x_ais = x_ais.detach()
             log_w_ais = log_w_ais.detach()
             if self.clip_ais_weights_frac is not None:
                 # optional clipping of log weights
@@ -81,7 +109,7 @@ class BufferTrainer:
                 log_w_ais = torch.clamp_max(log_w_ais, max_log_w)
 
             # perform one update using the recently collected AIS samples and log weights
-            loss = self.model.inner_loss(x_ais, log_w_ais)
+            loss = self.model.inner_loss(point_ais, log_w_ais)
             if not torch.isnan(loss) and not torch.isinf(loss):
                 loss.backward()
                 grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(),
@@ -101,22 +129,19 @@ class BufferTrainer:
 
             # We now take an additional self.n_batches_buffer_sampling gradient steps using
             # data from the replay buffer.
-            for (x, log_w) in self.buffer.sample_n_batches(
+            for batch in self.buffer.sample_n_batches(
                     batch_size=batch_size, n_batches=self.n_batches_buffer_sampling):
-
-                x, log_w = x.to(self.flow_device), log_w.to(self.flow_device)
-                self.optimizer.zero_grad()
-                loss = self.model.inner_loss(x, log_w)
-                if not torch.isnan(loss) and not torch.isinf(loss):
-                    loss.backward()
-                    grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(),
-                                                               self.max_gradient_norm)
-                    self.optimizer.step()
-                else:
-                    print("nan loss in replay step")
+                loss = self.replay_step(batch)
 
             # add data to buffer
-            self.buffer.add(x_ais, log_w_ais)
+            if self.buffer.store_log_probs:
+                log_q, log_p, _ = stored_sample_log_probs(
+                    point_ais.x.detach(), self.buffer.x_dtype, point_ais.log_q.detach(),
+                    self.model.flow.log_prob, point_ais.log_p.detach(),
+                    self.model.target_distribution.log_prob)
+                self.buffer.add(point_ais.x.detach(), log_w_ais, log_q, log_p)
+            else:
+                self.buffer.add(point_ais.x.detach(), log_w_ais)
             pbar.set_description(f"loss: {loss.cpu().detach().item()}, ess base: {info['ess_base']},"
                                  f"ess ais: {info['ess_ais']}")
 
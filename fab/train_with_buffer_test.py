@@ -0,0 +1,72 @@
+import normflows as nf
+import torch
+
+from fab import FABModel
+from fab.sampling_methods import Metropolis
+from fab.train_with_buffer import BufferTrainer
+from fab.utils.replay_buffer import ReplayBuffer
+from fab.wrappers.normflows import WrappedNormFlowModel
+from fab.wrappers.torch import WrappedTorchDist
+
+
+class CountingTarget(WrappedTorchDist):
+    """Gaussian target that counts the calls to its log prob."""
+    def __init__(self, dim: int):
+        super(CountingTarget, self).__init__(torch.distributions.MultivariateNormal(
+            loc=torch.zeros(dim), scale_tril=torch.eye(dim)))
+        self.n_log_prob_calls = 0
+
+    def log_prob(self, x: torch.Tensor) -> torch.Tensor:
+        self.n_log_prob_calls += 1
+        return super(CountingTarget, self).log_prob(x)
+
+
+def test_buffer_trainer__replay_step(dim: int = 2, batch_size: int = 16,
+                                     n_ais_intermediate_distributions: int = 2):
+    """Check that a replay step reuses the log p stored in the buffer, rather than evaluating the
+    target, and that the target is evaluated if the buffer does not store log probs."""
+    torch.manual_seed(0)
+    base = nf.distributions.base.DiagGaussian(dim)
+    flows = []
+    for i in range(2):
+        flows.append(nf.flows.AffineCouplingBlock(nf.nets.MLP([1, 8, 2], init_zeros=True)))
+        flows.append(nf.flows.Permute(2, mode='swap'))
+    flow = WrappedNormFlowModel(nf.NormalizingFlow(base, flows))
+    target = CountingTarget(dim)
+    transition_operator = Metropolis(
+        n_ais_intermediate_distributions=n_ais_intermediate_distributions, dim=dim,
+        base_log_prob=flow.log_prob, target_log_prob=target.log_prob, n_updates=1, alpha=2.0)
+    model = FABModel(flow=flow, target_distribution=target,
+                     n_intermediate_distributions=n_ais_intermediate_distributions,
+                     transition_operator=transition_operator, alpha=2.0,
+                     loss_type="fab_ub_alpha_2_div")
+
+    def initial_sampler():
+        point, log_w = model.annealed_importance_sampler.sample_and_log_weights(
+            batch_size, logging=False)
+        return point.x.detach(), log_w, point.log_q.detach(), point.log_p.detach()
+
+    # `BufferTrainer.__init__` raises as the trainer is experimental, so only the attributes used
+    # by the replay step are set.
+    trainer = BufferTrainer.__new__(BufferTrainer)
+    trainer.model = model
+    trainer.optimizer = torch.optim.Adam(flow.parameters(), lr=1e-3)
+    trainer.flow_device = torch.device("cpu")
+    trainer.max_gradient_norm = 5.0
+
+    for store_log_probs in [True, False]:
+        sampler = initial_sampler if store_log_probs else lambda: initial_sampler()[:2]
+        buffer = ReplayBuffer(dim=dim, max_length=batch_size * 4,
+                              min_sample_length=batch_size * 2, initial_sampler=sampler,
+                              store_log_probs=store_log_probs)
+        batch = buffer.sample(batch_size)
+        n_log_prob_calls = target.n_log_prob_calls
+        point = trainer.get_buffer_point(*batch)
+        assert target.n_log_prob_calls == n_log_prob_calls + (0 if store_log_probs else 1)
+        with torch.no_grad():
+            torch.testing.assert_close(point.log_p, target.log_prob(batch[0]))
+
+        n_log_prob_calls = target.n_log_prob_calls
+        loss = trainer.replay_step(batch)
+        assert torch.isfinite(loss)
+        assert target.n_log_prob_calls == n_log_prob_calls + (0 if store_log_probs else 1)
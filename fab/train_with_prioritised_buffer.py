@@ -1,4 +1,4 @@
-from typing import Callable, Any, Optional, List
+from typing import Callable, Any, Dict, Optional, List
 
 import torch.optim.optimizer
 from tqdm import tqdm
@@ -11,6 +11,7 @@ import os
 from fab.utils.logging import Logger, ListLogger
 from fab.core import FABModel
 from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer
+from fab.utils.buffer_storage import stored_sample_log_probs
 
 
 lr_scheduler = Any  # a learning rate schedular from torch.optim.lr_scheduler
@@ -103,6 +104,30 @@ class PrioritisedBufferTrainer:
 
 
 
+    def collect_samples(self, batch_size: int) -> Dict[str, Any]:
+        """Generate a batch of samples with AIS and add them to the buffer. Returns the logging
+        info from the step of the recently generated AIS points."""
+        point_ais, log_w_ais = self.model.\
+            annealed_importance_sampler.sample_and_log_weights(batch_size)
+        x_ais = point_ais.x.detach()
+        log_w_ais = log_w_ais.detach()
+        log_q_x_ais = point_ais.log_q.detach()
+        buffer_info = self.add_to_buffer(x_ais, log_w_ais, log_q_x_ais)
+        info = self.model.get_iter_info()
+        info.update(buffer_info)
+        return info
+
+    def add_to_buffer(self, x: torch.Tensor, log_w: torch.Tensor, log_q: torch.Tensor
+                      ) -> Dict[str, Any]:
+        """Add samples to the buffer. If the buffer stores x in reduced precision, then log q is
+        re-evaluated at the stored (rounded) x, so that the weight adjustments in the replay steps
+        are not biased by the rounding. The resulting change in log q is returned for logging, as
+        it shows the effect of the storage precision on the replay loss."""
+        log_q, _, info = stored_sample_log_probs(x, self.buffer.x_dtype, log_q,
+                                                 self.model.flow.log_prob)
+        self.buffer.add(x, log_w, log_q)
+        return info
+
     def run(self,
             n_iterations: int,
             batch_size: int,
@@ -140,16 +165,7 @@ class PrioritisedBufferTrainer:
             it_start_time = time()
             self.optimizer.zero_grad()
             # collect samples and log weights with AIS and add to the buffer
-            point_ais, log_w_ais = self.model.\
-                annealed_importance_sampler.sample_and_log_weights(batch_size)
-            x_ais = point_ais.x.detach()
-            log_w_ais = log_w_ais.detach()
-            log_q_x_ais = point_ais.log_q.detach()
-            self.buffer.add(x_ais.detach(), log_w_ais.detach(),
-                            log_q_x_ais.detach())
-
-            # we log info from the step of the recently generated ais points.
-            info = self.model.get_iter_info()
+            info = self.collect_samples(batch_size)
 
             # We now take self.n_batches_buffer_sampling gradient steps using
             # data from the replay buffer.
@@ -196,6 +212,7 @@ class PrioritisedBufferTrainer:
                         w_adjust_max=torch.max(w_adjust_pre_clip).detach().cpu().item(),
                         log_q_x_mean=torch.mean(log_q_x).cpu().item()
                         )
+            info.update(self.buffer.get_storage_info())
 
             if self.w_adjust_in_buffer_after_update:
                 with torch.no_grad():
@@ -1,5 +1,23 @@
+from typing import Tuple
+
+import torch
 import torch.nn as nn
 from fab.types_ import Distribution
 
 class TrainableDistribution(Distribution, nn.Module):
     """Base class for trainable distributions."""
+
+    def forward_and_log_det(self, z: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Map samples z from the base (latent) distribution to x, returning x and
+        log|det dx/dz|. Only required for latent space transition operators."""
+        raise NotImplementedError
+
+    def inverse_and_log_det(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Map x to the base (latent) distribution, returning z and log|det dz/dx|. Only required
+        for latent space transition operators."""
+        raise NotImplementedError
+
+    def base_log_prob(self, z: torch.Tensor) -> torch.Tensor:
+        """Log prob of z under the base (latent) distribution. Only required for latent space
+        transition operators."""
+        raise NotImplementedError
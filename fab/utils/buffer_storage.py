@@ -0,0 +1,78 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+import torch
+
+from fab.types_ import LogProbFunc
+
+
+def get_storage_dtype(name: Optional[str]) -> Optional[torch.dtype]:
+    """Convert the name of a dtype in a config (e.g. "bfloat16") to a torch dtype. None is passed
+    through, which means the buffer uses the default dtype."""
+    if name is None:
+        return None
+    dtype = getattr(torch, name, None)
+    if not isinstance(dtype, torch.dtype) or not dtype.is_floating_point:
+        raise ValueError(f"Unknown floating point dtype {name}")
+    return dtype
+
+
+def is_reduced_precision(x_dtype: torch.dtype, dtype: torch.dtype) -> bool:
+    """Whether storing values of `dtype` in `x_dtype` loses precision."""
+    return torch.finfo(x_dtype).eps > torch.finfo(dtype).eps
+
+
+def stored_sample_log_probs(x: torch.Tensor, x_dtype: Optional[torch.dtype],
+                            log_q: torch.Tensor, log_q_fn: LogProbFunc,
+                            log_p: Optional[torch.Tensor] = None,
+                            log_p_fn: Optional[LogProbFunc] = None
+                            ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Dict[str, float]]:
+    """Log q (and optionally log p) of the sample that is stored in a replay buffer with storage
+    dtype `x_dtype`. If x is stored in reduced precision, then they are re-evaluated at the
+    rounded x, so that the stored log probs match the stored samples, and the change in log q
+    from the rounding is returned for logging. Otherwise they are returned unchanged.
+
+    `log_q_fn` must be the log prob of the flow that generated the samples (with the same
+    weights), so that the change in log q is from the rounding alone.
+    """
+    info = {}
+    if x_dtype is None or not is_reduced_precision(x_dtype, x.dtype):
+        return log_q, log_p, info
+    x_stored = x.to(x_dtype).to(x.dtype)
+    with torch.no_grad():
+        log_q_stored = log_q_fn(x_stored).to(log_q.device)
+        if log_p is not None:
+            log_p = log_p_fn(x_stored).to(log_p.device)
+    log_q_error = torch.abs(log_q_stored - log_q)
+    log_q_error = log_q_error[torch.isfinite(log_q_error)]
+    if log_q_error.shape[0] > 0:
+        info.update(buffer_log_q_quantisation_error_mean=torch.mean(log_q_error).item(),
+                    buffer_log_q_quantisation_error_max=torch.max(log_q_error).item())
+    return log_q_stored, log_p, info
+
+
+def storage_mbytes(tensors: Iterable[Optional[torch.Tensor]]) -> float:
+    """Memory (in MB) used by the storage of a buffer."""
+    return sum(tensor.element_size() * tensor.numel() for tensor in tensors
+               if tensor is not None) / 2**20
+
+
+class QuantisationError:
+    """Running statistics of the error from storing the samples of a replay buffer in reduced
+    precision. The statistics are kept on the device, so that they may be updated without a
+    sync."""
+    def __init__(self, device: str = "cpu"):
+        self.sum_squared_error = torch.zeros((), device=device)
+        self.max_error = torch.zeros((), device=device)
+        self.n_elements = 0
+
+    @torch.no_grad()
+    def update(self, x: torch.Tensor, x_stored: torch.Tensor) -> None:
+        error = torch.abs(x_stored.to(x.dtype) - x)
+        self.sum_squared_error = self.sum_squared_error + torch.sum(error**2)
+        self.max_error = torch.maximum(self.max_error, torch.max(error))
+        self.n_elements += error.numel()
+
+    def get_info(self) -> Dict[str, float]:
+        rms_error = torch.sqrt(self.sum_squared_error / max(self.n_elements, 1))
+        return {"x_quantisation_error_rms": rms_error.cpu().item(),
+                "x_quantisation_error_max": self.max_error.cpu().item()}
@@ -0,0 +1,202 @@
+from typing import Callable, Optional, Tuple
+import os
+
+import torch
+
+from fab.utils.buffer_storage import QuantisationError
+from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer, ReplayData
+
+
+class MemoryMappedPrioritisedReplayBuffer(PrioritisedReplayBuffer):
+    def __init__(self, dim: int,
+                 max_length: int,
+                 min_sample_length: int,
+                 initial_sampler: Callable[[], Tuple[torch.Tensor, torch.Tensor, torch.Tensor]],
+                 storage_dir: str,
+                 device: str = "cpu",
+                 sample_with_replacement: bool = False,
+                 fill_buffer_during_init: bool = True,
+                 cache_length: Optional[int] = None,
+                 segment_length: int = 2**16,
+                 x_dtype: Optional[torch.dtype] = None,
+                 log_w_dtype: Optional[torch.dtype] = None,
+                 ):
+        """
+        Prioritised replay buffer where the samples x are stored in a memory-mapped file in
+        `storage_dir`, so that the buffer size is limited by disk space rather than device or host
+        memory. See `PrioritisedReplayBuffer` for the other args.
+
+        The log weights and log q are only a scalar per entry, so they are kept on `device` (as
+        they are needed over the whole buffer for prioritised sampling), and mirrored in
+        memory-mapped files. The most recently added `cache_length` samples are also kept in a
+        device-side cache, so that only samples outside of the cache are read from disk.
+
+        `save` is incremental: the samples are written to disk when they are added, and only the
+        segments (of `segment_length` entries) of the log weights and log q that changed since the
+        last call are written. So the files in `storage_dir` always hold the latest state of the
+        buffer (they are not a snapshot per checkpoint), and `load` restores the buffer from them
+        without reading the samples into memory. Samples added after the last `save` (e.g. before
+        a crash) are detected with a counter of written samples, and killed by `load`.
+
+        Args:
+            storage_dir: Directory of the memory-mapped files. Existing files are reused, so they
+                must have been created with the same `x_dtype` and `log_w_dtype`.
+            cache_length: Number of recently added samples kept on the device. Defaults to
+                `min_sample_length`.
+            segment_length: Number of entries per segment, the unit in which dirty log weights
+                and log q are written to disk.
+        """
+        assert min_sample_length < max_length
+        os.makedirs(storage_dir, exist_ok=True)
+        self.dim = dim
+        self.max_length = max_length
+        self.min_sample_length = min_sample_length
+        self.storage_dir = storage_dir
+        self.dtype = torch.get_default_dtype()
+        self.x_dtype = x_dtype or self.dtype
+        self.log_w_dtype = log_w_dtype or self.dtype
+        # `torch.from_file` with shared=True creates (or extends) the file, and writes to the
+        # tensor go to the file.
+        self._x_file = torch.from_file(os.path.join(storage_dir, "x.bin"), shared=True,
+                                       size=max_length * dim, dtype=self.x_dtype
+                                       ).view(max_length, dim)
+        self._log_w_file = torch.from_file(os.path.join(storage_dir, "log_w.bin"), shared=True,
+                                           size=max_length, dtype=self.log_w_dtype)
+        self._log_q_old_file = torch.from_file(os.path.join(storage_dir, "log_q_old.bin"),
+                                               shared=True, size=max_length,
+                                               dtype=self.log_w_dtype)
+        # Total number of samples ever written to `x.bin`, which is incremented before the samples
+        # are written. This lets `load` find the samples written after the last `save`.
+        self._n_written_file = torch.from_file(os.path.join(storage_dir, "n_written.bin"),
+                                               shared=True, size=1, dtype=torch.long)
+        self.buffer = ReplayData(x=self._x_file,
+                                 log_w=torch.zeros(self.max_length, dtype=self.log_w_dtype
+                                                   ).to(device),
+                                 log_q_old=torch.zeros(self.max_length, dtype=self.log_w_dtype
+                                                       ).to(device))
+        self._quantisation_error = QuantisationError(device)
+        self.cache_length = min(cache_length or min_sample_length, max_length)
+        self._cache_x = torch.zeros(self.cache_length, dim, dtype=self.x_dtype).to(device)
+        # Buffer index of the sample held in each cache slot (-1 if empty).
+        self._cache_index = torch.full((self.cache_length,), -1, dtype=torch.long).to(device)
+        self.segment_length = segment_length
+        n_segments = (max_length + segment_length - 1) // segment_length
+        self._dirty_segments = torch.zeros(n_segments, dtype=torch.bool).to(device)
+        self.device = device
+        self.current_index = 0
+        self.is_full = False  # whether the buffer is full
+        self.can_sample = False  # whether the buffer is full enough to begin sampling
+        self.sample_with_replacement = sample_with_replacement
+
+        if fill_buffer_during_init:
+            while self.can_sample is False:
+                # fill buffer up minimum length
+                x, log_w, log_q_old = initial_sampler()
+                self.add(x, log_w, log_q_old)
+
+    def _mark_dirty(self, indices: torch.Tensor) -> None:
+        self._dirty_segments[indices.to(self.device) // self.segment_length] = True
+
+    @torch.no_grad()
+    def add(self, x: torch.Tensor, log_w: torch.Tensor, log_q_old: torch.Tensor) -> None:
+        """Add a new batch of generated data to the replay buffer. The samples are written to the
+        memory-mapped file, and to the device cache."""
+        batch_size = x.shape[0]
+        indices = (torch.arange(batch_size) + self.current_index) % self.max_length
+        x = x.detach().to(self.device)
+        x_stored = x.to(self.x_dtype)
+        self._n_written_file += batch_size
+        self._x_file[indices] = x_stored.cpu()
+        if self.reduced_precision:
+            self._quantisation_error.update(x, x_stored)
+        device_indices = indices.to(self.device)
+        self._add_to_cache(x_stored, device_indices)
+        self.buffer.log_w[device_indices] = log_w.to(self.device, self.log_w_dtype)
+        self.buffer.log_q_old[device_indices] = log_q_old.to(self.device, self.log_w_dtype)
+        self._mark_dirty(device_indices)
+        new_index = self.current_index + batch_size
+        if not self.is_full:
+            self.is_full = new_index >= self.max_length
+            self.can_sample = new_index >= self.min_sample_length
+        self.current_index = new_index % self.max_length
+
+    def _add_to_cache(self, x: torch.Tensor, indices: torch.Tensor) -> None:
+        """Write the most recent samples of a batch to the device cache. Each cache slot is
+        written at most once, as with duplicate indices it is unspecified which value is written
+        (and it may differ between `_cache_x` and `_cache_index`)."""
+        n_cached = min(x.shape[0], self.cache_length)
+        x, indices = x[-n_cached:], indices[-n_cached:]
+        slots = indices % self.cache_length
+        # If the buffer indices wrap around, slots may still repeat, in which case only the last
+        # sample for each slot is kept.
+        order = torch.arange(n_cached, device=slots.device)
+        last = torch.full((self.cache_length,), -1, dtype=torch.long, device=slots.device
+                          ).scatter_reduce(0, slots, order, reduce="amax")
+        keep = last[slots] == order
+        self._cache_x[slots[keep]] = x[keep]
+        self._cache_index[slots[keep]] = indices[keep]
+
+    def _gather(self, indices: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Return the entries at `indices` (upcast to `self.dtype`), where samples that are not
+        in the device cache are read from disk."""
+        indices = indices.to(self.device)
+        slots = indices % self.cache_length
+        in_cache = self._cache_index[slots] == indices
+        x = self._cache_x[slots]
+        miss_indices = indices[~in_cache].cpu()
+        if miss_indices.shape[0] > 0:
+            x[~in_cache] = self._x_file[miss_indices].to(x)
+        return x.to(self.dtype), self.buffer.log_w[indices].to(self.dtype), \
+            self.buffer.log_q_old[indices].to(self.dtype)
+
+    @torch.no_grad()
+    def adjust(self, log_w_adjustment, log_q, indices):
+        """See `PrioritisedReplayBuffer.adjust`. The adjusted entries are marked as dirty, so that
+        they are written to disk at the next call to `save`."""
+        super(MemoryMappedPrioritisedReplayBuffer, self).adjust(log_w_adjustment, log_q, indices)
+        self._mark_dirty(indices)
+
+    def flush(self) -> None:
+        """Write the dirty segments of the log weights and log q to disk."""
+        dirty_segments = torch.nonzero(self._dirty_segments).squeeze(-1).cpu().tolist()
+        for segment in dirty_segments:
+            start = segment * self.segment_length
+            end = min(start + self.segment_length, self.max_length)
+            self._log_w_file[start:end] = self.buffer.log_w[start:end].cpu()
+            self._log_q_old_file[start:end] = self.buffer.log_q_old[start:end].cpu()
+        self._dirty_segments[:] = False
+
+    def save(self, path):
+        """Write the dirty segments to the files in `storage_dir`, and save the buffer state
+        (which is small) to `path`."""
+        self.flush()
+        to_save = {'storage_dir': self.storage_dir,
+                   'n_written': self._n_written_file.item(),
+                   'current_index': self.current_index,
+                   'is_full': self.is_full,
+                   'can_sample': self.can_sample}
+        torch.save(to_save, path)
+
+    def load(self, path):
+        """Load the buffer state from `path`, and the log weights and log q from the files in
+        `storage_dir`. The samples stay on disk, and the device cache is emptied.
+
+        Samples written to `x.bin` after the state was saved (e.g. before a crash) do not match
+        the saved log weights and log q of their entries, so these entries are killed by setting
+        their log weight to -inf."""
+        state = torch.load(path)
+        self.buffer.log_w[:] = self._log_w_file.to(self.device)
+        self.buffer.log_q_old[:] = self._log_q_old_file.to(self.device)
+        self._cache_index[:] = -1
+        self._dirty_segments[:] = False
+        self.current_index = state['current_index']
+        self.is_full = state['is_full']
+        self.can_sample = state['can_sample']
+        n_written_after_save = self._n_written_file.item() - state.get(
+            'n_written', self._n_written_file.item())
+        if n_written_after_save > 0:
+            indices = (torch.arange(min(n_written_after_save, self.max_length)) +
+                       self.current_index) % self.max_length
+            indices = indices.to(self.device)
+            self.buffer.log_w[indices] = -float("inf")
+            self._mark_dirty(indices)
@@ -0,0 +1,70 @@
+import torch
+
+from fab.utils.memory_mapped_replay_buffer import MemoryMappedPrioritisedReplayBuffer
+
+
+def test_memory_mapped_replay_buffer(tmp_path, dim: int = 3, batch_size: int = 8):
+    """Check sampling with a small device cache, and that an incrementally saved buffer is
+    restored from its files."""
+    torch.manual_seed(0)
+
+    def initial_sampler():
+        return torch.randn(batch_size, dim), torch.zeros(batch_size), torch.zeros(batch_size)
+
+    storage_dir = str(tmp_path / "buffer_storage")
+    buffer = MemoryMappedPrioritisedReplayBuffer(
+        dim=dim, max_length=batch_size * 8, min_sample_length=batch_size * 2,
+        initial_sampler=initial_sampler, storage_dir=storage_dir, cache_length=batch_size,
+        segment_length=batch_size)
+    for i in range(10):
+        x_new = torch.randn(batch_size, dim)
+        buffer.add(x_new, torch.zeros(batch_size), torch.ones(batch_size))
+        x, log_w, log_q_old, indices = buffer.sample(batch_size)
+        # Samples that are read from disk and from the cache both match the stored samples.
+        torch.testing.assert_close(x, buffer._x_file[indices])
+        buffer.adjust(torch.full((batch_size,), 0.5), log_q_old + 0.1, indices)
+    buffer.save(str(tmp_path / "buffer.pt"))
+    assert not buffer._dirty_segments.any()
+
+    restored_buffer = MemoryMappedPrioritisedReplayBuffer(
+        dim=dim, max_length=batch_size * 8, min_sample_length=batch_size * 2,
+        initial_sampler=initial_sampler, storage_dir=storage_dir, cache_length=batch_size,
+        segment_length=batch_size, fill_buffer_during_init=False)
+    restored_buffer.load(str(tmp_path / "buffer.pt"))
+    torch.testing.assert_close(restored_buffer.buffer.log_w, buffer.buffer.log_w)
+    torch.testing.assert_close(restored_buffer.buffer.log_q_old, buffer.buffer.log_q_old)
+    assert restored_buffer.current_index == buffer.current_index
+    assert restored_buffer.is_full == buffer.is_full
+    x, _, _, indices = restored_buffer.sample(batch_size)
+    torch.testing.assert_close(x, buffer._x_file[indices])
+
+
+def test_memory_mapped_replay_buffer__add_after_save(tmp_path, dim: int = 3,
+                                                     batch_size: int = 8):
+    """Check that samples added after the last save (e.g. before a crash) are killed when the
+    buffer is loaded, and that batches larger than the cache are cached correctly."""
+    torch.manual_seed(0)
+
+    def initial_sampler():
+        return torch.randn(batch_size, dim), torch.zeros(batch_size), torch.zeros(batch_size)
+
+    storage_dir = str(tmp_path / "buffer_storage")
+    buffer = MemoryMappedPrioritisedReplayBuffer(
+        dim=dim, max_length=batch_size * 3, min_sample_length=batch_size * 2,
+        initial_sampler=initial_sampler, storage_dir=storage_dir, cache_length=5)
+    buffer.save(str(tmp_path / "buffer.pt"))
+    # This batch is larger than the cache, and wraps around the end of the buffer, so that the
+    # buffer indices of its last samples map to the same cache slot more than once.
+    n_added = 10
+    buffer.add(torch.randn(n_added, dim), torch.zeros(n_added), torch.ones(n_added))
+    x, _, _ = buffer._gather(torch.arange(buffer.max_length))
+    torch.testing.assert_close(x, buffer._x_file)
+
+    restored_buffer = MemoryMappedPrioritisedReplayBuffer(
+        dim=dim, max_length=batch_size * 3, min_sample_length=batch_size * 2,
+        initial_sampler=initial_sampler, storage_dir=storage_dir, fill_buffer_during_init=False)
+    restored_buffer.load(str(tmp_path / "buffer.pt"))
+    assert restored_buffer.current_index == batch_size * 2
+    killed = (torch.arange(n_added) + batch_size * 2) % restored_buffer.max_length
+    assert torch.all(restored_buffer.buffer.log_w[killed] == -float("inf"))
+    assert torch.all(restored_buffer.buffer.log_w[n_added - batch_size:batch_size * 2] == 0.0)
@@ -1,5 +1,6 @@
-from typing import Union, Callable, Any
+from typing import Union, Callable, Any, Optional
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 
@@ -58,3 +59,83 @@ def importance_weighted_expectation(f: Callable[[torch.Tensor], torch.Tensor], x
     function_values = f(x)
     expectation = normalised_importance_weights.T @ function_values
     return expectation
+
+
+class RunningLogSumExp:
+    """Running logsumexp over a stream of batches, for use when the full set of values does not
+    fit in memory. Values may be vectors, in which case `dim` is the batch dimension that is
+    reduced over."""
+    def __init__(self, dim: int = 0):
+        self.dim = dim
+        self.value: Optional[torch.Tensor] = None
+        self.n: int = 0
+
+    @torch.no_grad()
+    def update(self, x: torch.Tensor) -> None:
+        self.n += x.shape[self.dim]
+        batch_value = torch.logsumexp(x, dim=self.dim)
+        if self.value is None:
+            self.value = batch_value
+        else:
+            self.value = torch.logaddexp(self.value, batch_value.to(self.value.device))
+
+
+class ImportanceWeightAccumulator:
+    """Online estimates of the normalisation constant, effective sample size and importance
+    weighted expectations from a stream of (unnormalised) log importance weights.
+
+    Equivalent to calling `torch.logsumexp`, `effective_sample_size` and
+    `importance_weighted_expectation` on the concatenated batches, but using constant memory.
+    """
+    def __init__(self):
+        self._log_sum_w = RunningLogSumExp()
+        self._log_sum_w_sq = RunningLogSumExp()
+        self._log_w_max: Optional[torch.Tensor] = None
+        # Sum of w * f(x), scaled by exp(-self._log_w_max) to prevent overflow.
+        self._scaled_sum_w_f: Optional[torch.Tensor] = None
+        self._scaled_sum_w: Optional[torch.Tensor] = None
+
+    @torch.no_grad()
+    def update(self, log_w: torch.Tensor, f_x: Optional[torch.Tensor] = None) -> None:
+        """Add a batch of log weights, and optionally the values of the function f(x) that we
+        wish to estimate the expectation of, which has a leading batch dimension."""
+        assert len(log_w.shape) == 1
+        self._log_sum_w.update(log_w)
+        self._log_sum_w_sq.update(2 * log_w)
+        if f_x is not None:
+            batch_max = torch.max(log_w)
+            if self._log_w_max is None:
+                new_max = batch_max
+                self._scaled_sum_w_f = torch.zeros_like(f_x[0])
+                self._scaled_sum_w = torch.zeros_like(batch_max)
+            else:
+                new_max = torch.maximum(self._log_w_max, batch_max)
+                rescale = torch.nan_to_num(torch.exp(self._log_w_max - new_max))
+                self._scaled_sum_w_f = self._scaled_sum_w_f * rescale
+                self._scaled_sum_w = self._scaled_sum_w * rescale
+            w = torch.nan_to_num(torch.exp(log_w - new_max))
+            self._scaled_sum_w_f = self._scaled_sum_w_f + torch.einsum("b,b...->...", w, f_x)
+            self._scaled_sum_w = self._scaled_sum_w + torch.sum(w)
+            self._log_w_max = new_max
+
+    @property
+    def n(self) -> int:
+        return self._log_sum_w.n
+
+    @property
+    def log_Z(self) -> torch.Tensor:
+        """Estimate of the log normalisation constant, log (1/N sum_i w_i)."""
+        return self._log_sum_w.value - np.log(self.n)
+
+    @property
+    def effective_sample_size(self) -> torch.Tensor:
+        """Effective sample size normalised by the number of samples, see
+        `effective_sample_size`."""
+        return torch.exp(2 * self._log_sum_w.value - self._log_sum_w_sq.value) / self.n
+
+    @property
+    def expectation(self) -> torch.Tensor:
+        """Self-normalised importance weighted estimate of E[f(x)]."""
+        if self._scaled_sum_w_f is None:
+            raise Exception("No function values have been passed to `update`.")
+        return self._scaled_sum_w_f / self._scaled_sum_w
@@ -0,0 +1,172 @@
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import torch
+
+from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer, ReplayData
+
+Batch = Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
+
+
+class PrefetchedBatches:
+    """Replay minibatches that are copied to the device one batch ahead of their use, so that the
+    copy of the next batch overlaps with the gradient step on the current batch. Batches that have
+    been copied are kept, so this may be iterated over more than once."""
+    def __init__(self, copy_batch: Callable[[torch.Tensor], Tuple[Batch, torch.cuda.Event]],
+                 index_batches: Tuple[torch.Tensor, ...]):
+        self._copy_batch = copy_batch
+        self._index_batches = index_batches
+        self._batches: List[Tuple[Batch, torch.cuda.Event]] = []
+
+    def __len__(self) -> int:
+        return len(self._index_batches)
+
+    def __iter__(self) -> Iterator[Batch]:
+        for k in range(len(self._index_batches)):
+            if k == len(self._batches):
+                self._batches.append(self._copy_batch(self._index_batches[k]))
+            if k + 1 == len(self._batches) and k + 1 < len(self._index_batches):
+                # Start copying the next batch before this one is used.
+                self._batches.append(self._copy_batch(self._index_batches[k + 1]))
+            batch, copied = self._batches[k]
+            torch.cuda.current_stream().wait_event(copied)
+            yield batch
+
+
+class PinnedPrioritisedReplayBuffer(PrioritisedReplayBuffer):
+    def __init__(self, dim: int,
+                 max_length: int,
+                 min_sample_length: int,
+                 initial_sampler: Callable[[], Tuple[torch.Tensor, torch.Tensor, torch.Tensor]],
+                 transfer_device: Optional[str] = None,
+                 sample_with_replacement: bool = False,
+                 fill_buffer_during_init: bool = True,
+                 x_dtype: Optional[torch.dtype] = None,
+                 log_w_dtype: Optional[torch.dtype] = None,
+                 ):
+        """
+        Prioritised replay buffer that is stored in pinned host memory, for when the buffer is too
+        large for the GPU that the flow is on. See `PrioritisedReplayBuffer` for the other args.
+
+        The batches returned by `sample_n_batches` are on `transfer_device`. Each batch is
+        gathered into pinned memory and copied on a side CUDA stream while the previous batch is
+        being used, rather than with a synchronous copy per batch. Adjustments passed to `adjust`
+        on the GPU are copied back to the host on the side stream, and applied to the buffer at
+        the next call that reads or writes it (or at `synchronize`), so they do not block either.
+        Sampling is therefore based on the log weights adjusted up to the previous call to
+        `sample_n_batches`, as with `PrioritisedReplayBuffer`.
+
+        If `transfer_device` is not a CUDA device (by default it is the GPU, if one is available),
+        then the buffer falls back to the behaviour of a `PrioritisedReplayBuffer` on the CPU.
+
+        Args:
+            transfer_device: Device that the sampled batches are copied to, typically the device
+                of the flow. Defaults to "cuda" if it is available, and otherwise "cpu".
+        """
+        super(PinnedPrioritisedReplayBuffer, self).__init__(
+            dim=dim, max_length=max_length, min_sample_length=min_sample_length,
+            initial_sampler=initial_sampler, device="cpu",
+            sample_with_replacement=sample_with_replacement, fill_buffer_during_init=False,
+            x_dtype=x_dtype, log_w_dtype=log_w_dtype)
+        if transfer_device is None:
+            transfer_device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.transfer_device = torch.device(transfer_device)
+        self.use_cuda = self.transfer_device.type == "cuda"
+        # Adjustments that are being copied back to the host, with the event marking the end of
+        # their copy.
+        self._pending_adjustments: List[Tuple[torch.cuda.Event, List[torch.Tensor]]] = []
+        if self.use_cuda:
+            self.buffer = ReplayData(*(tensor.pin_memory() for tensor in self.buffer))
+            self._copy_stream = torch.cuda.Stream(self.transfer_device)
+
+        if fill_buffer_during_init:
+            while self.can_sample is False:
+                # fill buffer up minimum length
+                x, log_w, log_q_old = initial_sampler()
+                self.add(x, log_w, log_q_old)
+
+    def _apply_adjustments(self, wait: bool) -> None:
+        """Apply the pending adjustments to the buffer, in the order they were made. If `wait` is
+        False, then only those whose copy has already finished are applied."""
+        while self._pending_adjustments:
+            copied, host_tensors = self._pending_adjustments[0]
+            if not wait and not copied.query():
+                break
+            copied.synchronize()
+            super(PinnedPrioritisedReplayBuffer, self).adjust(*host_tensors)
+            self._pending_adjustments.pop(0)
+
+    def synchronize(self) -> None:
+        """Wait for all pending adjustments, and apply them to the buffer."""
+        self._apply_adjustments(wait=True)
+
+    @torch.no_grad()
+    def add(self, x: torch.Tensor, log_w: torch.Tensor, log_q_old: torch.Tensor) -> None:
+        """See `PrioritisedReplayBuffer.add`. Pending adjustments are applied first, as they may be
+        for entries that are about to be overwritten."""
+        self.synchronize()
+        super(PinnedPrioritisedReplayBuffer, self).add(x, log_w, log_q_old)
+
+    def _sample_indices(self, batch_size: int) -> torch.Tensor:
+        self.synchronize()
+        return super(PinnedPrioritisedReplayBuffer, self)._sample_indices(batch_size)
+
+    def _copy_batch(self, indices: torch.Tensor) -> Tuple[Batch, torch.cuda.Event]:
+        """Gather the entries at `indices` into pinned memory, and copy them to
+        `transfer_device` on the side stream. Returns the batch (upcast to `self.dtype`), and the
+        event marking the end of the copy."""
+        consumer_stream = torch.cuda.current_stream(self.transfer_device)
+        host_tensors = []
+        for tensor in self.buffer:
+            host_tensor = torch.empty((indices.shape[0],) + tensor.shape[1:], dtype=tensor.dtype,
+                                      pin_memory=True)
+            torch.index_select(tensor, 0, indices, out=host_tensor)
+            host_tensors.append(host_tensor)
+        host_tensors.append(indices.pin_memory())
+        with torch.cuda.stream(self._copy_stream):
+            batch = [tensor.to(self.transfer_device, non_blocking=True) for tensor in host_tensors]
+            # The storage dtype is kept for the copy, and upcast on the device.
+            batch = [tensor.to(self.dtype) for tensor in batch[:-1]] + batch[-1:]
+            copied = self._copy_stream.record_event()
+        for tensor in batch:
+            # The batch is allocated on the side stream, but used on the consumer stream.
+            tensor.record_stream(consumer_stream)
+        return tuple(batch), copied
+
+    def sample_n_batches(self, batch_size: int, n_batches: int) -> Iterator[Batch]:
+        """Returns an iterable of batches on `transfer_device`, that are copied one batch ahead of
+        their use."""
+        if not self.use_cuda:
+            return super(PinnedPrioritisedReplayBuffer, self).sample_n_batches(batch_size,
+                                                                               n_batches)
+        indices = self._sample_indices(batch_size * n_batches)
+        return PrefetchedBatches(self._copy_batch, torch.chunk(indices, n_batches))
+
+    @torch.no_grad()
+    def adjust(self, log_w_adjustment, log_q, indices):
+        """See `PrioritisedReplayBuffer.adjust`. If the adjustment is on the GPU, then it is copied
+        to the host asynchronously, and applied to the buffer later."""
+        if not (self.use_cuda and log_w_adjustment.is_cuda):
+            self.synchronize()
+            super(PinnedPrioritisedReplayBuffer, self).adjust(log_w_adjustment, log_q, indices)
+            return
+        self._apply_adjustments(wait=False)
+        self._copy_stream.wait_stream(torch.cuda.current_stream(self.transfer_device))
+        host_tensors = []
+        with torch.cuda.stream(self._copy_stream):
+            for tensor in (log_w_adjustment, log_q, indices):
+                tensor = tensor.detach()
+                if tensor.is_cuda:
+                    tensor.record_stream(self._copy_stream)
+                host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                host_tensor.copy_(tensor, non_blocking=True)
+                host_tensors.append(host_tensor)
+            copied = self._copy_stream.record_event()
+        self._pending_adjustments.append((copied, host_tensors))
+
+    def save(self, path):
+        self.synchronize()
+        super(PinnedPrioritisedReplayBuffer, self).save(path)
+
+    def load(self, path):
+        self.synchronize()
+        super(PinnedPrioritisedReplayBuffer, self).load(path)
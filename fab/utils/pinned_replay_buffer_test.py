@@ -0,0 +1,34 @@
+import torch
+
+from fab.utils.pinned_replay_buffer import PinnedPrioritisedReplayBuffer
+
+
+def test_pinned_replay_buffer(dim: int = 3, batch_size: int = 8, n_batches: int = 3):
+    """Check that the sampled batches match the host storage, and that adjustments are applied.
+    Uses the GPU if it is available, and otherwise checks the fallback to the CPU."""
+    torch.manual_seed(0)
+
+    def initial_sampler():
+        return torch.randn(batch_size, dim), torch.zeros(batch_size), torch.zeros(batch_size)
+
+    buffer = PinnedPrioritisedReplayBuffer(dim=dim, max_length=batch_size * 8,
+                                           min_sample_length=batch_size * 4,
+                                           initial_sampler=initial_sampler)
+    assert buffer.use_cuda == torch.cuda.is_available()
+    for i in range(3):
+        buffer.add(torch.randn(batch_size, dim), torch.zeros(batch_size), torch.ones(batch_size))
+        mini_dataset = buffer.sample_n_batches(batch_size, n_batches)
+        log_w_start = buffer.buffer.log_w.clone()
+        adjusted_indices = []
+        for x, log_w, log_q_old, indices in mini_dataset:
+            assert x.device.type == buffer.transfer_device.type
+            torch.testing.assert_close(x.cpu(), buffer.buffer.x[indices.cpu()])
+            buffer.adjust(torch.full_like(log_w, 0.5), log_q_old + 0.1, indices)
+            adjusted_indices.append(indices.cpu())
+        # The mini dataset may be iterated over again.
+        assert len(list(mini_dataset)) == n_batches
+        # Adjustments made on the GPU are applied once the buffer is synchronised.
+        buffer.synchronize()
+        adjusted_indices = torch.cat(adjusted_indices)
+        torch.testing.assert_close(buffer.buffer.log_w[adjusted_indices],
+                                   log_w_start[adjusted_indices] + 0.5)
@@ -1,6 +1,8 @@
-from typing import NamedTuple, Tuple, Iterable, Callable
+from typing import Dict, NamedTuple, Optional, Tuple, Iterable, Callable
 import torch
 
+from fab.utils.buffer_storage import QuantisationError, is_reduced_precision, storage_mbytes
+
 class ReplayData(NamedTuple):
     """Log weights and samples generated by annealed importance sampling."""
     x: torch.Tensor
@@ -25,6 +27,8 @@ class PrioritisedReplayBuffer:
                  device: str = "cpu",
                  sample_with_replacement: bool = False,
                  fill_buffer_during_init: bool = True,
+                 x_dtype: Optional[torch.dtype] = None,
+                 log_w_dtype: Optional[torch.dtype] = None,
                  ):
         """
         Create prioritised replay buffer for batched sampling and adding of data.
@@ -39,6 +43,13 @@ class PrioritisedReplayBuffer:
             sample_with_replacement: Whether to sample from the buffer with replacement.
             fill_buffer_during_init: Whether to use `initial_sampler` to fill the buffer initially.
                 If a checkpoint is going to be loaded then this should be set to False.
+            x_dtype: dtype in which the samples x are stored, e.g. torch.bfloat16 or
+                torch.float16 to reduce the memory of the buffer. Defaults to the default dtype.
+            log_w_dtype: dtype in which the log weights and log q are stored, e.g. torch.float32
+                when training in float64. Defaults to the default dtype.
+
+        Sampled data is upcast to the default dtype (at the time the buffer is created). The error
+        from storing x in reduced precision is tracked, see `get_storage_info`.
 
         The `max_length` and `min_sample_length` should be sufficiently long to prevent overfitting
         to the replay data. For example, if `min_sample_length` is equal to the
@@ -49,9 +60,14 @@ class PrioritisedReplayBuffer:
         self.dim = dim
         self.max_length = max_length
         self.min_sample_length = min_sample_length
-        self.buffer = ReplayData(x=torch.zeros(self.max_length, dim).to(device),
-                              log_w=torch.zeros(self.max_length, ).to(device),
-                              log_q_old=torch.zeros(self.max_length, ).to(device))
+        self.dtype = torch.get_default_dtype()
+        self.x_dtype = x_dtype or self.dtype
+        self.log_w_dtype = log_w_dtype or self.dtype
+        self.buffer = ReplayData(x=torch.zeros(self.max_length, dim, dtype=self.x_dtype).to(device),
+                              log_w=torch.zeros(self.max_length, dtype=self.log_w_dtype).to(device),
+                              log_q_old=torch.zeros(self.max_length, dtype=self.log_w_dtype
+                                                    ).to(device))
+        self._quantisation_error = QuantisationError(device)
         self.possible_indices = torch.arange(self.max_length).to(device)
         self.device = device
         self.current_index = 0
@@ -70,10 +86,13 @@ class PrioritisedReplayBuffer:
         """Add a new batch of generated data to the replay buffer"""
         batch_size = x.shape[0]
         x = x.to(self.device)
-        log_w = log_w.to(self.device)
-        log_q_old = log_q_old.to(self.device)
+        x_stored = x.to(self.x_dtype)
+        log_w = log_w.to(self.device, self.log_w_dtype)
+        log_q_old = log_q_old.to(self.device, self.log_w_dtype)
         indices = (torch.arange(batch_size) + self.current_index).to(self.device) % self.max_length
-        self.buffer.x[indices] = x
+        self.buffer.x[indices] = x_stored
+        if self.reduced_precision:
+            self._quantisation_error.update(x, x_stored)
         self.buffer.log_w[indices] = log_w
         self.buffer.log_q_old[indices] = log_q_old
         new_index = self.current_index + batch_size
@@ -86,6 +105,13 @@ class PrioritisedReplayBuffer:
     def sample(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Return a batch of sampled data, if the batch size is specified then the batch will have a
         leading axis of length batch_size, otherwise the default self.batch_size will be used."""
+        indices = self._sample_indices(batch_size)
+        x, log_w, log_q_old = self._gather(indices)
+        return x, log_w, log_q_old, indices
+
+    def _sample_indices(self, batch_size: int) -> torch.Tensor:
+        """Sample the indices of `batch_size` buffer entries, with probability proportional to
+        their importance weights."""
         if not self.can_sample:
             raise Exception("Buffer must be at minimum length before calling sample")
         max_index = self.max_length if self.is_full else self.current_index
@@ -94,9 +120,29 @@ class PrioritisedReplayBuffer:
                                                       ).sample_n(batch_size)
         else:
             indices = sample_without_replacement(self.buffer.log_w[:max_index], batch_size).to(self.device)
-        x, log_w, log_q_old, indices = self.buffer.x[indices], self.buffer.log_w[indices], \
-                                       self.buffer.log_q_old[indices], indices
-        return x, log_w, log_q_old, indices
+        return indices
+
+    def _gather(self, indices: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Return the x, log_w and log_q_old of the buffer entries at `indices`, upcast to
+        `self.dtype`."""
+        return self.buffer.x[indices].to(self.dtype), self.buffer.log_w[indices].to(self.dtype), \
+            self.buffer.log_q_old[indices].to(self.dtype)
+
+    @property
+    def reduced_precision(self) -> bool:
+        """Whether x is stored with lower precision than it is sampled with."""
+        return is_reduced_precision(self.x_dtype, self.dtype)
+
+    def quantise(self, x: torch.Tensor) -> torch.Tensor:
+        """Round x to the precision in which it is stored in the buffer, keeping its dtype."""
+        return x.to(self.x_dtype).to(x.dtype)
+
+    def get_storage_info(self) -> Dict[str, float]:
+        """Memory used by the buffer, and the error of storing x in reduced precision."""
+        info = {"buffer_storage_mb": storage_mbytes(self.buffer)}
+        if self.reduced_precision:
+            info.update(self._quantisation_error.get_info())
+        return info
 
 
     def sample_n_batches(self, batch_size: int, n_batches: int) -> \
@@ -119,8 +165,8 @@ class PrioritisedReplayBuffer:
         log_w_adjustment, log_q, valid_indices = \
             log_w_adjustment[valid_adjustment], log_q[valid_adjustment], indices[valid_adjustment]
         valid_indices = valid_indices.to(self.device)
-        self.buffer.log_w[valid_indices] += log_w_adjustment.to(self.device)
-        self.buffer.log_q_old[valid_indices] = log_q.to(self.device)
+        self.buffer.log_w[valid_indices] += log_w_adjustment.to(self.device, self.log_w_dtype)
+        self.buffer.log_q_old[valid_indices] = log_q.to(self.device, self.log_w_dtype)
 
         # Kill samples in the buffer for which the `log_w_adjustment` is invalid.
         # A common reason this can occur is if AIS discovers a point far outside the reasonable range of the problem.
@@ -130,22 +176,24 @@ class PrioritisedReplayBuffer:
 
 
     def save(self, path):
-        """Save buffer to file."""
-        to_save = {'x': self.buffer.x.detach().cpu(),
-                   'log_w': self.buffer.log_w.detach().cpu(),
-                   'log_q_old': self.buffer.log_q_old.detach().cpu(),
+        """Save buffer to file. Only the filled entries are saved, in the storage dtypes."""
+        n_saved = self.max_length if self.is_full else self.current_index
+        to_save = {'x': self.buffer.x[:n_saved].detach().cpu(),
+                   'log_w': self.buffer.log_w[:n_saved].detach().cpu(),
+                   'log_q_old': self.buffer.log_q_old[:n_saved].detach().cpu(),
                    'current_index': self.current_index,
                    'is_full': self.is_full,
                    'can_sample': self.can_sample}
         torch.save(to_save, path)
 
     def load(self, path):
-        """Load buffer from file."""
+        """Load buffer from file. Buffers saved with a different storage dtype are cast to the
+        storage dtypes of this buffer."""
         old_buffer = torch.load(path)
-        indices = torch.arange(self.max_length)
-        self.buffer.x[indices] = old_buffer['x'].to(self.device)
-        self.buffer.log_w[indices] = old_buffer['log_w'].to(self.device)
-        self.buffer.log_q_old[indices] = old_buffer['log_q_old'].to(self.device)
+        indices = torch.arange(old_buffer['x'].shape[0])
+        self.buffer.x[indices] = old_buffer['x'].to(self.device, self.x_dtype)
+        self.buffer.log_w[indices] = old_buffer['log_w'].to(self.device, self.log_w_dtype)
+        self.buffer.log_q_old[indices] = old_buffer['log_q_old'].to(self.device, self.log_w_dtype)
         self.current_index = old_buffer['current_index']
         self.is_full = old_buffer['is_full']
         self.can_sample = old_buffer['can_sample']
@@ -0,0 +1,49 @@
+import torch
+
+from fab.utils.prioritised_replay_buffer import PrioritisedReplayBuffer
+
+
+def test_prioritised_replay_buffer__reduced_precision(tmp_path, dim: int = 3,
+                                                      batch_size: int = 8):
+    """Check that samples stored in bfloat16 are upcast when sampled, that the quantisation error
+    is tracked, and that a partially filled buffer is restored from a checkpoint."""
+    torch.manual_seed(0)
+
+    x_added = []
+
+    def initial_sampler():
+        x_added.append(torch.randn(batch_size, dim))
+        return x_added[-1], torch.zeros(batch_size), torch.zeros(batch_size)
+
+    buffer = PrioritisedReplayBuffer(dim=dim, max_length=batch_size * 8,
+                                     min_sample_length=batch_size * 2,
+                                     initial_sampler=initial_sampler,
+                                     x_dtype=torch.bfloat16, log_w_dtype=torch.float32)
+    assert buffer.reduced_precision
+    x_new = torch.randn(batch_size, dim)
+    x_added.append(x_new)
+    buffer.add(x_new, torch.zeros(batch_size), torch.ones(batch_size))
+    x, log_w, log_q_old, indices = buffer.sample(batch_size)
+    assert x.dtype == log_w.dtype == log_q_old.dtype == torch.get_default_dtype()
+    buffer.adjust(torch.full((batch_size,), 0.5), log_q_old + 0.1, indices)
+
+    # The stored samples are within the bfloat16 rounding error of the added samples.
+    x_stored, _, _ = buffer._gather(torch.arange(batch_size * 2, batch_size * 3))
+    torch.testing.assert_close(x_stored, buffer.quantise(x_new))
+    torch.testing.assert_close(x_stored, x_new, atol=0.0, rtol=2**-8)
+    info = buffer.get_storage_info()
+    # The running max is over every sample added, including those from the initial sampler.
+    max_abs_x = torch.max(torch.abs(torch.cat(x_added))).item()
+    assert 0.0 < info["x_quantisation_error_max"] <= max_abs_x * 2**-8
+    assert info["buffer_storage_mb"] == buffer.max_length * (dim * 2 + 2 * 4) / 2**20
+
+    buffer.save(str(tmp_path / "buffer.pt"))
+    restored_buffer = PrioritisedReplayBuffer(dim=dim, max_length=batch_size * 8,
+                                              min_sample_length=batch_size * 2,
+                                              initial_sampler=initial_sampler,
+                                              fill_buffer_during_init=False,
+                                              x_dtype=torch.bfloat16, log_w_dtype=torch.float32)
+    restored_buffer.load(str(tmp_path / "buffer.pt"))
+    assert torch.equal(restored_buffer.buffer.x, buffer.buffer.x)
+    assert torch.equal(restored_buffer.buffer.log_w, buffer.buffer.log_w)
+    assert restored_buffer.current_index == buffer.current_index
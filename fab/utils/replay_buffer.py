@@ -1,20 +1,28 @@
-from typing import NamedTuple, Tuple, Iterable, Callable
+from typing import Dict, NamedTuple, Tuple, Iterable, Callable, Optional
 import torch
 
+from fab.utils.buffer_storage import QuantisationError, is_reduced_precision, storage_mbytes
+
 class AISData(NamedTuple):
-    """Log weights and samples generated by annealed importance sampling."""
+    """Log weights and samples generated by annealed importance sampling. Optionally the flow and
+    target log probs of the samples (evaluated when they were added) are also kept."""
     x: torch.Tensor
     log_w: torch.Tensor
     add_count: torch.Tensor
+    log_q: Optional[torch.Tensor] = None
+    log_p: Optional[torch.Tensor] = None
 
 
 class ReplayBuffer:
     def __init__(self, dim: int,
                  max_length: int,
                  min_sample_length: int,
-                 initial_sampler: Callable[[], Tuple[torch.Tensor, torch.Tensor]],
+                 initial_sampler: Callable[[], Tuple[torch.Tensor, ...]],
                  device: str = "cpu",
-                 temperature: float = 1.0
+                 temperature: float = 1.0,
+                 store_log_probs: bool = False,
+                 x_dtype: Optional[torch.dtype] = None,
+                 log_w_dtype: Optional[torch.dtype] = None
                  ):
         """
         Create replay buffer for batched sampling and adding of data.
@@ -22,12 +30,27 @@ class ReplayBuffer:
             dim: dimension of x data
             max_length: maximum length of the buffer
             min_sample_length: minimum length of buffer required for sampling
-            initial_sampler: sampler producing x and log_w, used to fill the buffer up to
+            initial_sampler: sampler producing x and log_w (and log_q and log_p if
+                `store_log_probs` is True), used to fill the buffer up to
                 the min sample length. The initialised flow + AIS may be used here,
                 or we may desire to use AIS with more distributions to give the flow a "good start".
             device: replay buffer device
             temperature: rate at which we anneal the sampling probability of experience as new batches get added
                 anneal_temperature of 0 gives uniform sampling
+            store_log_probs: whether to also store the log_q and log_p of each sample (as computed
+                by AIS), which are then returned by `sample`. This lets the replay loss reuse
+                log_p, rather than re-evaluating the (possibly expensive) target. Note that log_q
+                is the value at the time the sample was added, and is stale once the flow has
+                been updated.
+            x_dtype: dtype in which the samples x are stored, e.g. torch.bfloat16 or
+                torch.float16 to reduce the memory of the buffer. Defaults to the default dtype.
+            log_w_dtype: dtype in which the log weights (and log probs) are stored. Defaults to
+                the default dtype.
+
+        Sampled data is upcast to the default dtype (at the time the buffer is created). If x is
+        stored in reduced precision, then the log probs passed to `add` must be those of the
+        rounded samples (see `fab.utils.buffer_storage.stored_sample_log_probs`), otherwise the
+        replay loss would pair log p of the original sample with log q of the stored one.
 
         The `max_length` and `min_sample_length` should be sufficiently long to prevent overfitting
         to the replay data. For example, if `min_sample_length` is equal to the
@@ -38,9 +61,18 @@ class ReplayBuffer:
         self.dim = dim
         self.max_length = max_length
         self.min_sample_length = min_sample_length
-        self.buffer = AISData(x=torch.zeros(self.max_length, dim).to(device),
-                              log_w=torch.zeros(self.max_length, ).to(device),
-                              add_count=torch.zeros(self.max_length, ).to(device))
+        self.store_log_probs = store_log_probs
+        self.dtype = torch.get_default_dtype()
+        self.x_dtype = x_dtype or self.dtype
+        self.log_w_dtype = log_w_dtype or self.dtype
+        self.buffer = AISData(x=torch.zeros(self.max_length, dim, dtype=self.x_dtype).to(device),
+                              log_w=torch.zeros(self.max_length, dtype=self.log_w_dtype).to(device),
+                              add_count=torch.zeros(self.max_length, ).to(device),
+                              log_q=torch.zeros(self.max_length, dtype=self.log_w_dtype).to(device)
+                              if store_log_probs else None,
+                              log_p=torch.zeros(self.max_length, dtype=self.log_w_dtype).to(device)
+                              if store_log_probs else None)
+        self._quantisation_error = QuantisationError(device)
         self.possible_indices = torch.arange(self.max_length).to(device)
         self.device = device
         self.current_index = 0
@@ -51,20 +83,28 @@ class ReplayBuffer:
 
         while self.can_sample is False:
             # fill buffer up minimum length
-            x, log_w = initial_sampler()
-            self.add(x, log_w)
+            self.add(*initial_sampler())
             self.current_add_count = 0  # reset add count back to zero
         self.current_add_count = 1
 
     @torch.no_grad()
-    def add(self, x: torch.Tensor, log_w: torch.Tensor):
-        """Add a batch of generated data to the replay buffer"""
+    def add(self, x: torch.Tensor, log_w: torch.Tensor, log_q: Optional[torch.Tensor] = None,
+            log_p: Optional[torch.Tensor] = None):
+        """Add a batch of generated data to the replay buffer. `log_q` and `log_p` must be given
+        if (and only if) the buffer stores log probs."""
+        assert (log_q is not None and log_p is not None) == self.store_log_probs
         batch_size = x.shape[0]
         x = x.to(self.device)
-        log_w = log_w.to(self.device)
+        x_stored = x.to(self.x_dtype)
+        log_w = log_w.to(self.device, self.log_w_dtype)
         indices = (torch.arange(batch_size) + self.current_index).to(self.device) % self.max_length
-        self.buffer.x[indices] = x
+        self.buffer.x[indices] = x_stored
         self.buffer.log_w[indices] = log_w
+        if self.store_log_probs:
+            self.buffer.log_q[indices] = log_q.to(self.device, self.log_w_dtype)
+            self.buffer.log_p[indices] = log_p.to(self.device, self.log_w_dtype)
+        if self.reduced_precision:
+            self._quantisation_error.update(x, x_stored)
         self.buffer.add_count[indices] = self.current_add_count
         new_index = self.current_index + batch_size
         if not self.is_full:
@@ -74,9 +114,11 @@ class ReplayBuffer:
         self.current_add_count += 1
 
     @torch.no_grad()
-    def sample(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    def sample(self, batch_size: int) -> Tuple[torch.Tensor, ...]:
         """Return a batch of sampled data, if the batch size is specified then the batch will have a
-        leading axis of length batch_size, otherwise the default self.batch_size will be used."""
+        leading axis of length batch_size, otherwise the default self.batch_size will be used.
+        Returns x and log_w, followed by log_q and log_p if the buffer stores log probs, upcast to
+        `self.dtype`."""
         if not self.can_sample:
             raise Exception("Buffer must be at minimum length before calling sample")
         max_index = self.max_length if self.is_full else self.current_index
@@ -84,16 +126,29 @@ class ReplayBuffer:
         probs = torch.pow(1/rank, self.temperature)
         indices = torch.multinomial(probs, num_samples=batch_size,
                                     replacement=False).to(self.device)  # sample uniformly
-        return self.buffer.x[indices], self.buffer.log_w[indices]
+        data = (self.buffer.x, self.buffer.log_w)
+        if self.store_log_probs:
+            data = data + (self.buffer.log_q, self.buffer.log_p)
+        return tuple(tensor[indices].to(self.dtype) for tensor in data)
+
+    @property
+    def reduced_precision(self) -> bool:
+        """Whether x is stored with lower precision than it is sampled with."""
+        return is_reduced_precision(self.x_dtype, self.dtype)
+
+    def get_storage_info(self) -> Dict[str, float]:
+        """Memory used by the buffer, and the error of storing x in reduced precision."""
+        info = {"buffer_storage_mb": storage_mbytes(self.buffer)}
+        if self.reduced_precision:
+            info.update(self._quantisation_error.get_info())
+        return info
 
 
     def sample_n_batches(self, batch_size: int, n_batches: int) -> \
-            Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+            Iterable[Tuple[torch.Tensor, ...]]:
         """Returns a list of batches."""
-        x, log_w = self.sample(batch_size*n_batches)
-        x_batches = torch.chunk(x, n_batches)
-        log_w_batches = torch.chunk(log_w, n_batches)
-        dataset = [(x, log_w) for x, log_w in zip(x_batches, log_w_batches)]
+        data = self.sample(batch_size*n_batches)
+        dataset = list(zip(*[torch.chunk(tensor, n_batches) for tensor in data]))
         return dataset
 
 
@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from fab.utils.replay_buffer import ReplayBuffer
+
+
+def test_replay_buffer__store_log_probs(dim: int = 3, batch_size: int = 8):
+    """Check that the stored log probs are returned with their samples, and that they must be
+    given if (and only if) the buffer stores them."""
+    torch.manual_seed(0)
+
+    def initial_sampler():
+        x = torch.randn(batch_size, dim)
+        return x, torch.zeros(batch_size), -torch.sum(x**2, dim=-1), torch.sum(x, dim=-1)
+
+    buffer = ReplayBuffer(dim=dim, max_length=batch_size * 4, min_sample_length=batch_size * 2,
+                          initial_sampler=initial_sampler, store_log_probs=True)
+    x, log_w, log_q, log_p = buffer.sample(batch_size)
+    torch.testing.assert_close(log_q, -torch.sum(x**2, dim=-1))
+    torch.testing.assert_close(log_p, torch.sum(x, dim=-1))
+    with pytest.raises(AssertionError):
+        buffer.add(x, log_w)
+    with pytest.raises(AssertionError):
+        buffer.add(x, log_w, log_q)
+
+    buffer = ReplayBuffer(dim=dim, max_length=batch_size * 4, min_sample_length=batch_size * 2,
+                          initial_sampler=lambda: initial_sampler()[:2])
+    assert len(buffer.sample(batch_size)) == 2
+    with pytest.raises(AssertionError):
+        buffer.add(x, log_w, log_q, log_p)
@@ -25,6 +25,16 @@ class WrappedNFlowsModel(TrainableDistribution):
     def log_prob(self, x: torch.Tensor) -> torch.Tensor:
         return self._nf_model.log_prob(x)
 
+    def forward_and_log_det(self, z: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # In nflows the transform maps from data to noise, so its inverse maps z to x.
+        return self._nf_model._transform.inverse(z)
+
+    def inverse_and_log_det(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self._nf_model._transform(x)
+
+    def base_log_prob(self, z: torch.Tensor) -> torch.Tensor:
+        return self._nf_model._distribution.log_prob(z)
+
     @property
     def event_shape(self) -> Tuple[int, ...]:
 
@@ -23,6 +23,15 @@ class WrappedNormFlowModel(TrainableDistribution):
     def log_prob(self, x: torch.Tensor) -> torch.Tensor:
         return self._nf_model.log_prob(x)
 
+    def forward_and_log_det(self, z: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self._nf_model.forward_and_log_det(z)
+
+    def inverse_and_log_det(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self._nf_model.inverse_and_log_det(x)
+
+    def base_log_prob(self, z: torch.Tensor) -> torch.Tensor:
+        return self._nf_model.q0.log_prob(z)
+
     @property
     def event_shape(self) -> Tuple[int, ...]:
         try: